@@ -1,21 +1,48 @@
+import asyncio
+import base64
 import logging
 import os
-import threading
+import signal
+import socket
 from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator
 
-import jwt
 from fastapi import Depends, FastAPI, HTTPException, Request
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.security import HTTPBearer
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from watchdog.events import (
-    FileSystemEvent,
-    FileSystemEventHandler,
-    FileSystemMovedEvent,
+
+from . import respond
+from .channel import run_agent_channel
+from .config import config_file, state_file
+from .dispatch import CatchupPayloads, CatchupResults, deadline_from_headers
+from .history import History, TopicHistory
+from .metrics import METRICS
+from .ratelimit import LoadShed, RateLimiter
+from .registry import (
+    AgentRegistryInterface,
+    GetAgent,
+    GetAgents,
+    MemoryAgentRegistry,
+    PutAgent,
+    make_agent,
+    make_get_agent,
+)
+from .relay import RelayTool, Route, load_relay_agents
+from .scheduler import TopicBusy, TopicScheduler, TopicSuperseded
+from .respond import (
+    RespondTool,
+    TopicHandlerResults,
+    TopicHandlers,
+    TopicRegistry,
+    TopicRun,
 )
-from watchdog.observers import Observer
+from .spool import Spool, SpoolLimitExceeded
+from .supervisor import WorkerHooks, path_fingerprint
+from .wire import encode_results, negotiate
 
-from .respond import RespondTool, TopicHandlerResults, TopicHandlers, TopicRegistry
+if TYPE_CHECKING:
+    from watchdog.observers import Observer
 
 logging.basicConfig(
     level=logging.DEBUG if os.getenv("DEBUG") else logging.INFO,
@@ -31,10 +58,37 @@ class AgentSettings(BaseSettings):
     public_key_file: str = "config/auth/keys/pub"
     jwt_issuer: str = "urn:nightlife:principal"
     jwt_audience: str = "urn:nightlife:agent"
+    spool_dir: str = state_file("spool")
+    max_body_size: int = 64 * 1024 * 1024
+    # Dial out to the principal's push channel, e.g. ws://principal:8000, as
+    # agent_name. The secret file must match the one the agent was registered
+    # with.
+    principal_url: str | None = None
+    agent_name: str | None = None
+    channel_secret_file: str = config_file("auth", "channel-secret")
+    channel_retry_delay: float = 5
+    # Forward every topic to downstream agents after handling it locally.
+    relay: bool = False
+    relay_id: str = socket.gethostname()
+    relay_max_hops: int = 8
+    relay_agents_file: str = config_file("relay-agents.json")
 
 
 SETTINGS = AgentSettings()
 PUBLIC_KEY = b""
+# Set in workers forked by the supervisor, which watches the key file and
+# topics directory for them and sends SIGHUP when they change.
+SUPERVISED = False
+WORKER_ID = 0
+
+SCHEDULER = TopicScheduler()
+HISTORY = History()
+LIMITER = RateLimiter()
+DOWNSTREAM = MemoryAgentRegistry()
+RELAY: RelayTool | None = None
+if SETTINGS.relay:
+    load_relay_agents(SETTINGS.relay_agents_file, DOWNSTREAM)
+    RELAY = RelayTool(DOWNSTREAM, SETTINGS.relay_id, SETTINGS.relay_max_hops)
 
 
 def _read_public_key(public_key_file: str) -> None:
@@ -50,100 +104,229 @@ def _read_public_key(public_key_file: str) -> None:
         PUBLIC_KEY = b""
 
 
-class PublicKeyFileEventHandler(FileSystemEventHandler):
-    def __init__(self, public_key_file: str):
-        self.public_key_file = public_key_file
-        self._thread_active = False
-        self._cv = threading.Condition()
-        self._thread = threading.Thread(target=lambda: self._thread_target())
+def _watch_public_key() -> "Observer | None":
+    # watchdog is only needed by unsupervised agents.
+    from .keywatch import watch_public_key
+
+    try:
+        return watch_public_key(
+            SETTINGS.public_key_file,
+            lambda: _read_public_key(SETTINGS.public_key_file),
+        )
+    except Exception:
+        logging.exception(
+            "Could not watch public key file '%s'", SETTINGS.public_key_file
+        )
+        return None
 
-    def _thread_target(self) -> None:
-        while self._thread_active:
-            _read_public_key(self.public_key_file)
-            with self._cv:
-                self._cv.wait()
 
-    def start(self) -> None:
-        self._thread_active = True
-        self._thread.start()
+def _start_handler_spawner() -> None:
+    try:
+        respond.handler_spawner()
+    except OSError:
+        # Handlers try again to start it when they run.
+        logging.exception("Could not start the handler spawner")
 
-    def stop(self) -> None:
-        self._thread_active = False
-        with self._cv:
-            self._cv.notify_all()
 
-    def join(self) -> None:
-        self._thread.join()
+def _load_shared_state() -> None:
+    _read_public_key(SETTINGS.public_key_file)
+    tool = RespondTool()
+    try:
+        respond.TOPIC_INDEX = tool.topic_index()
+    except FileNotFoundError:
+        logging.error("Topics directory '%s' does not exist", tool.settings.topics_dir)
+        respond.TOPIC_INDEX = {}
 
-    def _on_src_path_event(self, event: FileSystemEvent) -> None:
-        path = os.path.abspath(self.public_key_file)
-        if event.src_path == path:
-            with self._cv:
-                self._cv.notify()
 
-    def _on_dest_path_event(self, event: FileSystemMovedEvent) -> None:
-        path = os.path.abspath(self.public_key_file)
-        if event.dest_path == path:
-            with self._cv:
-                self._cv.notify()
+def _start_worker(worker_id: int) -> None:
+    global SUPERVISED, WORKER_ID
+    SUPERVISED = True
+    WORKER_ID = worker_id
 
-    def on_created(self, event: FileSystemEvent) -> None:
-        self._on_src_path_event(event)
 
-    def on_deleted(self, event: FileSystemEvent) -> None:
-        self._on_src_path_event(event)
+def worker_hooks() -> WorkerHooks:
+    return WorkerHooks(
+        load=_load_shared_state,
+        start_worker=_start_worker,
+        fingerprint=lambda: path_fingerprint(
+            [SETTINGS.public_key_file, RespondTool().settings.topics_dir]
+        ),
+    )
 
-    def on_modified(self, event: FileSystemEvent) -> None:
-        self._on_src_path_event(event)
 
-    def on_moved(self, event: FileSystemMovedEvent) -> None:
-        self._on_dest_path_event(event)
+def _read_channel_secret(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            secret = f.read().strip()
+    except OSError as e:
+        logging.error("Not opening a channel to the principal: %s", str(e))
+        return None
+    if not secret:
+        logging.error("Not opening a channel to the principal: %s is empty", path)
+    return secret or None
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    event_handler = PublicKeyFileEventHandler(SETTINGS.public_key_file)
+    if HISTORY.settings.persist:
+        HISTORY.load()
+    # Handlers start from the spawner, which is not needed before the first
+    # delivery.
+    spawner = asyncio.create_task(asyncio.to_thread(_start_handler_spawner))
+
+    watch = None
+    if SUPERVISED:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, _load_shared_state)
+    else:
+        _read_public_key(SETTINGS.public_key_file)
+        # Watching the key is not needed to answer requests, so it is set up
+        # once the server is already accepting them.
+        watch = asyncio.create_task(asyncio.to_thread(_watch_public_key))
+
+    channel = None
+    # One channel per agent, not per worker.
+    if SETTINGS.principal_url and SETTINGS.agent_name and WORKER_ID == 0:
+        secret = _read_channel_secret(SETTINGS.channel_secret_file)
+        if secret:
+            channel = asyncio.create_task(
+                run_agent_channel(
+                    f"{SETTINGS.principal_url}/channel/{SETTINGS.agent_name}",
+                    SETTINGS.agent_name,
+                    secret,
+                    _handle_channel_topic,
+                    SETTINGS.channel_retry_delay,
+                )
+            )
+
+    yield
 
-    observer = Observer()
-    observer.schedule(
-        event_handler, os.path.dirname(SETTINGS.public_key_file), recursive=True
+    if channel:
+        channel.cancel()
+    await spawner
+    await asyncio.to_thread(respond.close_handler_spawner)
+    if watch:
+        observer = await watch
+        if observer:
+            observer.stop()
+            observer.join()
+
+
+def _verify_token(token: str) -> dict:
+    # Imported on first use: it brings in the cryptography stack.
+    import jwt
+
+    payload = jwt.decode(
+        token, PUBLIC_KEY, audience=SETTINGS.jwt_audience, algorithms=["EdDSA"]
     )
 
-    event_handler.start()
-    observer.start()
+    if payload.get("iss") != SETTINGS.jwt_issuer:
+        raise HTTPException(401, "Unauthorized: invalid iss")
 
-    yield
+    if not payload.get("jti"):
+        raise HTTPException(401, "Unauthorized: missing jti")
 
-    observer.stop()
-    event_handler.stop()
+    return payload
 
-    observer.join()
-    event_handler.join()
+
+def _run_topic(
+    topic_name: str, body: bytes | Spool, run: TopicRun, deadline: float | None
+) -> TopicHandlerResults:
+    results = RespondTool().handle_topic(topic_name, body, run, deadline)
+    HISTORY.record(results)
+    return results
+
+
+async def _respond(
+    topic_name: str, body: bytes | Spool, deadline: float | None
+) -> TopicHandlerResults:
+    try:
+        return await SCHEDULER.run(
+            topic_name,
+            lambda run: _run_topic(topic_name, body, run, deadline),
+        )
+    except TopicBusy:
+        raise HTTPException(429, "topic busy", headers={"Retry-After": "1"})
+    except TopicSuperseded:
+        raise HTTPException(409, "superseded by a newer payload")
+
+
+async def _handle_topic(
+    topic_name: str, body: bytes | Spool, route: Route, deadline: float | None = None
+) -> TopicHandlerResults:
+    if RELAY is None:
+        return await _respond(topic_name, body, deadline)
+
+    if RELAY.is_loop(route):
+        raise HTTPException(508, "relay loop detected")
+
+    # Start forwarding before running local handlers so downstream agents are
+    # not delayed by them. The payload must outlive both.
+    forward = asyncio.create_task(RELAY.forward(topic_name, body, route, deadline))
+    try:
+        return await _respond(topic_name, body, deadline)
+    except FileNotFoundError:
+        # A relay need not handle the topics it only passes on.
+        if not await forward:
+            raise
+        return TopicHandlerResults(name=topic_name)
+    finally:
+        await forward
+
+
+async def _handle_channel_topic(
+    topic_name: str, body: bytes, deadline: float | None
+) -> TopicHandlerResults:
+    # The channel was opened to the configured principal.
+    try:
+        with LIMITER.admitted(SETTINGS.jwt_issuer, topic_name):
+            return await _handle_topic(topic_name, body, Route(), deadline)
+    except LoadShed as e:
+        raise HTTPException(429, str(e), headers=e.headers())
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+def _delivered_topic(request: Request) -> tuple[bool, str | None]:
+    """
+    Whether the request delivers payloads to handlers, and for which topic.
+    """
+    if request.method != "POST":
+        return False, None
+    if request.url.path.startswith("/topic/"):
+        return True, request.url.path.removeprefix("/topic/")
+    return request.url.path == "/catchup", None
+
+
+@app.middleware("http")
+async def shed_load(request: Request, call_next):
+    # Runs after authentication and before anything reads the body.
+    delivery, topic_name = _delivered_topic(request)
+    if not delivery:
+        return await call_next(request)
+    try:
+        LIMITER.admit(request.state.token["iss"], topic_name)
+    except LoadShed as e:
+        logging.warning("Shedding %s: %s", request.url.path, str(e))
+        return PlainTextResponse(str(e), status_code=429, headers=e.headers())
+    try:
+        return await call_next(request)
+    finally:
+        LIMITER.release()
+
+
 @app.middleware("http")
 async def authenticate(request: Request, call_next):
     try:
         authorization = await HTTPBearer(auto_error=False)(request)
         if authorization is None or authorization.scheme.lower() != "bearer":
             raise HTTPException(401, "Unauthorized: missing bearer token")
-        token = authorization.credentials
-        payload = jwt.decode(
-            token, PUBLIC_KEY, audience=SETTINGS.jwt_audience, algorithms=["EdDSA"]
-        )
-
-        if payload.get("iss") != SETTINGS.jwt_issuer:
-            raise HTTPException(401, "Unauthorized: invalid iss")
-
-        if not payload.get("jti"):
-            raise HTTPException(401, "Unauthorized: missing jti")
+        payload = _verify_token(authorization.credentials)
     except HTTPException as e:
         return PlainTextResponse(e.detail, status_code=e.status_code, headers=e.headers)
 
     logging.info("Authenticated JTI %s", payload["jti"])
+    request.state.token = payload
     return await call_next(request)
 
 
@@ -160,8 +343,41 @@ async def log_request(request: Request, call_next):
     return await call_next(request)
 
 
-async def _await_body(request: Request) -> bytes:
-    return await request.body()
+async def _spool_body(request: Request) -> AsyncIterator[Spool]:
+    content_length = request.headers.get("content-length")
+    if content_length:
+        try:
+            length = int(content_length)
+        except ValueError:
+            raise HTTPException(400, "invalid content-length")
+        if length > SETTINGS.max_body_size:
+            raise HTTPException(413, "payload too large")
+
+    # File I/O runs on worker threads so a slow disk does not stall the loop.
+    spool = await asyncio.to_thread(Spool.create, SETTINGS.spool_dir)
+    try:
+        try:
+            async for chunk in request.stream():
+                await asyncio.to_thread(spool.write, chunk, SETTINGS.max_body_size)
+        except SpoolLimitExceeded:
+            raise HTTPException(413, "payload too large")
+        await asyncio.to_thread(spool.close)
+        yield spool
+    finally:
+        await asyncio.to_thread(spool.remove)
+
+
+@app.get("/health")
+async def get_health() -> dict[str, str | int]:
+    """
+    Cheap, authenticated liveness check for the principal's health monitor.
+    """
+    return {"status": "ok", "in_flight": LIMITER.in_flight}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    return METRICS.render()
 
 
 @app.get("/topics")
@@ -180,11 +396,98 @@ async def get_topic(topic_name: str) -> TopicHandlers:
         raise HTTPException(404)
 
 
-@app.post("/topic/{topic_name}")
+@app.get("/topic/{topic_name}/history")
+async def get_topic_history(topic_name: str, limit: int | None = None) -> TopicHistory:
+    if topic_name not in HISTORY:
+        try:
+            RespondTool().topic_handlers(topic_name)
+        except FileNotFoundError:
+            raise HTTPException(404)
+    return HISTORY.topic_history(topic_name, limit)
+
+
+@app.post("/topic/{topic_name}", response_model=TopicHandlerResults)
 async def post_topic(
-    topic_name: str, body: bytes = Depends(_await_body)
-) -> TopicHandlerResults:
+    request: Request, topic_name: str, body: Spool = Depends(_spool_body)
+) -> Response:
+    try:
+        deadline = deadline_from_headers(request.headers)
+    except ValueError:
+        raise HTTPException(400, "invalid budget")
     try:
-        return RespondTool().handle_topic(topic_name, body)
+        route = Route.from_headers(request.headers)
+    except ValueError:
+        raise HTTPException(400, "invalid hop count")
+    try:
+        results = await _handle_topic(topic_name, body, route, deadline)
     except FileNotFoundError:
         raise HTTPException(404)
+
+    # The results were built by RespondTool, so serialize them directly rather
+    # than letting FastAPI validate them against the response model again.
+    media_type = negotiate(request.headers.get("accept"))
+    return Response(encode_results(results, media_type), media_type=media_type)
+
+
+@app.post("/catchup")
+async def post_catchup(catchup: CatchupPayloads) -> CatchupResults:
+    """
+    Handle the latest payload of several topics at once, as sent by the
+    principal to bring this agent up to date.
+    """
+    topic_names = sorted(catchup.payloads_b64)
+    results = await asyncio.gather(
+        *(
+            _handle_topic(
+                topic_name, base64.b64decode(catchup.payloads_b64[topic_name]), Route()
+            )
+            for topic_name in topic_names
+        ),
+        return_exceptions=True,
+    )
+    topics = []
+    for topic_name, result in zip(topic_names, results):
+        if isinstance(result, TopicHandlerResults):
+            topics.append(result)
+        elif not isinstance(result, FileNotFoundError):
+            logging.error(
+                "Failed to catch up on topic %s: %s",
+                topic_name,
+                str(result) or type(result).__name__,
+            )
+    return CatchupResults(topics=topics)
+
+
+def _relay_registry() -> AgentRegistryInterface:
+    if RELAY is None:
+        raise HTTPException(404, "relay mode is disabled")
+    return DOWNSTREAM
+
+
+@app.get("/relay/agents")
+async def get_relay_agents() -> GetAgents:
+    registry = _relay_registry()
+    return GetAgents(
+        agents=[make_get_agent(registry.get(name)) for name in registry.names()]
+    )
+
+
+@app.get("/relay/agent/{agent_name}")
+async def get_relay_agent(agent_name: str) -> GetAgent:
+    try:
+        return make_get_agent(_relay_registry().get(agent_name))
+    except KeyError:
+        raise HTTPException(404)
+
+
+@app.put("/relay/agent/{agent_name}", status_code=204, response_class=Response)
+async def put_relay_agent(agent_name: str, agent: PutAgent) -> None:
+    _relay_registry().put(make_agent(agent_name, agent))
+
+
+@app.delete("/relay/agent/{agent_name}", status_code=204, response_class=Response)
+async def delete_relay_agent(agent_name: str) -> None:
+    try:
+        _relay_registry().delete(agent_name)
+    except KeyError:
+        raise HTTPException(404)
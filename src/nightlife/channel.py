@@ -0,0 +1,265 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import time
+from typing import Awaitable, Callable
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+
+from .respond import TopicHandlerResults
+from .wire import (
+    JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+    decode_results,
+    encode_results,
+    msgpack_available,
+)
+
+# Frames are JSON text messages:
+#
+#   principal -> agent: {"type": "hello", "challenge": c1}
+#   agent -> principal: {"type": "ready", "challenge": c2, "proof": p1}
+#   principal -> agent: {"type": "welcome", "proof": p2}
+#   principal -> agent: {"type": "topic", "id": n, "topic": name, "payload": b64,
+#                        "budget_ms": ms}
+#   agent -> principal: {"type": "results", "id": n, "media_type": t, "body": b64}
+#   agent -> principal: {"type": "error", "id": n, "status": code, "detail": msg}
+#
+# Each side proves it holds the agent's channel secret by answering the other's
+# fresh challenge (see channel_proof), so nothing in the handshake can be
+# replayed, whether on another channel or against the agent's HTTP API.
+#
+# Topic and results frames carry an id so several deliveries can be in flight
+# on one socket at a time. budget_ms is optional, and like the HTTP budget header
+# it is how long the principal will still wait for the results.
+
+
+class ChannelError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"{status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+def channel_proof(secret: bytes, role: str, agent_name: str, challenge: str) -> str:
+    message = "\n".join([role, agent_name, challenge]).encode()
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+def _proof_matches(proof: object, expected: str) -> bool:
+    return isinstance(proof, str) and hmac.compare_digest(proof, expected)
+
+
+class AgentChannel:
+    """
+    The principal's end of a channel an agent dialed in on.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._next_id = 0
+        self._pending: dict[int, asyncio.Future[TopicHandlerResults]] = {}
+
+    async def handshake(self, agent_name: str, secret: bytes) -> bool:
+        challenge = secrets.token_hex(16)
+        await self.websocket.send_json({"type": "hello", "challenge": challenge})
+        frame = await self.websocket.receive_json()
+        if frame.get("type") != "ready" or not _proof_matches(
+            frame.get("proof"), channel_proof(secret, "agent", agent_name, challenge)
+        ):
+            return False
+        agent_challenge = frame.get("challenge")
+        if not isinstance(agent_challenge, str):
+            return False
+        proof = channel_proof(secret, "principal", agent_name, agent_challenge)
+        await self.websocket.send_json({"type": "welcome", "proof": proof})
+        return True
+
+    async def deliver(
+        self, topic: str, payload: bytes, deadline: float | None = None
+    ) -> TopicHandlerResults:
+        self._next_id += 1
+        frame_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[frame_id] = future
+        frame = {
+            "type": "topic",
+            "id": frame_id,
+            "topic": topic,
+            "payload": base64.b64encode(payload).decode(),
+        }
+        if deadline is not None:
+            frame["budget_ms"] = max(0, int((deadline - time.monotonic()) * 1000))
+        try:
+            await self.websocket.send_json(frame)
+            return await future
+        finally:
+            self._pending.pop(frame_id, None)
+
+    async def receive(self) -> None:
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                frame = json.loads(message.get("text") or "")
+            except ValueError:
+                logging.warning("Ignoring channel message that is not JSON text")
+                continue
+            if not isinstance(frame, dict) or frame.get("type") not in (
+                "results",
+                "error",
+            ):
+                logging.warning("Ignoring unexpected channel frame")
+                continue
+            frame_id = frame.get("id")
+            future = self._pending.get(frame_id) if isinstance(frame_id, int) else None
+            if future is None or future.done():
+                continue
+            if frame["type"] == "results":
+                try:
+                    body = base64.b64decode(frame["body"], validate=True)
+                    results = decode_results(body, frame["media_type"])
+                except Exception as e:
+                    logging.warning("Malformed results frame on channel: %s", str(e))
+                    future.set_exception(ChannelError(502, "malformed results"))
+                    continue
+                future.set_result(results)
+            else:
+                status = frame.get("status")
+                detail = frame.get("detail")
+                future.set_exception(
+                    ChannelError(
+                        status if isinstance(status, int) else 500,
+                        detail if isinstance(detail, str) else "",
+                    )
+                )
+
+    def close(self) -> None:
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ChannelError(503, "channel closed"))
+
+
+# Called with the topic, its payload and the time.monotonic() deadline, if any.
+TopicHandler = Callable[[str, bytes, float | None], Awaitable[TopicHandlerResults]]
+
+
+async def _answer(websocket, frame: dict, handle: TopicHandler, media_type: str):
+    from websockets.exceptions import ConnectionClosed
+
+    try:
+        if not isinstance(frame.get("topic"), str) or not isinstance(
+            frame.get("payload"), str
+        ):
+            raise HTTPException(400, "invalid topic frame")
+        deadline = None
+        budget_ms = frame.get("budget_ms")
+        if budget_ms is not None:
+            if isinstance(budget_ms, bool) or not isinstance(budget_ms, (int, float)):
+                raise HTTPException(400, "invalid budget")
+            deadline = time.monotonic() + budget_ms / 1000
+        try:
+            payload = base64.b64decode(frame["payload"], validate=True)
+        except ValueError:
+            raise HTTPException(400, "invalid payload")
+        results = await handle(frame["topic"], payload, deadline)
+    except FileNotFoundError:
+        reply = {"type": "error", "id": frame["id"], "status": 404, "detail": ""}
+    except HTTPException as e:
+        reply = {
+            "type": "error",
+            "id": frame["id"],
+            "status": e.status_code,
+            "detail": e.detail,
+        }
+    except Exception as e:
+        logging.exception("Failed to handle topic %s from channel", frame.get("topic"))
+        reply = {"type": "error", "id": frame["id"], "status": 500, "detail": str(e)}
+    else:
+        reply = {
+            "type": "results",
+            "id": frame["id"],
+            "media_type": media_type,
+            "body": base64.b64encode(encode_results(results, media_type)).decode(),
+        }
+    try:
+        await websocket.send(json.dumps(reply))
+    except ConnectionClosed:
+        logging.info("Channel closed before results of frame %d were sent", frame["id"])
+
+
+async def run_agent_channel(
+    url: str,
+    agent_name: str,
+    secret: bytes,
+    handle: TopicHandler,
+    retry_delay: float,
+) -> None:
+    """
+    Keep a channel to the principal open, reconnecting after failures, and
+    answer every topic pushed over it.
+    """
+    from websockets.asyncio.client import connect
+
+    media_type = MSGPACK_MEDIA_TYPE if msgpack_available() else JSON_MEDIA_TYPE
+    while True:
+        tasks: set[asyncio.Task] = set()
+        try:
+            async with connect(url) as websocket:
+                hello = json.loads(await websocket.recv())
+                if hello.get("type") != "hello" or not isinstance(
+                    hello.get("challenge"), str
+                ):
+                    raise ChannelError(400, "expected hello")
+                challenge = secrets.token_hex(16)
+                proof = channel_proof(secret, "agent", agent_name, hello["challenge"])
+                await websocket.send(
+                    json.dumps(
+                        {"type": "ready", "challenge": challenge, "proof": proof}
+                    )
+                )
+                # Once the principal has proven it holds the secret too, frames
+                # on this socket are trusted.
+                welcome = json.loads(await websocket.recv())
+                if welcome.get("type") != "welcome" or not _proof_matches(
+                    welcome.get("proof"),
+                    channel_proof(secret, "principal", agent_name, challenge),
+                ):
+                    raise ChannelError(401, "principal failed the handshake")
+                logging.info("Connected channel to principal at %s", url)
+
+                async for message in websocket:
+                    try:
+                        frame = json.loads(message)
+                    except ValueError:
+                        logging.warning("Ignoring channel message that is not JSON")
+                        continue
+                    if not isinstance(frame, dict) or frame.get("type") != "topic":
+                        logging.warning("Ignoring unexpected channel frame")
+                        continue
+                    if isinstance(frame.get("id"), bool) or not isinstance(
+                        frame.get("id"), int
+                    ):
+                        # Without an id there is nobody to answer.
+                        logging.warning("Ignoring topic frame without an id")
+                        continue
+                    task = asyncio.create_task(
+                        _answer(websocket, frame, handle, media_type)
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("Channel to principal at %s failed: %s", url, str(e))
+        finally:
+            # Answers in progress have no socket left to go to.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(retry_delay)
@@ -0,0 +1,144 @@
+"""
+Minimal client for the principal server.
+
+The notify and register tools run once per event, so this module must only
+import the standard library; importing FastAPI, pydantic or the crypto stack
+here would dominate their runtime. http.client is used directly because
+urllib.request and dataclasses each add several milliseconds of imports.
+"""
+
+import base64
+import http.client
+import json
+import socket
+import urllib.parse
+
+from .config import (
+    PRINCIPAL_LOCKFILE,
+    UNIX_SCHEME,
+    local_urls,
+    read_lockfile,
+    unix_path,
+)
+
+
+class PrincipalError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float | None = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class PrincipalClient:
+    def __init__(self, urls: list[str], timeout: float = 30):
+        self.urls = urls
+        self.timeout = timeout
+
+    @classmethod
+    def from_lockfile(cls, lockfile: str = PRINCIPAL_LOCKFILE) -> "PrincipalClient":
+        return cls(urls=local_urls(read_lockfile(lockfile)))
+
+    def notify(
+        self, event: str, payload: bytes | None = None, deadline: float | None = None
+    ) -> dict:
+        """
+        Returns the principal's DispatchResults as decoded JSON.
+        """
+        path = f"/dispatch/{event}"
+        if deadline is not None:
+            path += "?" + urllib.parse.urlencode({"deadline": deadline})
+        return json.loads(self._request("POST", path, payload))
+
+    def catchup(self, agent_name: str) -> dict:
+        """
+        Returns the principal's CatchupResults as decoded JSON.
+        """
+        return json.loads(self._request("POST", f"/catchup/{agent_name}"))
+
+    def register(
+        self,
+        agent_name: str,
+        host: str,
+        key_path: str,
+        events: list[str],
+        key_password: bytes | None = None,
+        channel_secret_path: str | None = None,
+    ) -> None:
+        body = {
+            "host": host,
+            "key_path": key_path,
+            "key_password_b64": (
+                base64.b64encode(key_password).decode() if key_password else None
+            ),
+            "events": events,
+            "channel_secret_path": channel_secret_path,
+        }
+        self._request(
+            "PUT",
+            f"/agent/{agent_name}",
+            json.dumps(body).encode(),
+            {"Content-Type": "application/json"},
+        )
+
+    def _connect(self) -> tuple[http.client.HTTPConnection, str]:
+        for index, url in enumerate(self.urls):
+            parts = urllib.parse.urlsplit(url)
+            connection: http.client.HTTPConnection
+            if parts.scheme == UNIX_SCHEME:
+                connection = UnixHTTPConnection(unix_path(url), timeout=self.timeout)
+            elif parts.scheme == "https":
+                connection = http.client.HTTPSConnection(
+                    parts.netloc, timeout=self.timeout
+                )
+            else:
+                connection = http.client.HTTPConnection(
+                    parts.netloc, timeout=self.timeout
+                )
+            try:
+                connection.connect()
+            except OSError:
+                # A server killed by a signal leaves its socket file behind;
+                # fall through to the next advertised address.
+                if index == len(self.urls) - 1:
+                    raise
+                continue
+            return connection, parts.path.rstrip("/")
+        raise PrincipalError("principal lockfile lists no addresses")
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> bytes:
+        connection, prefix = self._connect()
+        try:
+            if body is None:
+                # request() would send Content-Length: 0, which the principal
+                # takes for an empty payload rather than none.
+                connection.putrequest(method, prefix + path)
+                for name, value in (headers or {}).items():
+                    connection.putheader(name, value)
+                connection.endheaders()
+            else:
+                connection.request(
+                    method, prefix + path, body=body, headers=headers or {}
+                )
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise PrincipalError(
+                f"{method} {path} failed: {response.status} {response.reason}"
+            )
+        return data
@@ -37,13 +37,63 @@ def state_file(*parts: str) -> str:
 
 PRINCIPAL_LOCKFILE = state_file("principal.lock")
 AGENT_LOCKFILE = state_file("agent.lock")
+PRINCIPAL_SOCKET = state_file("principal.sock")
+AGENT_SOCKET = state_file("agent.sock")
 
+UNIX_SCHEME = "http+unix"
 
-def write_lockfile(lockfile: str, host: str, port: int) -> None:
-    url = f"{host}:{port}"
-    if not urllib.parse.urlparse(url).scheme:
-        url = f"http://{url}"
+
+def unix_url(path: str) -> str:
+    return f"{UNIX_SCHEME}://{urllib.parse.quote(os.path.abspath(path), safe='')}"
+
+
+def unix_path(url: str) -> str:
+    return urllib.parse.unquote(urllib.parse.urlsplit(url).netloc)
+
+
+def write_lockfile(
+    lockfile: str, host: str | None, port: int | None, uds: str | None = None
+) -> None:
+    """
+    Advertise the server's TCP address, if it has one, and then its Unix
+    socket, if any.
+    """
+    urls = []
+    if host is not None:
+        if ":" in host and not host.startswith("["):
+            # IPv6 addresses are bracketed in URLs.
+            host = f"[{host}]"
+        url = f"{host}:{port}"
+        if "://" not in url:
+            url = f"http://{url}"
+        urls.append(url)
+    if uds:
+        urls.append(unix_url(uds))
 
     os.makedirs(os.path.dirname(lockfile), exist_ok=True)
     with open(lockfile, "w") as f:
-        f.write(url)
+        f.write("\n".join(urls))
+
+
+def read_lockfile(lockfile: str) -> list[str]:
+    """
+    Return the URLs the server advertised: its TCP address, if any, then its
+    Unix socket, if any.
+    """
+    with open(lockfile) as f:
+        return f.read().split()
+
+
+def local_urls(urls: list[str]) -> list[str]:
+    """
+    Order the advertised URLs for a local client: Unix sockets that exist come
+    before the server's TCP address.
+    """
+    unix = [
+        url
+        for url in urls
+        if urllib.parse.urlsplit(url).scheme == UNIX_SCHEME
+        and os.path.exists(unix_path(url))
+    ]
+    tcp = [url for url in urls if urllib.parse.urlsplit(url).scheme != UNIX_SCHEME]
+    return unix + tcp
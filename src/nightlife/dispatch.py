@@ -1,17 +1,43 @@
+import base64
 import datetime
 import logging
 import os
 import subprocess
+import threading
+import time
 import urllib.request
 import uuid
+from concurrent.futures import Future
 from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, BinaryIO, Literal, Mapping
 
-import jwt
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from .config import config_file
+from .respond import TopicHandlerResults
+from .wire import JSON_MEDIA_TYPE, decode_results
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+# Milliseconds the sender will still wait for a topic's results. Agents skip or
+# cut short handlers that could not finish within it.
+BUDGET_HEADER = "X-Nightlife-Budget-Ms"
+
+
+def budget_headers(deadline: float | None) -> dict[str, str]:
+    if deadline is None:
+        return {}
+    budget_ms = max(0, int((deadline - time.monotonic()) * 1000))
+    return {BUDGET_HEADER: str(budget_ms)}
+
+
+def deadline_from_headers(headers: Mapping[str, str]) -> float | None:
+    budget_ms = headers.get(BUDGET_HEADER)
+    if not budget_ms:
+        return None
+    return time.monotonic() + int(budget_ms) / 1000
 
 
 class DispatchSettings(BaseSettings):
@@ -19,9 +45,68 @@ class DispatchSettings(BaseSettings):
 
     events_dir: str = config_file("enabled/events")
     event_timeout: int = 30
+    # Upper bound on one delivery to an agent, whether or not a dispatch
+    # deadline is still waiting for it.
+    broadcast_timeout: float = 30
     timesync_tolerance: int = 30
     jwt_issuer: str = "urn:nightlife:principal"
     jwt_audience: str = "urn:nightlife:agent"
+    accept: str = JSON_MEDIA_TYPE
+    trigger_cache_ttl: float = 0
+    trigger_cache_ttls: dict[str, float] = {}
+
+
+LOCAL_RESULT_NAME = "principal"
+
+
+class AgentDispatchResult(BaseModel):
+    name: str
+    # pending: the agent had not answered by the dispatch deadline. Delivery
+    # carries on in the background.
+    # parked: the agent's circuit breaker is open. It is caught up on the event
+    # once it answers health probes again.
+    status: Literal["ok", "error", "pending", "parked"]
+    latency_ms: int | None = None
+    error: str | None = None
+    results: TopicHandlerResults | None = None
+
+
+class DispatchResults(BaseModel):
+    name: str
+    agents: list[AgentDispatchResult] = []
+    # The principal's own handlers, named LOCAL_RESULT_NAME. None when it has
+    # none for the event.
+    local: AgentDispatchResult | None = None
+    # Milliseconds spent triggering the event, running the local handlers and
+    # delivering to every agent. Stages still running at the deadline are left
+    # out.
+    stage_ms: dict[str, int] = {}
+
+
+class CatchupPayloads(BaseModel):
+    # Latest payload of each event, base64 encoded.
+    payloads_b64: dict[str, str] = {}
+
+
+class CatchupResults(BaseModel):
+    topics: list[TopicHandlerResults] = []
+
+
+def make_catchup_payloads(payloads: dict[str, bytes]) -> CatchupPayloads:
+    return CatchupPayloads(
+        payloads_b64={
+            event: base64.b64encode(payload).decode()
+            for event, payload in payloads.items()
+        }
+    )
+
+
+# Recent trigger output per event, as (monotonic capture time, output).
+TRIGGER_CACHE: dict[str, tuple[float, bytes]] = {}
+# Triggers being run to fill the cache, which concurrent misses wait for
+# instead of running the event again.
+TRIGGER_IN_FLIGHT: dict[str, Future[bytes]] = {}
+TRIGGER_CACHE_LOCK = threading.Lock()
 
 
 @dataclass
@@ -29,6 +114,39 @@ class TriggerTool:
     settings: DispatchSettings = field(default_factory=DispatchSettings)
 
     def trigger(self, event: str) -> bytes:
+        ttl = self.settings.trigger_cache_ttls.get(
+            event, self.settings.trigger_cache_ttl
+        )
+        if ttl <= 0:
+            return self._run(event)
+
+        with TRIGGER_CACHE_LOCK:
+            cached = TRIGGER_CACHE.get(event)
+            if cached and time.monotonic() - cached[0] < ttl:
+                logging.info("Using cached trigger output for event: %s", event)
+                return cached[1]
+            in_flight = TRIGGER_IN_FLIGHT.get(event)
+            if in_flight is None:
+                future: Future[bytes] = Future()
+                TRIGGER_IN_FLIGHT[event] = future
+        if in_flight is not None:
+            logging.info("Waiting for in-flight trigger of event: %s", event)
+            return in_flight.result()
+
+        try:
+            output = self._run(event)
+        except BaseException as e:
+            with TRIGGER_CACHE_LOCK:
+                del TRIGGER_IN_FLIGHT[event]
+            future.set_exception(e)
+            raise
+        with TRIGGER_CACHE_LOCK:
+            TRIGGER_CACHE[event] = (time.monotonic(), output)
+            del TRIGGER_IN_FLIGHT[event]
+        future.set_result(output)
+        return output
+
+    def _run(self, event: str) -> bytes:
         logging.info("Triggering event: %s", event)
         event_path = os.path.join(self.settings.events_dir, event)
         p = subprocess.run(
@@ -46,13 +164,52 @@ class BroadcastTool:
     private_key_file: str
     private_key_password: bytes | None
     settings: DispatchSettings = field(default_factory=DispatchSettings)
+    headers: dict[str, str] = field(default_factory=dict)
+
+    def broadcast(self, event: str, body: bytes | BinaryIO) -> bytes:
+        return self._post_topic(event, self.token(), body)[1]
 
-    def broadcast(self, event: str, body: bytes) -> bytes:
+    def broadcast_results(
+        self, event: str, body: bytes | BinaryIO
+    ) -> TopicHandlerResults:
+        content_type, data = self._post_topic(event, self.token(), body)
+        return decode_results(data, content_type)
+
+    def catchup(self, payloads: dict[str, bytes]) -> CatchupResults:
+        """
+        Deliver the current payload of several events in one request.
+        """
+        logging.info("Posting catch-up of %d events", len(payloads))
+        _, data = self._post(
+            "/catchup",
+            self.token(),
+            make_catchup_payloads(payloads).model_dump_json().encode(),
+            accept=JSON_MEDIA_TYPE,
+            content_type=JSON_MEDIA_TYPE,
+        )
+        return CatchupResults.model_validate_json(data)
+
+    def probe(self, timeout: float) -> None:
+        """
+        Check that the agent is up and accepts this key. Raises on failure.
+        """
+        request = urllib.request.Request(f"{self.agent_host}/health")
+        request.add_header("Authorization", "bearer " + self.token())
+        with urllib.request.urlopen(request, timeout=timeout) as f:
+            f.read()
+
+    def token(self) -> str:
         privkey = self._read_private_key()
-        token = self._encode_jwt(privkey)
-        return self._post_topic(event, token, body)
+        return self._encode_jwt(privkey)
+
+    def _read_private_key(self) -> "Ed25519PrivateKey":
+        # Signing is only needed by the principal and relays, so agents do not
+        # load the cryptography stack just by importing this module.
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+            Ed25519PrivateKey,
+        )
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
-    def _read_private_key(self) -> Ed25519PrivateKey:
         logging.info("Reading private key file")
         with open(self.private_key_file, "rb") as f:
             privkey_bytes = f.read()
@@ -60,7 +217,9 @@ class BroadcastTool:
         assert isinstance(privkey, Ed25519PrivateKey)
         return privkey
 
-    def _encode_jwt(self, privkey: Ed25519PrivateKey) -> str:
+    def _encode_jwt(self, privkey: "Ed25519PrivateKey") -> str:
+        import jwt
+
         logging.info("Encoding JWT")
         now = datetime.datetime.now(tz=datetime.timezone.utc)
         tolerance = datetime.timedelta(seconds=self.settings.timesync_tolerance)
@@ -74,16 +233,35 @@ class BroadcastTool:
         }
         return jwt.encode(payload, privkey, algorithm="EdDSA")
 
-    def _post_topic(self, event: str, token: str, body: bytes) -> bytes:
+    def _post_topic(
+        self, event: str, token: str, body: bytes | BinaryIO
+    ) -> tuple[str, bytes]:
         logging.info("Posting topic %s", event)
+        return self._post(f"/topic/{event}", token, body, self.settings.accept)
+
+    def _post(
+        self,
+        path: str,
+        token: str,
+        body: bytes | BinaryIO,
+        accept: str,
+        content_type: str | None = None,
+    ) -> tuple[str, bytes]:
         request = urllib.request.Request(
-            f"{self.agent_host}/topic/{event}",
+            f"{self.agent_host}{path}",
             method="POST",
             data=body,
         )
         request.add_header("Authorization", "bearer " + token)
-        with urllib.request.urlopen(request) as f:
-            return f.read()
+        request.add_header("Accept", accept)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        for name, value in self.headers.items():
+            request.add_header(name, value)
+        with urllib.request.urlopen(
+            request, timeout=self.settings.broadcast_timeout
+        ) as f:
+            return f.headers.get_content_type(), f.read()
 
 
 class DispatchTool:
@@ -0,0 +1,264 @@
+import logging
+import os
+import subprocess
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Literal
+
+from pydantic import BaseModel
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+
+from .dispatch import DispatchSettings, TriggerTool
+
+# Called with the event name and its payload. A payload of None asks the
+# dispatcher to trigger the event to produce one.
+Dispatcher = Callable[[str, bytes | None], None]
+
+
+class EventSourceConfig(BaseModel):
+    event: str
+    kind: Literal["watch", "poll", "process"]
+    # watch: paths to observe; any change triggers the event.
+    paths: list[str] = []
+    recursive: bool = False
+    debounce: float = 0.5
+    # poll: trigger the event every interval, dispatching when output changes.
+    interval: float = 60
+    dispatch_unchanged: bool = False
+    # process: long-lived command whose stdout lines are event payloads.
+    command: list[str] = []
+    restart_delay: float = 5
+
+
+class EventSources(BaseModel):
+    sources: list[EventSourceConfig] = []
+
+
+def load_event_sources(path: str) -> EventSources:
+    try:
+        with open(path, "rb") as f:
+            return EventSources.model_validate_json(f.read())
+    except FileNotFoundError:
+        return EventSources()
+
+
+class EventSource:
+    def __init__(self, config: EventSourceConfig, dispatch: Dispatcher):
+        self.config = config
+        self.dispatch = dispatch
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def join(self) -> None:
+        pass
+
+    def _dispatch(self, payload: bytes | None) -> None:
+        try:
+            self.dispatch(self.config.event, payload)
+        except Exception:
+            logging.exception("Failed to dispatch event %s", self.config.event)
+
+
+class _WatchEventHandler(FileSystemEventHandler):
+    def __init__(self, source: "WatchEventSource"):
+        self.source = source
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        # Reading a file is not a change to it.
+        if event.is_directory or event.event_type in ("opened", "closed_no_write"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        if any(self.source.matches(os.fsdecode(path)) for path in paths if path):
+            self.source.notify()
+
+
+class WatchEventSource(EventSource):
+    def __init__(self, config: EventSourceConfig, dispatch: Dispatcher):
+        super().__init__(config, dispatch)
+        self._observer = Observer()
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        # A file is watched through its directory, which also reports changes
+        # to the file's siblings; only events for these paths count.
+        self._targets: list[str] = []
+        handler = _WatchEventHandler(self)
+        for path in config.paths:
+            path = os.path.abspath(os.path.expanduser(path))
+            watched = path if os.path.isdir(path) else os.path.dirname(path)
+            if not os.path.isdir(watched):
+                logging.error(
+                    "Not watching %s for event %s: %s does not exist",
+                    path,
+                    config.event,
+                    watched,
+                )
+                continue
+            self._targets.append(path)
+            self._observer.schedule(handler, watched, recursive=config.recursive)
+
+    def matches(self, path: str) -> bool:
+        return any(
+            path == target or path.startswith(target + os.sep)
+            for target in self._targets
+        )
+
+    def notify(self) -> None:
+        # Editors and installers tend to touch a file several times in a row;
+        # coalesce the burst into a single dispatch.
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(
+                self.config.debounce, lambda: self._dispatch(None)
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def start(self) -> None:
+        logging.info("Watching %s for event %s", self.config.paths, self.config.event)
+        self._observer.start()
+
+    def stop(self) -> None:
+        super().stop()
+        self._observer.stop()
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+
+    def join(self) -> None:
+        self._observer.join()
+
+
+class PollEventSource(EventSource):
+    def __init__(
+        self,
+        config: EventSourceConfig,
+        dispatch: Dispatcher,
+        settings: DispatchSettings | None = None,
+    ):
+        super().__init__(config, dispatch)
+        self.trigger = TriggerTool(settings or DispatchSettings())
+        self._last: bytes | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                payload = self.trigger.trigger(self.config.event)
+            except Exception:
+                logging.exception("Failed to poll event %s", self.config.event)
+            else:
+                if self.config.dispatch_unchanged or payload != self._last:
+                    self._last = payload
+                    self._dispatch(payload)
+            self._stopped.wait(self.config.interval)
+
+    def start(self) -> None:
+        logging.info(
+            "Polling event %s every %ss", self.config.event, self.config.interval
+        )
+        self._thread.start()
+
+    def join(self) -> None:
+        self._thread.join()
+
+
+class ProcessEventSource(EventSource):
+    def __init__(self, config: EventSourceConfig, dispatch: Dispatcher):
+        super().__init__(config, dispatch)
+        self._process: subprocess.Popen | None = None
+        # Held while starting the process, so that stop either sees it or
+        # keeps it from being started.
+        self._process_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            logging.info(
+                "Starting event source %s for event %s",
+                self.config.command,
+                self.config.event,
+            )
+            try:
+                with self._process_lock:
+                    if self._stopped.is_set():
+                        break
+                    self._process = subprocess.Popen(
+                        self.config.command,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                    )
+            except OSError:
+                logging.exception("Failed to start event source %s", self.config.event)
+            else:
+                assert self._process.stdout
+                for line in self._process.stdout:
+                    self._dispatch(line.rstrip(b"\r\n"))
+                exit_status = self._process.wait()
+                logging.warning(
+                    "Event source for %s exited with status %d",
+                    self.config.event,
+                    exit_status,
+                )
+            self._stopped.wait(self.config.restart_delay)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._process_lock:
+            super().stop()
+            if self._process and self._process.poll() is None:
+                self._process.terminate()
+
+    def join(self) -> None:
+        self._thread.join()
+
+
+def make_event_source(config: EventSourceConfig, dispatch: Dispatcher) -> EventSource:
+    if config.kind == "watch":
+        return WatchEventSource(config, dispatch)
+    if config.kind == "poll":
+        return PollEventSource(config, dispatch)
+    return ProcessEventSource(config, dispatch)
+
+
+@dataclass
+class EventSourceManager:
+    dispatch: Dispatcher
+    sources: list[EventSource] = field(default_factory=list)
+
+    def load(self, path: str) -> None:
+        for config in load_event_sources(path).sources:
+            try:
+                self.sources.append(make_event_source(config, self.dispatch))
+            except Exception:
+                logging.exception("Failed to set up event source %s", config.event)
+
+    def start(self) -> None:
+        # One broken source must not keep the server or the others from running.
+        started = []
+        for source in self.sources:
+            try:
+                source.start()
+            except Exception:
+                logging.exception(
+                    "Failed to start event source %s", source.config.event
+                )
+                continue
+            started.append(source)
+        self.sources = started
+
+    def stop(self) -> None:
+        for source in self.sources:
+            source.stop()
+
+    def join(self) -> None:
+        for source in self.sources:
+            source.join()
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+import urllib.error
+from typing import Callable
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from .dispatch import BroadcastTool, DispatchSettings
+from .registry import Agent, AgentHealth, AgentRegistryInterface
+
+
+class HealthSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="NIGHTLIFE_HEALTH_")
+
+    # Seconds between probes of every registered agent. 0 disables probing,
+    # which leaves breakers to be opened by failed deliveries alone and never
+    # closed again.
+    interval: float = 30
+    timeout: float = 2
+    # Failed probes or deliveries in a row that open an agent's breaker.
+    failure_threshold: int = 3
+
+
+def is_unreachable(e: Exception) -> bool:
+    """
+    Whether a failed delivery shows that the agent could not be reached, as
+    opposed to an error the agent answered with or a delivery that was slow.
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return False
+    return isinstance(e, (urllib.error.URLError, ConnectionError))
+
+
+class HealthMonitor:
+    """
+    Tracks whether each registered agent is reachable, from periodic probes of
+    its /health endpoint and from the outcome of deliveries. An agent that
+    fails failure_threshold times in a row has its breaker opened until a
+    probe succeeds. Health is kept in the registry, so that workers sharing it
+    agree on which breakers are open; only one of them should run the probes.
+    Meant to be used from the event loop only.
+    """
+
+    def __init__(
+        self,
+        registry: AgentRegistryInterface,
+        settings: HealthSettings | None = None,
+        # Agents connected over a channel are known to be up.
+        connected: Callable[[str], bool] = lambda agent_name: False,
+        # Called with an agent whose breaker just closed again.
+        on_recover: Callable[[Agent], None] = lambda agent: None,
+    ):
+        self.registry = registry
+        self.settings = settings or HealthSettings()
+        self.connected = connected
+        self.on_recover = on_recover
+
+    async def health(self, agent_name: str) -> AgentHealth:
+        health = await asyncio.to_thread(self.registry.health, agent_name)
+        return health or AgentHealth()
+
+    async def is_open(self, agent_name: str) -> bool:
+        return (await self.health(agent_name)).breaker == "open"
+
+    async def reset(self, agent_name: str) -> None:
+        """
+        Forget what is known about the agent, closing its breaker.
+        """
+        await asyncio.to_thread(
+            self.registry.update_health, agent_name, lambda health: None
+        )
+
+    async def record_success(
+        self, agent: Agent, latency_ms: int | None, probed: bool = False
+    ) -> None:
+        recovered = False
+
+        def update(current: AgentHealth | None) -> AgentHealth | None:
+            nonlocal recovered
+            health = current or AgentHealth()
+            if (
+                not probed
+                and health.breaker == "closed"
+                and not health.consecutive_failures
+            ):
+                # A delivery to a healthy agent changes nothing worth writing.
+                return current
+            recovered = health.breaker == "open"
+            return AgentHealth(
+                breaker="closed",
+                consecutive_failures=0,
+                latency_ms=latency_ms if latency_ms is not None else health.latency_ms,
+                last_checked=time.time(),
+                error=None,
+            )
+
+        await asyncio.to_thread(self.registry.update_health, agent.name, update)
+        if recovered:
+            logging.info("Agent %s is reachable again; closing its breaker", agent.name)
+            self.on_recover(agent)
+
+    async def record_failure(self, agent: Agent, error: str) -> None:
+        opened = 0
+
+        def update(current: AgentHealth | None) -> AgentHealth:
+            nonlocal opened
+            health = (current or AgentHealth()).model_copy()
+            health.consecutive_failures += 1
+            health.last_checked = time.time()
+            health.error = error
+            if (
+                health.breaker == "closed"
+                and health.consecutive_failures >= self.settings.failure_threshold
+            ):
+                health.breaker = "open"
+                opened = health.consecutive_failures
+            return health
+
+        await asyncio.to_thread(self.registry.update_health, agent.name, update)
+        if opened:
+            logging.warning(
+                "Agent %s failed %d times in a row; opening its breaker: %s",
+                agent.name,
+                opened,
+                error,
+            )
+
+    async def run(self) -> None:
+        if self.settings.interval <= 0:
+            return
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logging.exception("Failed to probe agents")
+            await asyncio.sleep(self.settings.interval)
+
+    async def probe_all(self) -> None:
+        agents = []
+        for agent_name in await asyncio.to_thread(self.registry.names):
+            try:
+                agents.append(await asyncio.to_thread(self.registry.get, agent_name))
+            except KeyError:
+                continue
+        await asyncio.gather(*(self._probe(agent) for agent in agents))
+
+    async def _probe(self, agent: Agent) -> None:
+        if self.connected(agent.name):
+            await self.record_success(agent, None, probed=True)
+            return
+        broadcast = BroadcastTool(
+            agent_host=agent.host,
+            private_key_file=agent.key_path,
+            private_key_password=agent.key_password,
+            settings=DispatchSettings(),
+        )
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(broadcast.probe, self.settings.timeout)
+        except Exception as e:
+            logging.debug("Health probe of agent %s failed: %s", agent.name, str(e))
+            await self.record_failure(agent, str(e) or type(e).__name__)
+            return
+        await self.record_success(
+            agent, int((time.monotonic() - start) * 1000), probed=True
+        )
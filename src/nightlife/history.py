@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from .config import state_file
+from .respond import TopicHandlerResults, handler_outcome
+
+PERCENTILES = (50, 90, 99)
+
+
+class HistorySettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="NIGHTLIFE_HISTORY_")
+
+    # Runs kept in memory for each handler of each topic.
+    size: int = 100
+    # Append every run to log_file too, and replay it on startup. The log is
+    # rotated to log_file.1 once it grows past max_log_bytes.
+    persist: bool = False
+    log_file: str = state_file("history.log")
+    max_log_bytes: int = 1024 * 1024
+
+
+class HistoryEntry(BaseModel):
+    time: float
+    outcome: str
+    exit_status: int | None
+    runtime_ms: int
+
+
+class HandlerHistory(BaseModel):
+    name: str
+    # Runtime of the runs that were started, in milliseconds, by percentile.
+    runtime_percentiles_ms: dict[str, int] = {}
+    runs: list[HistoryEntry] = []
+
+
+class TopicHistory(BaseModel):
+    name: str
+    handlers: list[HandlerHistory] = []
+
+
+def _percentile(ordered: list[int], percentile: int) -> int:
+    # Nearest-rank percentile of an already sorted list.
+    rank = max(1, -(-percentile * len(ordered) // 100))
+    return ordered[rank - 1]
+
+
+class History:
+    """
+    The most recent handler results of each topic, in fixed-size ring buffers.
+    """
+
+    def __init__(self, settings: HistorySettings | None = None):
+        self.settings = settings or HistorySettings()
+        self._lock = threading.Lock()
+        self._runs: dict[str, dict[str, deque[HistoryEntry]]] = {}
+
+    def _append(self, topic_name: str, handler: str, entry: HistoryEntry) -> None:
+        handlers = self._runs.setdefault(topic_name, {})
+        if handler not in handlers:
+            handlers[handler] = deque(maxlen=self.settings.size)
+        handlers[handler].append(entry)
+
+    def record(self, results: TopicHandlerResults) -> None:
+        now = time.time()
+        lines = []
+        with self._lock:
+            for result in results.handlers:
+                entry = HistoryEntry(
+                    time=now,
+                    outcome=handler_outcome(result.status),
+                    exit_status=result.status.exit_status,
+                    runtime_ms=result.status.runtime_ms,
+                )
+                self._append(results.name, result.name, entry)
+                lines.append(
+                    json.dumps(
+                        [
+                            entry.time,
+                            results.name,
+                            result.name,
+                            entry.outcome,
+                            entry.exit_status,
+                            entry.runtime_ms,
+                        ],
+                        separators=(",", ":"),
+                    )
+                )
+            if self.settings.persist and lines:
+                self._write_log(lines)
+
+    def _write_log(self, lines: list[str]) -> None:
+        path = self.settings.log_file
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            if (
+                os.path.exists(path)
+                and os.path.getsize(path) >= self.settings.max_log_bytes
+            ):
+                os.replace(path, f"{path}.1")
+            # One write per record keeps lines from several workers whole.
+            with open(path, "a") as f:
+                f.write("".join(line + "\n" for line in lines))
+        except OSError as e:
+            logging.error("Failed to write history log '%s': %s", path, str(e))
+
+    def load(self) -> None:
+        """
+        Replay the rotated and current logs into memory, oldest first.
+        """
+        path = self.settings.log_file
+        for log_path in (f"{path}.1", path):
+            try:
+                with open(log_path, "r") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                for line in lines:
+                    try:
+                        when, topic_name, handler, outcome, exit_status, runtime_ms = (
+                            json.loads(line)
+                        )
+                        if not isinstance(topic_name, str) or not isinstance(
+                            handler, str
+                        ):
+                            raise TypeError("topic and handler must be strings")
+                        entry = HistoryEntry(
+                            time=when,
+                            outcome=outcome,
+                            exit_status=exit_status,
+                            runtime_ms=runtime_ms,
+                        )
+                    except (TypeError, ValueError):
+                        # The tail of a line cut short by a crash, or a line
+                        # that is not a record.
+                        continue
+                    self._append(topic_name, handler, entry)
+
+    def topic_history(self, topic_name: str, limit: int | None = None) -> TopicHistory:
+        with self._lock:
+            handlers = {
+                handler: list(runs)
+                for handler, runs in self._runs.get(topic_name, {}).items()
+            }
+        history = TopicHistory(name=topic_name)
+        for handler, runs in sorted(handlers.items()):
+            runtimes = sorted(
+                entry.runtime_ms for entry in runs if entry.outcome != "skipped"
+            )
+            percentiles = {}
+            if runtimes:
+                percentiles = {
+                    f"p{percentile}": _percentile(runtimes, percentile)
+                    for percentile in PERCENTILES
+                }
+            if limit is not None:
+                runs = runs[-limit:] if limit > 0 else []
+            history.handlers.append(
+                HandlerHistory(
+                    name=handler, runtime_percentiles_ms=percentiles, runs=runs
+                )
+            )
+        return history
+
+    def __contains__(self, topic_name: str) -> bool:
+        with self._lock:
+            return topic_name in self._runs
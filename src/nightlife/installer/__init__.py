@@ -2,6 +2,7 @@ from nightlife.installer.argument_parser import ArgumentParser
 from nightlife.installer.config_installer import ConfigInstaller
 from nightlife.installer.installer import Installer
 from nightlife.installer.launchd_installer import LaunchdInstaller
+from nightlife.installer.systemd_installer import SystemdInstaller
 
 
 def install(installer: Installer, argv: list[str] | None = None) -> None:
@@ -18,3 +19,13 @@ def install_launchd(argv: list[str] | None = None) -> None:
         ]
     )
     install(installer, argv)
+
+
+def install_systemd(argv: list[str] | None = None) -> None:
+    installer = Installer(
+        [
+            ConfigInstaller(),
+            SystemdInstaller(),
+        ]
+    )
+    install(installer, argv)
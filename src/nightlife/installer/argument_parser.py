@@ -1,4 +1,5 @@
 import argparse
+import os
 
 from nightlife.config import config_file, state_file
 
@@ -28,6 +29,12 @@ class ArgumentParser:
         self.uninstall.add_argument("--disable", action="store_true", default=False)
         uninstall_subparsers = self.uninstall.add_subparsers(required=True)
 
+        self.sync = subparsers.add_parser("sync")
+        self.sync.add_argument("source_dir")
+        self.sync.add_argument("--enable", action="store_true", default=False)
+        self.sync.add_argument("--prune", action="store_true", default=False)
+        self.sync.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+
         self.install_server = install_subparsers.add_parser("server")
         self.install_server.add_argument("server_name", choices=SERVER_NAME_CHOICES)
 
@@ -43,7 +50,6 @@ class ArgumentParser:
         self.install_event = install_subparsers.add_parser("event")
         self.install_event.add_argument("event_name")
         self.install_event.add_argument("event_path")
-        self.install_event.add_argument("--run-under", nargs="+", required=True)
 
         self.enable_event = enable_subparsers.add_parser("event")
         self.enable_event.add_argument("event_name")
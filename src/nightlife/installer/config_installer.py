@@ -4,6 +4,7 @@ import os
 
 from nightlife.config import config_file
 from nightlife.installer.installer_interface import InstallerInterface
+from nightlife.installer.sync import sync
 from nightlife.system import copy, symlink, unlink
 
 
@@ -24,6 +25,12 @@ def _enable_handlers(topic_name: str, handler_names: list[str]) -> None:
 
 
 class ConfigInstaller(InstallerInterface):
+    def sync(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running ConfigInstaller sync hook with source %s", args.source_dir
+        )
+        sync(os.path.abspath(args.source_dir), args.enable, args.prune, args.jobs)
+
     def install_event(self, args: argparse.Namespace) -> None:
         logging.debug(
             "Running ConfigInstaller install hook for event %s with path %s",
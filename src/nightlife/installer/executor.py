@@ -0,0 +1,29 @@
+import logging
+import subprocess
+from dataclasses import dataclass
+
+PREFIX = ">>>"
+
+
+@dataclass
+class SubprocessExecutor:
+    execute: bool
+    prefix: str
+
+    def run(self, cmd: list[str]) -> None:
+        if self.execute:
+            subprocess.run(cmd, check=True)
+        else:
+            print(self.prefix, " ".join(cmd))
+
+
+def make_executor(
+    service_manager: str, should_execute: bool, reasons: list[str]
+) -> SubprocessExecutor:
+    if not should_execute:
+        message = f"Nightlife's {service_manager} installer will not execute {service_manager} commands for the following reasons:"
+        for index, reason in enumerate(reasons):
+            message += "\n{:>2}) {}".format(str(index + 1), reason)
+        message += f"\nYou can complete this installation by manually running these commands (lines will be prefixed with '{PREFIX}')"
+        logging.warning(message)
+    return SubprocessExecutor(execute=should_execute, prefix=PREFIX)
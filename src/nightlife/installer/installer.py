@@ -13,6 +13,8 @@ class Installer(InstallerInterface):
         for sub in self.subinstallers:
             parser = sub.augment_parser(parser)
 
+        parser.sync.set_defaults(action=self.sync)
+
         parser.install_server.set_defaults(action=self.install_server)
         parser.enable_server.set_defaults(action=self.enable_server)
         parser.disable_server.set_defaults(action=self.disable_server)
@@ -35,6 +37,12 @@ class Installer(InstallerInterface):
 
         return parser
 
+    def sync(self, args: argparse.Namespace) -> None:
+        logging.info("Syncing from %s...", args.source_dir)
+        for sub in self.subinstallers:
+            sub.sync(args)
+        logging.info("Synced from %s", args.source_dir)
+
     def install_server(self, args: argparse.Namespace) -> None:
         logging.info("Installing server %s...", args.server_name)
         for sub in self.subinstallers:
@@ -7,6 +7,9 @@ class InstallerInterface:
     def augment_parser(self, parser: ArgumentParser) -> ArgumentParser:
         return parser
 
+    def sync(self, args: argparse.Namespace) -> None:
+        pass
+
     def install_server(self, args: argparse.Namespace) -> None:
         pass
 
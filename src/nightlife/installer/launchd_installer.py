@@ -7,6 +7,7 @@ from dataclasses import dataclass
 
 from nightlife.config import BIN_HOME, app_file
 from nightlife.installer.argument_parser import ArgumentParser
+from nightlife.installer.executor import SubprocessExecutor, make_executor
 from nightlife.installer.installer_interface import InstallerInterface
 from nightlife.system import symlink
 
@@ -37,18 +38,6 @@ def _event_id(event_name: str) -> str:
 LAUNCHD_SERVICE_TEMPLATE = _template_path(app_file("templates"))
 
 
-@dataclass
-class SubprocessExecutor:
-    execute: bool
-    prefix: str
-
-    def run(self, cmd: list[str]) -> None:
-        if self.execute:
-            subprocess.run(cmd, check=True)
-        else:
-            print(self.prefix, " ".join(cmd))
-
-
 @dataclass
 class ServiceTemplate:
     template: str
@@ -111,7 +100,6 @@ def _is_crowdstrike_falcon_running() -> bool:
 
 
 def _make_executor(args: argparse.Namespace) -> SubprocessExecutor:
-    prefix = ">>>"
     should_execute = args.force
     reasons = []
     if not should_execute:
@@ -120,13 +108,7 @@ def _make_executor(args: argparse.Namespace) -> SubprocessExecutor:
                 "CrowdStrike Falcon is running (Falcon will terminate the installer if it tries to install any launch agents)"
             )
             should_execute = False
-    if not should_execute:
-        message = "Nightlife's launchd installer will not execute launchd commands for the following reasons:"
-        for index, reason in enumerate(reasons):
-            message += "\n{:>2}) {}".format(str(index + 1), reason)
-        message += f"\nYou can complete this installation by manually running these commands (lines will be prefixed with '{prefix}')"
-        logging.warning(message)
-    return SubprocessExecutor(execute=should_execute, prefix=prefix)
+    return make_executor("launchd", should_execute, reasons)
 
 
 class LaunchdInstaller(InstallerInterface):
@@ -135,6 +117,7 @@ class LaunchdInstaller(InstallerInterface):
         parser.root.add_argument("--force", action="store_true", default=False)
         parser.install_server.add_argument("--bin-dir", default=BIN_HOME)
         parser.install_event.add_argument("--bin-dir", default=BIN_HOME)
+        parser.install_event.add_argument("--run-under", nargs="+", required=True)
         return parser
 
     def install_server(self, args: argparse.Namespace) -> None:
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from nightlife.config import config_file
+from nightlife.system import unlink
+
+MANIFEST_FILE = "manifest.json"
+ENABLED_VERSIONS_DIR = "enabled.d"
+
+
+@dataclass
+class FileState:
+    sha256: str
+    mode: int
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def of(cls, path: str, known: "FileState | None" = None) -> "FileState":
+        st = os.stat(path)
+        mode = st.st_mode & 0o7777
+        if known and known.size == st.st_size and known.mtime_ns == st.st_mtime_ns:
+            # Unchanged since the last sync recorded it; skip re-hashing.
+            return cls(known.sha256, mode, st.st_size, st.st_mtime_ns)
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        return cls(digest, mode, st.st_size, st.st_mtime_ns)
+
+
+@dataclass
+class SyncPlan:
+    # Paths relative to the config directory, e.g. "events/theme" or
+    # "handlers/theme/1-theme-file".
+    copy: dict[str, str] = field(default_factory=dict)
+    chmod: dict[str, int] = field(default_factory=dict)
+    remove: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    # Absolute source path of every path in the tree.
+    sources: dict[str, str] = field(default_factory=dict)
+
+
+def _source_files(source_dir: str) -> dict[str, str]:
+    files = {}
+    events_dir = os.path.join(source_dir, "events")
+    if os.path.isdir(events_dir):
+        for event_name in sorted(os.listdir(events_dir)):
+            event_path = os.path.join(events_dir, event_name)
+            if os.path.isfile(event_path):
+                files[os.path.join("events", event_name)] = event_path
+    handlers_dir = os.path.join(source_dir, "handlers")
+    if os.path.isdir(handlers_dir):
+        for topic_name in sorted(os.listdir(handlers_dir)):
+            topic_dir = os.path.join(handlers_dir, topic_name)
+            if not os.path.isdir(topic_dir):
+                continue
+            for handler_name in sorted(os.listdir(topic_dir)):
+                handler_path = os.path.join(topic_dir, handler_name)
+                if os.path.isfile(handler_path):
+                    files[os.path.join("handlers", topic_name, handler_name)] = (
+                        handler_path
+                    )
+    return files
+
+
+def _installed_files() -> list[str]:
+    files = []
+    for root in ("events", "handlers"):
+        root_dir = config_file(root)
+        for dirpath, _, filenames in os.walk(root_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files.append(os.path.relpath(path, config_file()))
+    return sorted(files)
+
+
+@dataclass
+class Manifest:
+    # Installed files by path relative to the config directory.
+    files: dict[str, FileState] = field(default_factory=dict)
+    # Source files of the last sync by absolute path, so that unchanged ones
+    # are not hashed again.
+    sources: dict[str, FileState] = field(default_factory=dict)
+
+
+def read_manifest() -> Manifest:
+    try:
+        with open(config_file(MANIFEST_FILE)) as f:
+            doc = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return Manifest()
+    return Manifest(
+        files={
+            path: FileState(**state) for path, state in doc.get("files", {}).items()
+        },
+        sources={
+            path: FileState(**state) for path, state in doc.get("sources", {}).items()
+        },
+    )
+
+
+def write_manifest(manifest: Manifest) -> None:
+    doc = {
+        "files": {
+            path: state.__dict__ for path, state in sorted(manifest.files.items())
+        },
+        "sources": {
+            path: state.__dict__ for path, state in sorted(manifest.sources.items())
+        },
+    }
+    _atomic_write(config_file(MANIFEST_FILE), json.dumps(doc, indent=2).encode())
+
+
+def plan_sync(
+    source_dir: str, prune: bool, jobs: int
+) -> tuple[SyncPlan, dict[str, FileState]]:
+    manifest = read_manifest()
+    sources = {
+        path: os.path.abspath(source_path)
+        for path, source_path in _source_files(source_dir).items()
+    }
+
+    def states(path: str) -> tuple[FileState, FileState | None]:
+        source = FileState.of(sources[path], manifest.sources.get(sources[path]))
+        installed_path = config_file(path)
+        installed = None
+        if os.path.isfile(installed_path):
+            installed = FileState.of(installed_path, manifest.files.get(path))
+        return source, installed
+
+    plan = SyncPlan(sources=sources)
+    with ThreadPoolExecutor(jobs) as executor:
+        compared = dict(zip(sources, executor.map(states, sources)))
+
+    for path, (source, installed) in compared.items():
+        if installed is None or installed.sha256 != source.sha256:
+            plan.copy[path] = sources[path]
+        elif installed.mode != source.mode:
+            plan.chmod[path] = source.mode
+        else:
+            plan.unchanged.append(path)
+
+    if prune:
+        plan.remove = [path for path in _installed_files() if path not in sources]
+
+    return plan, {path: source for path, (source, _) in compared.items()}
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".sync-")
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _atomic_copy(src: str, dst: str) -> None:
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".sync-")
+    os.close(fd)
+    shutil.copy(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def apply_sync(plan: SyncPlan, jobs: int) -> None:
+    def copy(item: tuple[str, str]) -> None:
+        path, src = item
+        logging.info("Installing %s", path)
+        _atomic_copy(src, config_file(path))
+
+    with ThreadPoolExecutor(jobs) as executor:
+        list(executor.map(copy, plan.copy.items()))
+
+    for path, mode in plan.chmod.items():
+        logging.info("Changing mode of %s to %o", path, mode)
+        os.chmod(config_file(path), mode)
+
+    for path in plan.remove:
+        logging.info("Removing %s", path)
+        unlink(config_file(path))
+
+
+def _enabled_entries() -> set[str]:
+    entries = set()
+    enabled_dir = config_file("enabled")
+    for dirpath, _, filenames in os.walk(enabled_dir, followlinks=True):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            entries.add(os.path.relpath(path, enabled_dir))
+    return entries
+
+
+def _enabled_target(entry: str) -> str:
+    # enabled/handlers/<topic>/<handler> -> handlers/<topic>/<handler>
+    return config_file(entry)
+
+
+def swap_enabled(entries: set[str]) -> None:
+    """
+    Build the enabled set in a fresh versioned directory and atomically point
+    the "enabled" symlink at it, so readers never see a half-enabled topic.
+    """
+    entries = {entry for entry in entries if os.path.exists(_enabled_target(entry))}
+    digest = hashlib.sha256("\n".join(sorted(entries)).encode()).hexdigest()[:16]
+    versions_dir = config_file(ENABLED_VERSIONS_DIR)
+    version_dir = os.path.join(versions_dir, digest)
+    enabled_path = config_file("enabled")
+
+    if os.path.realpath(enabled_path) == os.path.realpath(version_dir):
+        logging.info("Enabled set is unchanged")
+        return
+
+    shutil.rmtree(version_dir, ignore_errors=True)
+    for entry in sorted(entries):
+        link = os.path.join(version_dir, entry)
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(_enabled_target(entry), link)
+    os.makedirs(version_dir, exist_ok=True)
+
+    if os.path.isdir(enabled_path) and not os.path.islink(enabled_path):
+        # A plain directory left by enable/disable before the first sync
+        # cannot be replaced atomically; move it aside once.
+        legacy_dir = os.path.join(versions_dir, f"legacy-{int(time.time())}")
+        logging.info("Moving %s to %s", enabled_path, legacy_dir)
+        os.rename(enabled_path, legacy_dir)
+
+    tmp_link = os.path.join(config_file(), f".enabled-{os.getpid()}")
+    unlink(tmp_link)
+    os.symlink(os.path.relpath(version_dir, config_file()), tmp_link)
+    os.replace(tmp_link, enabled_path)
+    logging.info("Enabled set is now %s", version_dir)
+
+    for version in os.listdir(versions_dir):
+        path = os.path.join(versions_dir, version)
+        # The moved-aside legacy directory is left for the user to delete.
+        if path != version_dir and not version.startswith("legacy-"):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def sync(source_dir: str, enable: bool, prune: bool, jobs: int) -> None:
+    plan, states = plan_sync(source_dir, prune, jobs)
+    logging.info(
+        "Sync plan: %d to copy, %d to chmod, %d to remove, %d unchanged",
+        len(plan.copy),
+        len(plan.chmod),
+        len(plan.remove),
+        len(plan.unchanged),
+    )
+    apply_sync(plan, jobs)
+
+    previous = read_manifest()
+    manifest = Manifest() if prune else previous
+    for path in plan.remove:
+        manifest.files.pop(path, None)
+    # Only this tree's sources are kept; they are just a cache of hashes.
+    manifest.sources = {}
+    for path, source in states.items():
+        installed_path = config_file(path)
+        if path in plan.copy:
+            # Just copied, so its content is the source's.
+            st = os.stat(installed_path)
+            manifest.files[path] = FileState(
+                source.sha256, st.st_mode & 0o7777, st.st_size, st.st_mtime_ns
+            )
+        else:
+            manifest.files[path] = FileState.of(
+                installed_path, previous.files.get(path)
+            )
+        manifest.sources[plan.sources[path]] = source
+    write_manifest(manifest)
+
+    if enable:
+        entries = set() if prune else _enabled_entries()
+        entries.update(states)
+        swap_enabled(entries)
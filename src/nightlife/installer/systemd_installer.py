@@ -0,0 +1,369 @@
+import argparse
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+
+from nightlife.config import BIN_HOME, CONFIG_HOME, PRINCIPAL_SOCKET, app_file
+from nightlife.installer.argument_parser import ArgumentParser
+from nightlife.installer.executor import SubprocessExecutor, make_executor
+from nightlife.installer.installer_interface import InstallerInterface
+from nightlife.system import symlink, unlink
+
+DEFAULT_SERVICE_DIR = os.path.join(CONFIG_HOME, "systemd/user")
+# The principal keeps its registry and event sources in memory, so it only
+# exits when idle if asked to.
+DEFAULT_IDLE_TIMEOUT = {"agent": 600}
+DEFAULT_LISTEN = {
+    "principal": ["127.0.0.1:8000", PRINCIPAL_SOCKET],
+    "agent": ["127.0.0.1:8001"],
+}
+# Units that start their service, in the order they are enabled.
+TRIGGER_KINDS = ["socket", "path", "timer"]
+UNIT_KINDS = ["service"] + TRIGGER_KINDS
+
+
+def _template_path(template_dir: str, kind: str) -> str:
+    return os.path.join(template_dir, f"systemd/{kind}.in")
+
+
+def _unit_path(unit_name: str, service_dir: str) -> str:
+    return os.path.join(service_dir, unit_name)
+
+
+def _server_id(server_name: str) -> str:
+    return f"nightlife-server-{server_name}"
+
+
+def _event_id(event_name: str) -> str:
+    return f"nightlife-event-{event_name}"
+
+
+def _systemd_quote(arg: str, executable: bool = False) -> str:
+    # systemd expands specifiers starting with "%" and environment variables
+    # starting with "$" in ExecStart, even inside quotes.
+    escaped = arg.replace("%", "%%").replace("$", "$$")
+    # A leading "@", "-", ":", "+" or "!" on the executable is a prefix that
+    # changes how it is run.
+    prefixed = executable and arg[:1] in tuple("@-:+!|")
+    if arg and not prefixed and not re.search(r"[\s\"'\\;]", arg):
+        return escaped
+    # Words are split on whitespace, and double-quoted words take C-style
+    # escapes.
+    escaped = (
+        escaped.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\t", "\\t")
+    )
+    return f'"{escaped}"'
+
+
+def _exec_start(args: list[str]) -> str:
+    return " ".join(
+        _systemd_quote(arg, executable=index == 0) for index, arg in enumerate(args)
+    )
+
+
+def _directives(name: str, values: list[str]) -> str:
+    return "\n".join(f"{name}={value}" for value in values)
+
+
+@dataclass
+class Unit:
+    unit_id: str
+    kind: str
+    values: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def unit_name(self) -> str:
+        return f"{self.unit_id}.{self.kind}"
+
+    def render(self, template: str) -> str:
+        rendered = template[:]
+        for key, value in self.values.items():
+            rendered = rendered.replace("{{" + key + "}}", value)
+        return rendered
+
+
+def server_units(
+    server_name: str,
+    bin_dir: str,
+    state_dir: str,
+    socket_activation: bool,
+    listen: list[str],
+    idle_timeout: int | None,
+) -> list[Unit]:
+    unit_id = _server_id(server_name)
+    program_arguments = [os.path.join(bin_dir, f"nightlife-{server_name}")]
+    if socket_activation and idle_timeout:
+        program_arguments += ["--idle-timeout", str(idle_timeout)]
+    units = [
+        Unit(
+            unit_id=unit_id,
+            kind="service",
+            values={
+                "description": f"Nightlife {server_name} server",
+                "type": "simple",
+                "exec_start": _exec_start(program_arguments),
+                # An idle exit is clean, so socket activation starts the server
+                # again on the next connection rather than systemd restarting it.
+                "restart": "on-failure",
+                "log_dir": os.path.join(state_dir, unit_id),
+            },
+        )
+    ]
+    if socket_activation:
+        units.append(
+            Unit(
+                unit_id=unit_id,
+                kind="socket",
+                values={
+                    "description": f"Nightlife {server_name} server socket",
+                    "listen_streams": _directives("ListenStream", listen),
+                    "service": f"{unit_id}.service",
+                },
+            )
+        )
+    return units
+
+
+def event_units(
+    event_name: str,
+    bin_dir: str,
+    state_dir: str,
+    run_under: list[str] | None,
+    on_path: list[str],
+    on_calendar: list[str],
+) -> list[Unit]:
+    unit_id = _event_id(event_name)
+    notify = [os.path.join(bin_dir, "nightlife-notify"), event_name]
+    service = {
+        "description": f"Nightlife {event_name} event",
+        "log_dir": os.path.join(state_dir, unit_id),
+    }
+    if run_under:
+        # A long-lived watcher that runs notify itself whenever the event occurs.
+        service.update(
+            type="simple", exec_start=_exec_start(run_under + notify), restart="always"
+        )
+    else:
+        service.update(type="oneshot", exec_start=_exec_start(notify), restart="no")
+    units = [Unit(unit_id=unit_id, kind="service", values=service)]
+    if on_path:
+        units.append(
+            Unit(
+                unit_id=unit_id,
+                kind="path",
+                values={
+                    "description": f"Nightlife {event_name} event paths",
+                    "paths_changed": _directives(
+                        "PathChanged",
+                        [
+                            os.path.abspath(os.path.expanduser(path)).replace("%", "%%")
+                            for path in on_path
+                        ],
+                    ),
+                    "service": f"{unit_id}.service",
+                },
+            )
+        )
+    if on_calendar:
+        units.append(
+            Unit(
+                unit_id=unit_id,
+                kind="timer",
+                values={
+                    "description": f"Nightlife {event_name} event timer",
+                    "on_calendars": _directives("OnCalendar", on_calendar),
+                    "service": f"{unit_id}.service",
+                },
+            )
+        )
+    return units
+
+
+def render_units(units: list[Unit], template_dir: str) -> dict[str, str]:
+    rendered = {}
+    for unit in units:
+        template_path = _template_path(template_dir, unit.kind)
+        logging.debug("Reading unit template from %s", template_path)
+        with open(template_path, "r") as f:
+            rendered[unit.unit_name] = unit.render(f.read())
+    return rendered
+
+
+def _installed_units(unit_id: str, service_dir: str) -> list[str]:
+    return [
+        f"{unit_id}.{kind}"
+        for kind in UNIT_KINDS
+        if os.path.exists(_unit_path(f"{unit_id}.{kind}", service_dir))
+    ]
+
+
+def _enabled_units(unit_id: str, service_dir: str) -> list[str]:
+    units = _installed_units(unit_id, service_dir)
+    triggers = [unit for unit in units if unit.rsplit(".", 1)[1] in TRIGGER_KINDS]
+    return triggers or units
+
+
+def _make_executor(args: argparse.Namespace) -> SubprocessExecutor:
+    should_execute = args.force
+    reasons = []
+    if not should_execute:
+        reasons.append("--force was not given")
+        if shutil.which("systemctl") is None:
+            reasons.append("systemctl was not found")
+    return make_executor("systemd", should_execute, reasons)
+
+
+class SystemdInstaller(InstallerInterface):
+    def augment_parser(self, parser: ArgumentParser) -> ArgumentParser:
+        parser.root.add_argument("--service-dir", default=DEFAULT_SERVICE_DIR)
+        parser.root.add_argument("--force", action="store_true", default=False)
+        parser.install_server.add_argument("--bin-dir", default=BIN_HOME)
+        parser.install_server.add_argument(
+            "--socket-activation", action="store_true", default=False
+        )
+        parser.install_server.add_argument("--listen", nargs="+")
+        parser.install_server.add_argument("--idle-timeout", type=int)
+        parser.install_event.add_argument("--bin-dir", default=BIN_HOME)
+        parser.install_event.add_argument("--run-under", nargs="+")
+        parser.install_event.add_argument("--on-path", nargs="+", default=[])
+        parser.install_event.add_argument("--on-calendar", nargs="+", default=[])
+        return parser
+
+    def install_server(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller install hook for server %s", args.server_name
+        )
+        executor = _make_executor(args)
+        units = server_units(
+            server_name=args.server_name,
+            bin_dir=args.bin_dir,
+            state_dir=args.state_dir,
+            socket_activation=args.socket_activation,
+            listen=args.listen or DEFAULT_LISTEN[args.server_name],
+            idle_timeout=(
+                args.idle_timeout
+                if args.idle_timeout is not None
+                else DEFAULT_IDLE_TIMEOUT.get(args.server_name)
+            ),
+        )
+        self._install_units(executor, units, args.template_dir, args.service_dir)
+
+    def enable_server(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller enable hook for server %s", args.server_name
+        )
+        executor = _make_executor(args)
+        self._enable_units(executor, _server_id(args.server_name), args.service_dir)
+
+    def disable_server(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller disable hook for server %s", args.server_name
+        )
+        executor = _make_executor(args)
+        self._disable_units(executor, _server_id(args.server_name), args.service_dir)
+
+    def uninstall_server(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller uninstall hook for server %s", args.server_name
+        )
+        executor = _make_executor(args)
+        self._uninstall_units(executor, _server_id(args.server_name), args.service_dir)
+
+    def install_event(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller install hook for event %s", args.event_name
+        )
+        if not (args.run_under or args.on_path or args.on_calendar):
+            raise ValueError(
+                "systemd events need --run-under, --on-path or --on-calendar"
+            )
+        executor = _make_executor(args)
+        units = event_units(
+            event_name=args.event_name,
+            bin_dir=args.bin_dir,
+            state_dir=args.state_dir,
+            run_under=args.run_under,
+            on_path=args.on_path,
+            on_calendar=args.on_calendar,
+        )
+        self._install_units(executor, units, args.template_dir, args.service_dir)
+
+    def enable_event(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller enable hook for event %s", args.event_name
+        )
+        executor = _make_executor(args)
+        self._enable_units(executor, _event_id(args.event_name), args.service_dir)
+
+    def disable_event(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller disable hook for event %s", args.event_name
+        )
+        executor = _make_executor(args)
+        self._disable_units(executor, _event_id(args.event_name), args.service_dir)
+
+    def uninstall_event(self, args: argparse.Namespace) -> None:
+        logging.debug(
+            "Running SystemdInstaller uninstall hook for event %s", args.event_name
+        )
+        executor = _make_executor(args)
+        self._uninstall_units(executor, _event_id(args.event_name), args.service_dir)
+
+    def _install_units(
+        self,
+        executor: SubprocessExecutor,
+        units: list[Unit],
+        template_dir: str,
+        service_dir: str,
+    ) -> None:
+        for kind in {unit.kind for unit in units}:
+            symlink(
+                _template_path(app_file("templates"), kind),
+                _template_path(template_dir, kind),
+            )
+
+        logging.debug("Rendering templates")
+        rendered = render_units(units, template_dir)
+
+        for unit in units:
+            if "log_dir" in unit.values:
+                os.makedirs(unit.values["log_dir"], exist_ok=True)
+        os.makedirs(service_dir, exist_ok=True)
+        for unit_name, content in rendered.items():
+            unit_path = _unit_path(unit_name, service_dir)
+            logging.debug("Writing rendered template to %s", unit_path)
+            with open(unit_path, "w") as f:
+                f.write(content)
+
+        logging.debug("Reloading systemd user units")
+        executor.run(["systemctl", "--user", "daemon-reload"])
+
+    def _enable_units(
+        self, executor: SubprocessExecutor, unit_id: str, service_dir: str
+    ) -> None:
+        units = _enabled_units(unit_id, service_dir)
+        logging.debug("Enabling and starting units %s", units)
+        executor.run(["systemctl", "--user", "enable", "--now"] + units)
+
+    def _disable_units(
+        self, executor: SubprocessExecutor, unit_id: str, service_dir: str
+    ) -> None:
+        units = _installed_units(unit_id, service_dir)
+        logging.debug("Disabling and stopping units %s", units)
+        executor.run(["systemctl", "--user", "disable", "--now"] + units)
+
+    def _uninstall_units(
+        self, executor: SubprocessExecutor, unit_id: str, service_dir: str
+    ) -> None:
+        for unit_name in _installed_units(unit_id, service_dir):
+            unit_path = _unit_path(unit_name, service_dir)
+            logging.debug("Deleting unit file %s", unit_path)
+            unlink(unit_path)
+
+        logging.debug("Reloading systemd user units")
+        executor.run(["systemctl", "--user", "daemon-reload"])
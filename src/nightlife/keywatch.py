@@ -0,0 +1,58 @@
+import os
+from typing import Callable
+
+from watchdog.events import (
+    FileSystemEvent,
+    FileSystemEventHandler,
+    FileSystemMovedEvent,
+)
+from watchdog.observers import Observer
+
+
+class PublicKeyFileEventHandler(FileSystemEventHandler):
+    """
+    Calls on_change whenever the key file is created, changed, removed or
+    moved into place. The observer delivers events one at a time from its own
+    thread, so on_change never runs concurrently with itself.
+    """
+
+    def __init__(self, public_key_file: str, on_change: Callable[[], None]):
+        self.public_key_file = public_key_file
+        self.on_change = on_change
+
+    def _on_src_path_event(self, event: FileSystemEvent) -> None:
+        path = os.path.abspath(self.public_key_file)
+        if event.src_path == path:
+            self.on_change()
+
+    def _on_dest_path_event(self, event: FileSystemMovedEvent) -> None:
+        path = os.path.abspath(self.public_key_file)
+        if event.dest_path == path:
+            self.on_change()
+
+    def on_created(self, event: FileSystemEvent) -> None:
+        self._on_src_path_event(event)
+
+    def on_deleted(self, event: FileSystemEvent) -> None:
+        self._on_src_path_event(event)
+
+    def on_modified(self, event: FileSystemEvent) -> None:
+        self._on_src_path_event(event)
+
+    def on_moved(self, event: FileSystemMovedEvent) -> None:
+        self._on_dest_path_event(event)
+
+
+def watch_public_key(public_key_file: str, on_change: Callable[[], None]) -> Observer:
+    """
+    Start an observer that calls on_change when the key file changes. The
+    caller stops and joins it.
+    """
+    observer = Observer()
+    observer.schedule(
+        PublicKeyFileEventHandler(public_key_file, on_change),
+        os.path.dirname(public_key_file),
+        recursive=True,
+    )
+    observer.start()
+    return observer
@@ -0,0 +1,72 @@
+import threading
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    rendered = ",".join(
+        '{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return f"{name}{{{rendered}}}"
+
+
+class Metrics:
+    """
+    In-process counters, gauges and summaries, rendered in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._gauges: dict[str, dict[Labels, float]] = {}
+        self._summaries: dict[str, dict[Labels, list[float]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            series = self._summaries.setdefault(name, {})
+            count_sum = series.setdefault(_labels(labels), [0, 0])
+            count_sum[0] += 1
+            count_sum[1] += value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{_format(name, labels)} {_number(value)}")
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in series.items():
+                    lines.append(f"{_format(name, labels)} {_number(value)}")
+            for name, series in sorted(self._summaries.items()):
+                lines.append(f"# TYPE {name} summary")
+                for labels, (count, total) in series.items():
+                    lines.append(f"{_format(name + '_count', labels)} {_number(count)}")
+                    lines.append(f"{_format(name + '_sum', labels)} {_number(total)}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
@@ -1,14 +1,51 @@
-import base64
+import asyncio
 import logging
 import os
-from collections import defaultdict
-
-from fastapi import FastAPI, HTTPException, Request, Response
-from pydantic import BaseModel
+import signal
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Literal
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from .dispatch import BroadcastTool, DispatchSettings, TriggerTool
-from .respond import RespondTool
+from .channel import AgentChannel
+from .config import config_file, state_file
+from .dispatch import (
+    AgentDispatchResult,
+    BroadcastTool,
+    CatchupResults,
+    DispatchResults,
+    DispatchSettings,
+    LOCAL_RESULT_NAME,
+    TriggerTool,
+    budget_headers,
+)
+from .event_source import EventSourceManager
+from .health import HealthMonitor, is_unreachable
+from .registry import (
+    Agent,
+    AgentRegistryInterface,
+    GetAgent,
+    GetAgents,
+    MemoryAgentRegistry,
+    PutAgent,
+    SqliteAgentRegistry,
+    make_agent,
+    make_get_agent,
+)
+from .respond import RespondTool, TopicHandlerResults
+from .scheduler import TopicBusy, TopicScheduler, TopicSuperseded
+from .supervisor import WorkerHooks
 
 logging.basicConfig(
     level=logging.DEBUG if os.getenv("DEBUG") else logging.INFO,
@@ -21,55 +58,130 @@ class PrincipalSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="NIGHTLIFE_PRINCIPAL_")
 
     app_name: str = "Nightlife Principal"
+    event_sources_file: str = config_file("sources.json")
+    # sqlite keeps registrations across restarts and shares them between
+    # workers; it is required to run more than one.
+    registry: Literal["memory", "sqlite"] = "memory"
+    registry_path: str = state_file("registry.sqlite3")
+    last_values_path: str = state_file("last-values.sqlite3")
+    # Keep the latest payload of every event, and bring agents up to date
+    # with it when they register or connect.
+    last_value_cache: bool = True
 
 
 SETTINGS = PrincipalSettings()
 
 
-class Agent(BaseModel):
-    name: str
-    host: str
-    key_path: str
-    key_password: bytes | None
-    events: set[str]
+def _make_registry(settings: PrincipalSettings) -> AgentRegistryInterface:
+    if settings.registry == "sqlite":
+        return SqliteAgentRegistry(settings.registry_path, settings.last_values_path)
+    return MemoryAgentRegistry()
+
+
+REGISTRY = _make_registry(SETTINGS)
+# Set in workers forked by the supervisor.
+SUPERVISED = False
+WORKER_ID = 0
+# Agents that dialed in over /channel receive events on that socket instead of
+# through a new HTTP request.
+CHANNELS: dict[str, AgentChannel] = {}
+# Orders local runs of each event's handlers, with the agent's scheduler
+# settings.
+SCHEDULER = TopicScheduler()
+# Deliveries still running after their dispatch returned at its deadline, and
+# catch-ups started in the background.
+STRAGGLERS: set[asyncio.Task] = set()
+
+
+async def _get_agent(agent_name: str) -> GetAgent:
+    try:
+        agent = await asyncio.to_thread(REGISTRY.get, agent_name)
+    except KeyError:
+        raise HTTPException(status_code=404)
+    return make_get_agent(agent, await HEALTH.health(agent_name))
+
+
+def _keep_running(task: asyncio.Task) -> None:
+    STRAGGLERS.add(task)
+    task.add_done_callback(STRAGGLERS.discard)
 
 
-AGENTS: dict[str, Agent] = {}
-AGENTS_BY_EVENT = defaultdict(set)
+# Deliveries parked while an agent's breaker was open are made up for by
+# catching the agent up once it recovers.
+HEALTH = HealthMonitor(
+    REGISTRY,
+    connected=lambda agent_name: agent_name in CHANNELS,
+    on_recover=lambda agent: _keep_running(
+        asyncio.create_task(_catchup_in_background(agent))
+    ),
+)
 
 
-class GetAgent(BaseModel):
-    name: str
-    host: str
-    key_path: str
-    events: set[str]
+def _start_worker(worker_id: int) -> None:
+    global SUPERVISED, WORKER_ID
+    SUPERVISED = True
+    WORKER_ID = worker_id
 
 
-class GetAgents(BaseModel):
-    agents: list[GetAgent]
+def _prepare_registry() -> None:
+    assert isinstance(REGISTRY, SqliteAgentRegistry)
+    # Create the schema before workers race to, then close the connection,
+    # which must not be carried across fork.
+    REGISTRY.names()
+    REGISTRY.close()
 
 
-class PutAgent(BaseModel):
-    host: str
-    key_path: str
-    key_password_b64: str | None
-    events: set[str]
+def worker_hooks() -> WorkerHooks:
+    if SETTINGS.registry == "memory":
+        raise SystemExit(
+            "Running several principal workers requires"
+            " NIGHTLIFE_PRINCIPAL_REGISTRY=sqlite"
+        )
+    return WorkerHooks(load=_prepare_registry, start_worker=_start_worker)
 
 
-def _get_agent(agent_name: str) -> GetAgent:
+def _log_dispatch_failure(event_name: str, future: Future) -> None:
     try:
-        agent = AGENTS[agent_name]
-    except KeyError:
-        raise HTTPException(status_code=404)
-    return GetAgent(
-        name=agent.name,
-        host=agent.host,
-        key_path=agent.key_path,
-        events=agent.events,
-    )
+        future.result()
+    except HTTPException as e:
+        logging.error("Failed to dispatch event %s: %s", event_name, e.detail)
+    except Exception:
+        logging.exception("Failed to dispatch event %s", event_name)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    loop = asyncio.get_running_loop()
+    if SUPERVISED:
+        # The registry reloads itself when another worker changes it, so a
+        # reload has nothing to do. Catching SIGHUP rather than ignoring it
+        # keeps handlers from inheriting an ignored SIGHUP.
+        loop.add_signal_handler(signal.SIGHUP, lambda: None)
+
+    def dispatch(event_name: str, body: bytes | None) -> None:
+        # Event sources run on their own threads; hand the event over to the
+        # server's loop so it goes through the same path as /dispatch.
+        future = asyncio.run_coroutine_threadsafe(_dispatch(event_name, body), loop)
+        future.add_done_callback(lambda f: _log_dispatch_failure(event_name, f))
+
+    event_sources = EventSourceManager(dispatch)
+    # Each event should be produced once, not once per worker.
+    if WORKER_ID == 0:
+        event_sources.load(SETTINGS.event_sources_file)
+    event_sources.start()
+    # Workers share breaker state through the registry, so one of them probing
+    # is enough.
+    health = asyncio.create_task(HEALTH.run()) if WORKER_ID == 0 else None
 
+    yield
 
-app = FastAPI()
+    if health:
+        health.cancel()
+    event_sources.stop()
+    event_sources.join()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.middleware("http")
@@ -85,90 +197,331 @@ async def log_request(request: Request, call_next):
     return await call_next(request)
 
 
+async def _await_body(request: Request) -> bytes:
+    return await request.body()
+
+
 @app.get("/agents")
 async def get_agents() -> GetAgents:
-    return GetAgents(agents=[_get_agent(name) for name in AGENTS])
+    names = await asyncio.to_thread(REGISTRY.names)
+    return GetAgents(agents=[await _get_agent(name) for name in names])
 
 
 @app.get("/agent/{agent_name}")
 async def get_agent(agent_name: str) -> GetAgent:
-    return _get_agent(agent_name)
+    return await _get_agent(agent_name)
 
 
 @app.put("/agent/{agent_name}", status_code=204, response_class=Response)
 async def put_agent(agent_name: str, agent: PutAgent) -> None:
-    global AGENTS
-    global AGENTS_BY_EVENT
-
-    key_password: bytes | None = None
-    if agent.key_password_b64:
-        key_password = base64.b64decode(agent.key_password_b64)
-
-    AGENTS[agent_name] = Agent(
-        name=agent_name,
-        host=agent.host,
-        key_path=agent.key_path,
-        key_password=key_password,
-        events=agent.events,
-    )
-
-    for event_name in agent.events:
-        AGENTS_BY_EVENT[event_name].add(agent_name)
+    registered = make_agent(agent_name, agent)
+    await asyncio.to_thread(REGISTRY.put, registered)
+    # The agent may have moved or been fixed; find out afresh.
+    await HEALTH.reset(agent_name)
+    _keep_running(asyncio.create_task(_catchup_in_background(registered)))
 
 
 @app.delete("/agent/{agent_name}", status_code=204, response_class=Response)
 async def delete_agent(agent_name: str) -> None:
-    global AGENTS
-    global AGENTS_BY_EVENT
-
-    agent = AGENTS[agent_name]
+    try:
+        await asyncio.to_thread(REGISTRY.delete, agent_name)
+    except KeyError:
+        raise HTTPException(status_code=404)
 
-    for event_name in agent.events:
-        AGENTS_BY_EVENT[event_name].remove(agent_name)
 
-    del AGENTS[agent_name]
+def _read_channel_secret(path: str) -> bytes:
+    with open(path, "rb") as f:
+        secret = f.read().strip()
+    if not secret:
+        raise OSError(f"{path} is empty")
+    return secret
 
 
-@app.post("/dispatch/{event_name}", status_code=204, response_class=Response)
-async def post_dispatch(event_name: str) -> None:
-    """
-    Trigger the event to capture the broadcast payload. Respond to the event
-    locally, then broadcast the event to all registered agents.
-    """
-    settings = DispatchSettings()
-
+@app.websocket("/channel/{agent_name}")
+async def agent_channel(websocket: WebSocket, agent_name: str) -> None:
     try:
-        body = TriggerTool(settings=settings).trigger(event_name)
-    except:
-        logging.exception("Failed to trigger event: %s", event_name)
-        raise HTTPException(500, "trigger failed")
+        agent = await asyncio.to_thread(REGISTRY.get, agent_name)
+    except KeyError:
+        await websocket.close(code=1008, reason="unknown agent")
+        return
 
+    if agent.channel_secret_path is None:
+        await websocket.close(code=1008, reason="channel not enabled")
+        return
     try:
-        RespondTool().handle_topic(event_name, body)
-    except FileNotFoundError:
-        # This machine might not be configured to handle this event locally, but
-        # we still want to broadcast to all our registered agents.
-        pass
+        secret = _read_channel_secret(agent.channel_secret_path)
+    except OSError as e:
+        logging.error("Failed to read channel secret for %s: %s", agent_name, str(e))
+        await websocket.close(code=1011, reason="channel secret unavailable")
+        return
 
+    await websocket.accept()
+    channel = AgentChannel(websocket)
     try:
-        agent_names = AGENTS_BY_EVENT[event_name]
+        if not await channel.handshake(agent_name, secret):
+            logging.warning("Agent %s failed the channel handshake", agent_name)
+            await websocket.close(code=1008, reason="handshake failed")
+            return
+        logging.info("Agent %s connected over channel", agent_name)
+        CHANNELS[agent_name] = channel
+        _keep_running(asyncio.create_task(_catchup_in_background(agent)))
+        await channel.receive()
+    except WebSocketDisconnect:
+        logging.info("Agent %s disconnected from channel", agent_name)
+    finally:
+        if CHANNELS.get(agent_name) is channel:
+            del CHANNELS[agent_name]
+        channel.close()
+
+
+@app.post("/catchup/{agent_name}")
+async def post_catchup(agent_name: str) -> CatchupResults:
+    """
+    Deliver the latest payload of every event the agent subscribes to.
+    """
+    try:
+        agent = await asyncio.to_thread(REGISTRY.get, agent_name)
     except KeyError:
-        # There may not be any registered agents for this event.
-        return
+        raise HTTPException(status_code=404)
+    try:
+        return await _catchup(agent)
+    except Exception as e:
+        logging.exception("Failed to catch up agent %s", agent_name)
+        raise HTTPException(502, f"catch-up failed: {str(e) or type(e).__name__}")
 
-    for agent_name in agent_names:
-        try:
-            agent = AGENTS[agent_name]
-        except KeyError:
-            raise HTTPException(500, "server misconfiguration")
 
+async def _catchup(agent: Agent) -> CatchupResults:
+    if not SETTINGS.last_value_cache:
+        return CatchupResults()
+    payloads = await asyncio.to_thread(REGISTRY.last_values, sorted(agent.events))
+    if not payloads:
+        return CatchupResults()
+
+    logging.info(
+        "Catching up agent %s on events %s", agent.name, ",".join(sorted(payloads))
+    )
+    settings = DispatchSettings()
+    channel = CHANNELS.get(agent.name)
+    if channel is None:
         broadcast = BroadcastTool(
             agent_host=agent.host,
             private_key_file=agent.key_path,
             private_key_password=agent.key_password,
             settings=settings,
         )
+        return await asyncio.to_thread(broadcast.catchup, payloads)
+
+    # Frames are multiplexed on the channel, so the batch is sent as
+    # concurrent topic frames.
+    results = await asyncio.gather(
+        *(
+            asyncio.wait_for(
+                channel.deliver(event_name, payload), settings.broadcast_timeout
+            )
+            for event_name, payload in payloads.items()
+        ),
+        return_exceptions=True,
+    )
+    topics = []
+    for event_name, result in zip(payloads, results):
+        if isinstance(result, TopicHandlerResults):
+            topics.append(result)
+        else:
+            logging.error(
+                "Failed to catch up agent %s on event %s: %s",
+                agent.name,
+                event_name,
+                str(result) or type(result).__name__,
+            )
+    return CatchupResults(topics=topics)
+
+
+async def _catchup_in_background(agent: Agent) -> None:
+    try:
+        await _catchup(agent)
+    except Exception as e:
+        logging.error(
+            "Failed to catch up agent %s: %s", agent.name, str(e) or type(e).__name__
+        )
+
+
+@app.post("/dispatch/{event_name}")
+async def post_dispatch(
+    event_name: str,
+    request: Request,
+    deadline: float | None = None,
+    body: bytes = Depends(_await_body),
+) -> DispatchResults:
+    """
+    Trigger the event to capture the broadcast payload, unless the caller
+    supplied the payload in the request body. Then respond to the event locally
+    while broadcasting it to all registered agents. With a deadline (in
+    seconds), agents that have not answered by then are reported as pending.
+    """
+    # A request without a body asks for the event to be triggered, while an
+    # empty body is an empty payload.
+    supplied = (
+        "content-length" in request.headers or "transfer-encoding" in request.headers
+    )
+    return await _dispatch(event_name, body if supplied else None, deadline)
+
+
+async def _dispatch(
+    event_name: str, body: bytes | None, deadline: float | None = None
+) -> DispatchResults:
+    start = time.monotonic()
+    settings = DispatchSettings()
+    stage_ms: dict[str, int] = {}
+
+    if body is None:
         try:
-            broadcast.broadcast(event_name, body)
+            body = await asyncio.to_thread(
+                TriggerTool(settings=settings).trigger, event_name
+            )
         except:
-            raise HTTPException(500, "broadcast failed")
+            logging.exception("Failed to trigger event: %s", event_name)
+            raise HTTPException(500, "trigger failed")
+        stage_ms["trigger"] = int((time.monotonic() - start) * 1000)
+
+    if SETTINGS.last_value_cache:
+        await asyncio.to_thread(REGISTRY.put_last_value, event_name, body)
+
+    # Local handlers and deliveries to agents run side by side, so agents are
+    # not held up by the principal's own handlers.
+    fanout = time.monotonic()
+    local = asyncio.create_task(_respond_locally(event_name, body, start, stage_ms))
+
+    # There may not be any registered agents for this event.
+    agents = await asyncio.to_thread(REGISTRY.subscribers, event_name)
+    # Agents are told how long they have, so they stop work nobody will wait
+    # for. Deliveries outlive the caller's deadline, which only decides what is
+    # reported as pending, so the budget is the broadcast timeout.
+    expires = start + settings.broadcast_timeout
+    tasks = [
+        asyncio.create_task(_deliver(agent, event_name, body, settings, start, expires))
+        for agent in agents
+    ]
+    timeout = None if deadline is None else max(0, start + deadline - time.monotonic())
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+        if all(task.done() for task in tasks):
+            stage_ms["broadcast"] = int((time.monotonic() - fanout) * 1000)
+    timeout = None if deadline is None else max(0, start + deadline - time.monotonic())
+    await asyncio.wait([local], timeout=timeout)
+
+    results = []
+    for agent, task in zip(agents, tasks):
+        if task.done():
+            results.append(task.result())
+            continue
+        results.append(AgentDispatchResult(name=agent.name, status="pending"))
+        _keep_running(task)
+
+    local_result = None
+    if local.done():
+        local_result = local.result()
+    else:
+        local_result = AgentDispatchResult(name=LOCAL_RESULT_NAME, status="pending")
+        _keep_running(local)
+    return DispatchResults(
+        name=event_name, agents=results, local=local_result, stage_ms=stage_ms
+    )
+
+
+async def _respond_locally(
+    event_name: str, body: bytes, start: float, stage_ms: dict[str, int]
+) -> AgentDispatchResult | None:
+    local_start = time.monotonic()
+    try:
+        # Runs of one event's handlers are ordered by the scheduler, as on an
+        # agent, so overlapping dispatches do not race each other.
+        results = await SCHEDULER.run(
+            event_name,
+            lambda run: RespondTool().handle_topic(event_name, body, run),
+        )
+    except FileNotFoundError:
+        # This machine might not be configured to handle this event locally, but
+        # we still want to broadcast to all our registered agents.
+        return None
+    except Exception as e:
+        stage_ms["local"] = int((time.monotonic() - local_start) * 1000)
+        if isinstance(e, TopicBusy):
+            error = "topic busy"
+        elif isinstance(e, TopicSuperseded):
+            error = "superseded by a newer payload"
+        else:
+            # Reported to the caller, but it does not stop the broadcast.
+            logging.exception("Failed to respond to event %s locally", event_name)
+            error = str(e) or type(e).__name__
+        return AgentDispatchResult(
+            name=LOCAL_RESULT_NAME,
+            status="error",
+            latency_ms=int((time.monotonic() - start) * 1000),
+            error=error,
+        )
+    stage_ms["local"] = int((time.monotonic() - local_start) * 1000)
+    return AgentDispatchResult(
+        name=LOCAL_RESULT_NAME,
+        status="ok",
+        latency_ms=int((time.monotonic() - start) * 1000),
+        results=results,
+    )
+
+
+async def _deliver(
+    agent: Agent,
+    event_name: str,
+    body: bytes,
+    settings: DispatchSettings,
+    start: float,
+    expires: float,
+) -> AgentDispatchResult:
+    channel = CHANNELS.get(agent.name)
+    if channel is None and await HEALTH.is_open(agent.name):
+        # Skip the connection attempt. With the last-value cache the agent
+        # gets this payload (or a newer one) when it is caught up on recovery.
+        logging.info(
+            "Not broadcasting event %s to %s: breaker open", event_name, agent.name
+        )
+        if SETTINGS.last_value_cache:
+            return AgentDispatchResult(name=agent.name, status="parked")
+        return AgentDispatchResult(
+            name=agent.name, status="error", error="agent unreachable"
+        )
+
+    try:
+        if channel:
+            results = await asyncio.wait_for(
+                channel.deliver(event_name, body, expires), settings.broadcast_timeout
+            )
+        else:
+            broadcast = BroadcastTool(
+                agent_host=agent.host,
+                private_key_file=agent.key_path,
+                private_key_password=agent.key_password,
+                settings=settings,
+                headers=budget_headers(expires),
+            )
+            results = await asyncio.to_thread(
+                broadcast.broadcast_results, event_name, body
+            )
+    except Exception as e:
+        logging.exception("Failed to broadcast event %s to %s", event_name, agent.name)
+        # An error answered by the agent, or a slow answer, says nothing about
+        # whether it is up.
+        if is_unreachable(e):
+            await HEALTH.record_failure(agent, str(e) or type(e).__name__)
+        return AgentDispatchResult(
+            name=agent.name,
+            status="error",
+            latency_ms=int((time.monotonic() - start) * 1000),
+            error=str(e) or type(e).__name__,
+        )
+    latency_ms = int((time.monotonic() - start) * 1000)
+    logging.info(
+        "Broadcast event %s to %s in %d ms", event_name, agent.name, latency_ms
+    )
+    await HEALTH.record_success(agent, None)
+    return AgentDispatchResult(
+        name=agent.name, status="ok", latency_ms=latency_ms, results=results
+    )
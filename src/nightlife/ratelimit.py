@@ -0,0 +1,167 @@
+import math
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from .metrics import METRICS
+
+# Idle buckets are forgotten once there are more than this many of a kind.
+MAX_BUCKETS = 1024
+
+
+class RateLimitSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="NIGHTLIFE_RATE_LIMIT_")
+
+    # Sustained deliveries per second and burst size for each token issuer and
+    # each topic. A rate of 0 disables that limit.
+    issuer_rate: float = 0
+    issuer_burst: int = 20
+    topic_rate: float = 0
+    topic_burst: int = 10
+    topic_rates: dict[str, float] = {}
+    # Deliveries being handled at once, across all topics. 0 disables it.
+    max_in_flight: int = 64
+
+
+class LoadShed(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason} limit exceeded")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self) -> dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    burst: int
+    tokens: float = field(init=False)
+    updated: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self) -> None:
+        self.tokens = self.burst
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def wait(self, now: float) -> float:
+        """
+        Seconds until a token is available, or 0 if one is now.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    Admission control for deliveries, checked before their payload is read.
+    Meant to be used from the event loop only.
+    """
+
+    def __init__(self, settings: RateLimitSettings | None = None):
+        self.settings = settings or RateLimitSettings()
+        self.in_flight = 0
+        self._issuers: dict[str, TokenBucket] = {}
+        self._topics: dict[str, TokenBucket] = {}
+
+    def _bucket(
+        self,
+        buckets: dict[str, TokenBucket],
+        key: str,
+        rate: float,
+        burst: int,
+        now: float,
+    ) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_BUCKETS:
+                for idle in [k for k, b in buckets.items() if b.full(now)]:
+                    del buckets[idle]
+            bucket = buckets[key] = TokenBucket(rate, burst, updated=now)
+        return bucket
+
+    def _buckets(
+        self, issuer: str, topic_name: str | None
+    ) -> list[tuple[str, TokenBucket]]:
+        now = time.monotonic()
+        buckets = []
+        if self.settings.issuer_rate > 0:
+            buckets.append(
+                (
+                    "issuer",
+                    self._bucket(
+                        self._issuers,
+                        issuer,
+                        self.settings.issuer_rate,
+                        self.settings.issuer_burst,
+                        now,
+                    ),
+                )
+            )
+        topic_rate = self.settings.topic_rates.get(
+            topic_name or "", self.settings.topic_rate
+        )
+        if topic_name is not None and topic_rate > 0:
+            buckets.append(
+                (
+                    "topic",
+                    self._bucket(
+                        self._topics,
+                        topic_name,
+                        topic_rate,
+                        self.settings.topic_burst,
+                        now,
+                    ),
+                )
+            )
+        return buckets
+
+    def admit(self, issuer: str, topic_name: str | None = None) -> None:
+        """
+        Count a delivery as in flight, or raise LoadShed if a limit does not
+        allow it. Every admitted delivery must be released.
+        """
+        try:
+            if 0 < self.settings.max_in_flight <= self.in_flight:
+                raise LoadShed("in_flight", 1)
+            buckets = self._buckets(issuer, topic_name)
+            # Check every bucket before taking from any, so that a rejected
+            # delivery does not use up the others' tokens.
+            now = time.monotonic()
+            for reason, bucket in buckets:
+                wait = bucket.wait(now)
+                if wait > 0:
+                    raise LoadShed(reason, wait)
+        except LoadShed as e:
+            METRICS.inc("nightlife_shed_requests_total", reason=e.reason)
+            raise
+        for _, bucket in buckets:
+            bucket.take()
+        self.in_flight += 1
+        METRICS.set("nightlife_in_flight_requests", self.in_flight)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        METRICS.set("nightlife_in_flight_requests", self.in_flight)
+
+    @contextmanager
+    def admitted(self, issuer: str, topic_name: str | None = None):
+        self.admit(issuer, topic_name)
+        try:
+            yield
+        finally:
+            self.release()
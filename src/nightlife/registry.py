@@ -0,0 +1,432 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Callable, Literal
+
+from pydantic import BaseModel
+
+
+class Agent(BaseModel):
+    name: str
+    host: str
+    key_path: str
+    key_password: bytes | None
+    events: set[str]
+    # File holding the secret the agent proves itself with to open a channel;
+    # agents without one cannot open a channel.
+    channel_secret_path: str | None = None
+
+
+class AgentHealth(BaseModel):
+    # open: the agent failed too many probes or deliveries in a row, and
+    # deliveries to it are not attempted until a probe succeeds.
+    breaker: Literal["closed", "open"] = "closed"
+    consecutive_failures: int = 0
+    latency_ms: int | None = None
+    # Unix time of the last probe or delivery.
+    last_checked: float | None = None
+    error: str | None = None
+
+
+class GetAgent(BaseModel):
+    name: str
+    host: str
+    key_path: str
+    events: set[str]
+    health: AgentHealth | None = None
+
+
+class GetAgents(BaseModel):
+    agents: list[GetAgent]
+
+
+class PutAgent(BaseModel):
+    host: str
+    key_path: str
+    key_password_b64: str | None
+    events: set[str]
+    channel_secret_path: str | None = None
+
+
+def make_agent(agent_name: str, agent: PutAgent) -> Agent:
+    key_password: bytes | None = None
+    if agent.key_password_b64:
+        key_password = base64.b64decode(agent.key_password_b64)
+
+    return Agent(
+        name=agent_name,
+        host=agent.host,
+        key_path=agent.key_path,
+        key_password=key_password,
+        events=agent.events,
+        channel_secret_path=agent.channel_secret_path,
+    )
+
+
+def make_get_agent(agent: Agent, health: AgentHealth | None = None) -> GetAgent:
+    return GetAgent(
+        name=agent.name,
+        host=agent.host,
+        key_path=agent.key_path,
+        events=agent.events,
+        health=health,
+    )
+
+
+class AgentRegistryInterface(ABC):
+    @abstractmethod
+    def names(self) -> list[str]: ...
+
+    @abstractmethod
+    def get(self, agent_name: str) -> Agent: ...
+
+    @abstractmethod
+    def put(self, agent: Agent) -> None: ...
+
+    @abstractmethod
+    def delete(self, agent_name: str) -> Agent: ...
+
+    @abstractmethod
+    def subscribers(self, event_name: str) -> list[Agent]: ...
+
+    @abstractmethod
+    def version(self) -> int:
+        """
+        A number that changes whenever the registry does, including through
+        changes made by other processes sharing the backend.
+        """
+
+    @abstractmethod
+    def health(self, agent_name: str) -> AgentHealth | None: ...
+
+    @abstractmethod
+    def update_health(
+        self,
+        agent_name: str,
+        update: Callable[[AgentHealth | None], AgentHealth | None],
+    ) -> None:
+        """
+        Replace the agent's health with what update returns for the current
+        one, atomically with respect to other processes sharing the backend.
+        None forgets the agent's health.
+        """
+
+    @abstractmethod
+    def put_last_value(self, event_name: str, payload: bytes) -> None: ...
+
+    @abstractmethod
+    def last_values(self, event_names: list[str]) -> dict[str, bytes]:
+        """
+        The latest payload dispatched for each of the events that has one.
+        """
+
+
+class MemoryAgentRegistry(AgentRegistryInterface):
+    def __init__(self):
+        self.agents: dict[str, Agent] = {}
+        self.agents_by_event: defaultdict[str, set[str]] = defaultdict(set)
+        self._version = 0
+        self._health: dict[str, AgentHealth] = {}
+        self._last_values: dict[str, bytes] = {}
+
+    def names(self) -> list[str]:
+        return list(self.agents)
+
+    def get(self, agent_name: str) -> Agent:
+        return self.agents[agent_name]
+
+    def put(self, agent: Agent) -> None:
+        if agent.name in self.agents:
+            # Re-registering replaces the agent's subscriptions outright.
+            self.delete(agent.name)
+
+        self.agents[agent.name] = agent
+        for event_name in agent.events:
+            self.agents_by_event[event_name].add(agent.name)
+        self._version += 1
+
+    def delete(self, agent_name: str) -> Agent:
+        agent = self.agents.pop(agent_name)
+        for event_name in agent.events:
+            self.agents_by_event[event_name].discard(agent_name)
+        self._health.pop(agent_name, None)
+        self._version += 1
+        return agent
+
+    def subscribers(self, event_name: str) -> list[Agent]:
+        return [
+            self.agents[agent_name]
+            for agent_name in sorted(self.agents_by_event.get(event_name, ()))
+        ]
+
+    def version(self) -> int:
+        return self._version
+
+    def health(self, agent_name: str) -> AgentHealth | None:
+        return self._health.get(agent_name)
+
+    def update_health(
+        self,
+        agent_name: str,
+        update: Callable[[AgentHealth | None], AgentHealth | None],
+    ) -> None:
+        health = update(self.health(agent_name))
+        if health is None:
+            self._health.pop(agent_name, None)
+        else:
+            self._health[agent_name] = health
+
+    def put_last_value(self, event_name: str, payload: bytes) -> None:
+        self._last_values[event_name] = payload
+
+    def last_values(self, event_names: list[str]) -> dict[str, bytes]:
+        return {
+            event_name: self._last_values[event_name]
+            for event_name in event_names
+            if event_name in self._last_values
+        }
+
+
+class SqliteAgentRegistry(AgentRegistryInterface):
+    """
+    Registry stored in a SQLite database in WAL mode, so that several server
+    processes can share it. Reads are served from an in-memory copy that is
+    reloaded whenever another connection has committed a change, which SQLite
+    reports cheaply through PRAGMA data_version.
+    """
+
+    def __init__(self, path: str, last_values_path: str | None = None):
+        self.path = path
+        # Last values are written on every dispatch. They live in their own
+        # database so those writes do not change the agents database's
+        # data_version, which would make every worker reload its agents.
+        self.last_values_path = last_values_path or f"{path}.last-values"
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._pid = 0
+        self._data_version = -1
+        self._cache = MemoryAgentRegistry()
+        self._version = 0
+        self._last_values_lock = threading.Lock()
+        self._last_values_conn: sqlite3.Connection | None = None
+        self._last_values_pid = 0
+
+    @staticmethod
+    def _open(path: str) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Agents' key passwords and event payloads are stored here, and SQLite
+        # creates the -wal and -shm files next to it with the process umask.
+        umask = os.umask(0o077)
+        try:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not be used across fork, so a forked worker opens
+        # its own.
+        if self._conn is None or self._pid != os.getpid():
+            conn = self._open(self.path)
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS agents (
+                        name TEXT PRIMARY KEY,
+                        host TEXT NOT NULL,
+                        key_path TEXT NOT NULL,
+                        key_password BLOB,
+                        events TEXT NOT NULL,
+                        channel_secret_path TEXT
+                    )
+                    """)
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(agents)")]
+                if "channel_secret_path" not in columns:
+                    conn.execute(
+                        "ALTER TABLE agents ADD COLUMN channel_secret_path TEXT"
+                    )
+                # Health is written when a probe round or a delivery changes
+                # it, rarely enough to share the agents' data_version.
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS health (
+                        name TEXT PRIMARY KEY,
+                        health TEXT NOT NULL
+                    )
+                    """)
+            self._conn = conn
+            self._pid = os.getpid()
+            self._data_version = -1
+        return self._conn
+
+    def _connect_last_values(self) -> sqlite3.Connection:
+        if self._last_values_conn is None or self._last_values_pid != os.getpid():
+            conn = self._open(self.last_values_path)
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS last_values (
+                        event TEXT PRIMARY KEY,
+                        payload BLOB NOT NULL
+                    )
+                    """)
+            self._last_values_conn = conn
+            self._last_values_pid = os.getpid()
+        return self._last_values_conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        with self._last_values_lock:
+            if self._last_values_conn is not None:
+                self._last_values_conn.close()
+                self._last_values_conn = None
+
+    def _refresh(self) -> MemoryAgentRegistry:
+        conn = self._connect()
+        (data_version,) = conn.execute("PRAGMA data_version").fetchone()
+        if data_version != self._data_version:
+            self._reload(conn, data_version)
+        return self._cache
+
+    def _reload(self, conn: sqlite3.Connection, data_version: int) -> None:
+        cache = MemoryAgentRegistry()
+        rows = conn.execute(
+            "SELECT name, host, key_path, key_password, events, channel_secret_path"
+            " FROM agents"
+        )
+        for name, host, key_path, key_password, events, channel_secret_path in rows:
+            cache.put(
+                Agent(
+                    name=name,
+                    host=host,
+                    key_path=key_path,
+                    key_password=key_password,
+                    events=set(json.loads(events)),
+                    channel_secret_path=channel_secret_path,
+                )
+            )
+        for name, health in conn.execute("SELECT name, health FROM health"):
+            if name in cache.agents:
+                cache._health[name] = AgentHealth.model_validate_json(health)
+        self._cache = cache
+        self._data_version = data_version
+        self._version += 1
+
+    def _write(self, sql: str, params: tuple, *more: tuple[str, tuple]) -> int:
+        """
+        Run the statements in one transaction and return how many rows the
+        first one changed.
+        """
+        conn = self._connect()
+        with conn:
+            rowcount = conn.execute(sql, params).rowcount
+            for more_sql, more_params in more:
+                conn.execute(more_sql, more_params)
+        # data_version only changes for other connections' commits.
+        (data_version,) = conn.execute("PRAGMA data_version").fetchone()
+        self._reload(conn, data_version)
+        return rowcount
+
+    def names(self) -> list[str]:
+        with self._lock:
+            return self._refresh().names()
+
+    def get(self, agent_name: str) -> Agent:
+        with self._lock:
+            return self._refresh().get(agent_name)
+
+    def put(self, agent: Agent) -> None:
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO agents VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    agent.name,
+                    agent.host,
+                    agent.key_path,
+                    agent.key_password,
+                    json.dumps(sorted(agent.events)),
+                    agent.channel_secret_path,
+                ),
+            )
+
+    def delete(self, agent_name: str) -> Agent:
+        with self._lock:
+            agent = self._refresh().get(agent_name)
+            if not self._write(
+                "DELETE FROM agents WHERE name = ?",
+                (agent_name,),
+                ("DELETE FROM health WHERE name = ?", (agent_name,)),
+            ):
+                raise KeyError(agent_name)
+            return agent
+
+    def subscribers(self, event_name: str) -> list[Agent]:
+        with self._lock:
+            return self._refresh().subscribers(event_name)
+
+    def version(self) -> int:
+        with self._lock:
+            self._refresh()
+            return self._version
+
+    def health(self, agent_name: str) -> AgentHealth | None:
+        with self._lock:
+            return self._refresh().health(agent_name)
+
+    def update_health(
+        self,
+        agent_name: str,
+        update: Callable[[AgentHealth | None], AgentHealth | None],
+    ) -> None:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # Take the write lock before reading, so that concurrent
+                # updates from other workers are not lost.
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT health FROM health WHERE name = ?", (agent_name,)
+                ).fetchone()
+                current = (
+                    None if row is None else AgentHealth.model_validate_json(row[0])
+                )
+                health = update(current)
+                if health == current:
+                    return
+                if health is None:
+                    conn.execute("DELETE FROM health WHERE name = ?", (agent_name,))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO health VALUES (?, ?)",
+                        (agent_name, health.model_dump_json()),
+                    )
+            (data_version,) = conn.execute("PRAGMA data_version").fetchone()
+            self._reload(conn, data_version)
+
+    def put_last_value(self, event_name: str, payload: bytes) -> None:
+        with self._last_values_lock:
+            conn = self._connect_last_values()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO last_values VALUES (?, ?)",
+                    (event_name, payload),
+                )
+
+    def last_values(self, event_names: list[str]) -> dict[str, bytes]:
+        with self._last_values_lock:
+            conn = self._connect_last_values()
+            rows = conn.execute(
+                "SELECT event, payload FROM last_values WHERE event IN ({})".format(
+                    ",".join("?" * len(event_names))
+                ),
+                event_names,
+            )
+            return {event_name: payload for event_name, payload in rows}
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import urllib.error
+from dataclasses import dataclass, field
+from typing import Mapping
+
+from pydantic import BaseModel
+
+from .dispatch import BroadcastTool, DispatchSettings, budget_headers
+from .registry import Agent, AgentRegistryInterface, PutAgent, make_agent
+from .spool import Spool
+
+HOPS_HEADER = "X-Nightlife-Hops"
+ROUTE_HEADER = "X-Nightlife-Route"
+
+
+class RelayAgents(BaseModel):
+    agents: dict[str, PutAgent] = {}
+
+
+def load_relay_agents(path: str, registry: AgentRegistryInterface) -> None:
+    try:
+        with open(path, "rb") as f:
+            relay_agents = RelayAgents.model_validate_json(f.read())
+    except FileNotFoundError:
+        return
+    for agent_name, agent in relay_agents.agents.items():
+        registry.put(make_agent(agent_name, agent))
+
+
+@dataclass
+class Route:
+    """
+    The relays a delivery has already passed through, in order.
+    """
+
+    hops: int = 0
+    relays: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str]) -> "Route":
+        """
+        Raises ValueError if the hop count is not a non-negative integer.
+        """
+        route = headers.get(ROUTE_HEADER, "")
+        hops = int(headers.get(HOPS_HEADER, "0") or 0)
+        if hops < 0:
+            raise ValueError(f"negative hop count {hops}")
+        return cls(hops=hops, relays=[relay for relay in route.split(",") if relay])
+
+    def next(self, relay_id: str) -> "Route":
+        return Route(hops=self.hops + 1, relays=self.relays + [relay_id])
+
+    def headers(self) -> dict[str, str]:
+        return {HOPS_HEADER: str(self.hops), ROUTE_HEADER: ",".join(self.relays)}
+
+
+@dataclass
+class RelayTool:
+    registry: AgentRegistryInterface
+    relay_id: str
+    max_hops: int
+    settings: DispatchSettings = field(default_factory=DispatchSettings)
+
+    def is_loop(self, route: Route) -> bool:
+        return self.relay_id in route.relays
+
+    async def forward(
+        self,
+        topic_name: str,
+        body: bytes | Spool,
+        route: Route,
+        deadline: float | None = None,
+    ) -> bool:
+        """
+        Forward the topic to its downstream subscribers, and return whether
+        there were any.
+        """
+        if route.hops >= self.max_hops:
+            logging.warning(
+                "Not relaying topic %s: hop limit %d reached via %s",
+                topic_name,
+                self.max_hops,
+                ",".join(route.relays),
+            )
+            return False
+
+        next_route = route.next(self.relay_id)
+        subscribers = self.registry.subscribers(topic_name)
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(
+                    self._forward, agent, topic_name, body, next_route, deadline
+                )
+                for agent in subscribers
+            )
+        )
+        return bool(subscribers)
+
+    def _forward(
+        self,
+        agent: Agent,
+        topic_name: str,
+        body: bytes | Spool,
+        route: Route,
+        deadline: float | None,
+    ) -> None:
+        # Downstream agents get what is left of the budget this one was given.
+        headers = route.headers() | budget_headers(deadline)
+        broadcast = BroadcastTool(
+            agent_host=agent.host,
+            private_key_file=agent.key_path,
+            private_key_password=agent.key_password,
+            settings=self.settings,
+            headers=headers,
+        )
+        logging.info("Relaying topic %s to %s", topic_name, agent.name)
+        try:
+            if isinstance(body, Spool):
+                # Stream the spooled payload instead of loading it into memory.
+                headers["Content-Length"] = str(body.size)
+                with body.open() as f:
+                    broadcast.broadcast(topic_name, f)
+            else:
+                broadcast.broadcast(topic_name, body)
+        except urllib.error.HTTPError as e:
+            if e.code != 508:
+                logging.exception(
+                    "Failed to relay topic %s to %s", topic_name, agent.name
+                )
+            else:
+                logging.warning(
+                    "Not relaying topic %s to %s: it is already on the route",
+                    topic_name,
+                    agent.name,
+                )
+        except Exception:
+            logging.exception("Failed to relay topic %s to %s", topic_name, agent.name)
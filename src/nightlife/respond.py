@@ -1,13 +1,36 @@
+import base64
+import contextlib
 import logging
 import os
-import subprocess
+import resource
+import sys
+import tempfile
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from typing import IO, Any
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationInfo, field_serializer, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from .config import config_file
+from .config import config_file, state_file
+from .metrics import METRICS
+from .spawner import SpawnedHandler, Spawner
+from .spool import PAYLOAD_FILE_ENV, Spool
+from .system import PROCESS_INDEX_ENV, unlink
+
+# Optional per-topic file in the topic directory that overrides RespondSettings
+# for individual handlers.
+TOPIC_MANIFEST_FILE = ".manifest.json"
+
+
+class ResourceLimits(BaseModel):
+    cpu_seconds: int | None = None
+    address_space: int | None = None
+    open_files: int | None = None
+    nice: int | None = None
 
 
 class RespondSettings(BaseSettings):
@@ -16,6 +39,82 @@ class RespondSettings(BaseSettings):
     topics_dir: str = config_file("enabled/handlers")
     handler_timeout: int = 15
     handler_output_limit: int = 1024
+    share_process_index: bool = True
+    handler_limits: ResourceLimits = ResourceLimits()
+    # Overrides of handler_limits for individual handlers, keyed by
+    # "<topic>/<handler>".
+    topic_handler_limits: dict[str, ResourceLimits] = {}
+
+
+class HandlerManifest(BaseModel):
+    timeout: float | None = None
+    output_limit: int | None = None
+    # Stages run in ascending order. Within a stage, handlers that share a group
+    # run one after another in name order, and distinct groups run in parallel.
+    stage: int = 0
+    group: str = ""
+    # Handlers that do not read the payload are started without it.
+    stdin: bool = True
+    limits: ResourceLimits | None = None
+
+
+class TopicManifest(BaseModel):
+    handlers: dict[str, HandlerManifest] = {}
+
+    def handler(self, handler_name: str) -> HandlerManifest:
+        return self.handlers.get(handler_name, DEFAULT_HANDLER_MANIFEST)
+
+
+DEFAULT_HANDLER_MANIFEST = HandlerManifest()
+
+# Handlers of every topic, loaded up front by a supervised agent so that workers
+# do not list the topics directory on every request. None means list on demand.
+TOPIC_INDEX: dict[str, list[str]] | None = None
+
+# Smoothed runtime of each "<topic>/<handler>", used to skip stages that could
+# not finish before a caller's deadline.
+RUNTIME_ESTIMATES: dict[str, float] = {}
+RUNTIME_ESTIMATES_LOCK = threading.Lock()
+RUNTIME_ESTIMATE_WEIGHT = 0.3
+
+
+def _estimate_runtime(topic_name: str, handler: str) -> float:
+    with RUNTIME_ESTIMATES_LOCK:
+        return RUNTIME_ESTIMATES.get(f"{topic_name}/{handler}", 0)
+
+
+def _update_runtime_estimate(topic_name: str, handler: str, runtime: float) -> None:
+    key = f"{topic_name}/{handler}"
+    with RUNTIME_ESTIMATES_LOCK:
+        previous = RUNTIME_ESTIMATES.get(key)
+        if previous is None:
+            RUNTIME_ESTIMATES[key] = runtime
+        else:
+            RUNTIME_ESTIMATES[key] = previous + RUNTIME_ESTIMATE_WEIGHT * (
+                runtime - previous
+            )
+
+
+# Parsed manifests keyed by path, reloaded only when the file's mtime changes.
+TOPIC_MANIFEST_CACHE: dict[str, tuple[int, TopicManifest]] = {}
+TOPIC_MANIFEST_CACHE_LOCK = threading.Lock()
+
+
+def load_topic_manifest(path: str) -> TopicManifest:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return TopicManifest()
+    with TOPIC_MANIFEST_CACHE_LOCK:
+        cached = TOPIC_MANIFEST_CACHE.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    logging.info("Loading topic manifest %s", path)
+    with open(path, "rb") as f:
+        manifest = TopicManifest.model_validate_json(f.read())
+    with TOPIC_MANIFEST_CACHE_LOCK:
+        TOPIC_MANIFEST_CACHE[path] = (mtime, manifest)
+    return manifest
 
 
 class TopicHandlers(BaseModel):
@@ -32,19 +131,45 @@ class TopicHandlerStatus(BaseModel):
     timed_out: bool
     exit_status: int | None
     runtime_ms: int
+    cancelled: bool = False
+    # Not started, because the caller's deadline would have passed first.
+    skipped: bool = False
+
+
+class TopicHandlerUsage(BaseModel):
+    user_cpu_ms: int
+    system_cpu_ms: int
+    max_rss_kb: int
+    voluntary_context_switches: int
+    involuntary_context_switches: int
+    block_input_ops: int
+    block_output_ops: int
 
 
 class TopicHandlerOutput(BaseModel):
     truncated: bool
     length: int
+    # Handlers may write any bytes, so the JSON form carries output as base64.
     output: bytes
 
+    @field_serializer("output", when_used="json")
+    def _output_to_base64(self, output: bytes) -> str:
+        return base64.b64encode(output).decode()
+
+    @field_validator("output", mode="before")
+    @classmethod
+    def _output_from_base64(cls, output: Any, info: ValidationInfo) -> Any:
+        if info.mode == "json" and isinstance(output, str):
+            return base64.b64decode(output, validate=True)
+        return output
+
 
 class TopicHandlerResult(BaseModel):
     name: str
     status: TopicHandlerStatus
     stdout: TopicHandlerOutput
     stderr: TopicHandlerOutput
+    usage: TopicHandlerUsage | None = None
 
 
 class TopicHandlerResults(BaseModel):
@@ -52,25 +177,151 @@ class TopicHandlerResults(BaseModel):
     handlers: list[TopicHandlerResult] = []
 
 
+# Results are assembled from values produced by this module, so the models are
+# built with model_construct to skip re-validating them on every request.
+
+
 def _make_topic_handler_status(
-    exit_status: int | None, runtime: float
+    exit_status: int | None,
+    runtime: float,
+    cancelled: bool = False,
+    skipped: bool = False,
 ) -> TopicHandlerStatus:
-    return TopicHandlerStatus(
-        success=(exit_status == 0),
-        timed_out=(exit_status is None),
+    return TopicHandlerStatus.model_construct(
+        success=(exit_status == 0 and not cancelled),
+        timed_out=(exit_status is None and not cancelled and not skipped),
         exit_status=exit_status,
         runtime_ms=int(runtime * 1000),
+        cancelled=cancelled,
+        skipped=skipped,
+    )
+
+
+def _make_topic_handler_usage(
+    rusage: resource.struct_rusage | None,
+) -> TopicHandlerUsage | None:
+    if rusage is None:
+        return None
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+    max_rss_kb = rusage.ru_maxrss
+    if sys.platform == "darwin":
+        max_rss_kb //= 1024
+    return TopicHandlerUsage.model_construct(
+        user_cpu_ms=int(rusage.ru_utime * 1000),
+        system_cpu_ms=int(rusage.ru_stime * 1000),
+        max_rss_kb=max_rss_kb,
+        voluntary_context_switches=rusage.ru_nvcsw,
+        involuntary_context_switches=rusage.ru_nivcsw,
+        block_input_ops=rusage.ru_inblock,
+        block_output_ops=rusage.ru_oublock,
     )
 
 
 def _make_topic_handler_output(output: bytes, max_len: int) -> TopicHandlerOutput:
-    return TopicHandlerOutput(
+    return TopicHandlerOutput.model_construct(
         truncated=len(output) > max_len,
         length=len(output),
         output=output[:max_len],
     )
 
 
+def _make_skipped_result(handler: str) -> TopicHandlerResult:
+    empty = _make_topic_handler_output(b"", 0)
+    return TopicHandlerResult.model_construct(
+        name=handler,
+        status=_make_topic_handler_status(None, 0, skipped=True),
+        stdout=empty,
+        stderr=empty,
+        usage=None,
+    )
+
+
+# Helper process that starts this process's handlers, so that their reported
+# peak memory is their own rather than inherited from the server.
+SPAWNER: Spawner | None = None
+SPAWNER_LOCK = threading.Lock()
+
+
+def handler_spawner() -> Spawner:
+    global SPAWNER
+    with SPAWNER_LOCK:
+        # A forked worker cannot share the spawner of its parent.
+        if SPAWNER is None or not SPAWNER.alive():
+            SPAWNER = Spawner()
+        return SPAWNER
+
+
+def close_handler_spawner() -> None:
+    global SPAWNER
+    with SPAWNER_LOCK:
+        if SPAWNER is not None and SPAWNER.alive():
+            SPAWNER.close()
+        SPAWNER = None
+
+
+def _limited_command(handler_path: str, limits: ResourceLimits) -> list[str]:
+    """
+    The command that runs the handler under its resource limits. The limits
+    are set by a shell that then execs the handler, so that they are in place
+    before it starts without running Python between fork and exec.
+    """
+    ulimits = [
+        ("t", limits.cpu_seconds),
+        (
+            "v",
+            None if limits.address_space is None else limits.address_space // 1024,
+        ),
+        ("n", limits.open_files),
+    ]
+    commands = [
+        f"ulimit -{flag} {value}" for flag, value in ulimits if value is not None
+    ]
+    if not commands and limits.nice is None:
+        return [handler_path]
+    if limits.nice is not None:
+        commands.append(f'exec nice -n {limits.nice} "$0"')
+    else:
+        commands.append('exec "$0"')
+    return ["/bin/sh", "-c", " && ".join(commands), handler_path]
+
+
+class TopicRun:
+    """
+    Tracks the handler processes of one topic invocation so that it can be
+    cancelled from another thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes: set[SpawnedHandler] = set()
+        self.cancelled = False
+        # Extra environment for every handler of the run.
+        self.environ: dict[str, str] = {}
+        # time.monotonic() by which the caller stops waiting for results.
+        self.deadline: float | None = None
+
+    def remaining(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                process.kill()
+
+    def attach(self, process: SpawnedHandler) -> None:
+        with self._lock:
+            if self.cancelled:
+                process.kill()
+            self._processes.add(process)
+
+    def detach(self, process: SpawnedHandler) -> None:
+        with self._lock:
+            self._processes.discard(process)
+
+
 @dataclass
 class RespondTool:
     settings: RespondSettings = field(default_factory=RespondSettings)
@@ -83,27 +334,73 @@ class RespondTool:
             topics=[self.topic_handlers(name) for name in self._list_topics()]
         )
 
-    def handle_topic(self, topic_name: str, input: bytes | None) -> TopicHandlerResults:
-        logging.info("Invoking handlers for topic %s", topic_name)
-        results = TopicHandlerResults(
-            name=topic_name,
-            handlers=[
-                self._invoke_topic_handler(topic_name, handler, input)
-                for handler in self._list_handlers(topic_name)
-            ],
+    def topic_manifest(self, topic_name: str) -> TopicManifest:
+        return load_topic_manifest(
+            os.path.join(self.settings.topics_dir, topic_name, TOPIC_MANIFEST_FILE)
         )
+
+    def handle_topic(
+        self,
+        topic_name: str,
+        input: bytes | Spool | None,
+        run: TopicRun | None = None,
+        deadline: float | None = None,
+    ) -> TopicHandlerResults:
+        logging.info("Invoking handlers for topic %s", topic_name)
+        run = run or TopicRun()
+        timer = None
+        if deadline is not None:
+            run.deadline = deadline
+            # Nobody is waiting for results after the deadline, so stop
+            # whatever is still running then.
+            timer = threading.Timer(max(0, deadline - time.monotonic()), run.cancel)
+            timer.daemon = True
+            timer.start()
+        process_index = None
+        if self.settings.share_process_index:
+            process_index = state_file("process-index", f"{uuid.uuid4()}.json")
+            run.environ[PROCESS_INDEX_ENV] = process_index
+        try:
+            handlers = self._list_handlers(topic_name)
+            manifest = self.topic_manifest(topic_name)
+            results = self._run_stages(topic_name, handlers, manifest, input, run)
+            results = TopicHandlerResults.model_construct(
+                name=topic_name,
+                handlers=[results[handler] for handler in handlers],
+            )
+        finally:
+            if timer:
+                timer.cancel()
+            if process_index:
+                unlink(process_index)
         return results
 
+    def topic_index(self) -> dict[str, list[str]]:
+        return {name: self._scan_handlers(name) for name in self._scan_topics()}
+
     def _list_handlers(self, topic_name: str) -> list[str]:
+        if TOPIC_INDEX is None:
+            return self._scan_handlers(topic_name)
+        try:
+            return TOPIC_INDEX[topic_name]
+        except KeyError:
+            raise FileNotFoundError(topic_name)
+
+    def _list_topics(self) -> list[str]:
+        if TOPIC_INDEX is None:
+            return self._scan_topics()
+        return sorted(TOPIC_INDEX)
+
+    def _scan_handlers(self, topic_name: str) -> list[str]:
         topic_dir = os.path.join(self.settings.topics_dir, topic_name)
         logging.info("Scanning for topic handlers in %s", topic_dir)
         return sorted(
             f
             for f in os.listdir(topic_dir)
-            if os.path.isfile(os.path.join(topic_dir, f))
+            if not f.startswith(".") and os.path.isfile(os.path.join(topic_dir, f))
         )
 
-    def _list_topics(self) -> list[str]:
+    def _scan_topics(self) -> list[str]:
         logging.info("Scanning for topics in %s", self.settings.topics_dir)
         return sorted(
             f
@@ -111,36 +408,203 @@ class RespondTool:
             if os.path.isdir(os.path.join(self.settings.topics_dir, f))
         )
 
+    def _run_stages(
+        self,
+        topic_name: str,
+        handlers: list[str],
+        manifest: TopicManifest,
+        input: bytes | Spool | None,
+        run: TopicRun,
+    ) -> dict[str, TopicHandlerResult]:
+        stages: dict[int, dict[str, list[str]]] = {}
+        for handler in handlers:
+            spec = manifest.handler(handler)
+            stages.setdefault(spec.stage, {}).setdefault(spec.group, []).append(handler)
+
+        def run_group(group: list[str]) -> list[tuple[str, TopicHandlerResult]]:
+            return [
+                (
+                    handler,
+                    self._invoke_topic_handler(
+                        topic_name, handler, manifest.handler(handler), input, run
+                    ),
+                )
+                for handler in group
+            ]
+
+        results: dict[str, TopicHandlerResult] = {}
+        for stage in sorted(stages):
+            groups = list(stages[stage].values())
+            remaining = run.remaining()
+            if remaining is not None:
+                estimate = max(
+                    sum(_estimate_runtime(topic_name, handler) for handler in group)
+                    for group in groups
+                )
+                if estimate >= remaining:
+                    logging.info(
+                        "Skipping stage %d of topic %s: needs %.3fs, %.3fs left",
+                        stage,
+                        topic_name,
+                        estimate,
+                        remaining,
+                    )
+                    for group in groups:
+                        results.update(
+                            (handler, _make_skipped_result(handler))
+                            for handler in group
+                        )
+                    continue
+            if len(groups) == 1:
+                results.update(run_group(groups[0]))
+                continue
+            with ThreadPoolExecutor(len(groups)) as executor:
+                for group_results in executor.map(run_group, groups):
+                    results.update(group_results)
+        return results
+
     def _invoke_topic_handler(
-        self, topic_name: str, handler: str, input: bytes | None
+        self,
+        topic_name: str,
+        handler: str,
+        spec: HandlerManifest,
+        input: bytes | Spool | None,
+        run: TopicRun,
     ) -> TopicHandlerResult:
         topic_dir = os.path.join(self.settings.topics_dir, topic_name)
         handler_path = os.path.join(topic_dir, handler)
-        start_time = time.time()
-        try:
+        remaining = run.remaining()
+        if remaining is not None and remaining <= 0:
+            logging.info("Skipping late topic handler %s/%s", topic_name, handler)
+            return _make_skipped_result(handler)
+        if run.cancelled:
+            logging.info("Skipping cancelled topic handler %s/%s", topic_name, handler)
+            status = _make_topic_handler_status(None, 0, cancelled=True)
+            stdout = b""
+            stderr = b""
+            usage = None
+        else:
             logging.info("Invoking topic handler %s/%s", topic_name, handler)
-            p = subprocess.run(
-                [handler_path],
-                timeout=self.settings.handler_timeout,
-                input=input,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+            limits = self.settings.topic_handler_limits.get(
+                f"{topic_name}/{handler}", spec.limits or self.settings.handler_limits
             )
-            duration = time.time() - start_time
-            status = _make_topic_handler_status(p.returncode, duration)
-            stdout = p.stdout
-            stderr = p.stderr
-        except subprocess.TimeoutExpired as e:
-            status = _make_topic_handler_status(None, self.settings.handler_timeout)
-            stdout = e.stdout or b""
-            stderr = e.stderr or b""
-        return TopicHandlerResult(
+            timeout = spec.timeout or self.settings.handler_timeout
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+            status, stdout, stderr, rusage = self._run_handler(
+                handler_path, input if spec.stdin else None, run, limits, timeout
+            )
+            if status.exit_status is not None and not status.cancelled:
+                _update_runtime_estimate(topic_name, handler, status.runtime_ms / 1000)
+            usage = _make_topic_handler_usage(rusage)
+            _record_metrics(topic_name, handler, status, usage)
+        output_limit = spec.output_limit or self.settings.handler_output_limit
+        return TopicHandlerResult.model_construct(
             name=handler,
             status=status,
-            stdout=_make_topic_handler_output(
-                stdout, self.settings.handler_output_limit
-            ),
-            stderr=_make_topic_handler_output(
-                stderr, self.settings.handler_output_limit
-            ),
+            stdout=_make_topic_handler_output(stdout, output_limit),
+            stderr=_make_topic_handler_output(stderr, output_limit),
+            usage=usage,
+        )
+
+    def _run_handler(
+        self,
+        handler_path: str,
+        input: bytes | Spool | None,
+        run: TopicRun,
+        limits: ResourceLimits,
+        timeout: float,
+    ) -> tuple[TopicHandlerStatus, bytes, bytes, resource.struct_rusage | None]:
+        with contextlib.ExitStack() as stack:
+            env = {**os.environ, **run.environ}
+            # Output goes to unlinked temporary files rather than pipes, so
+            # nothing has to be read while the handler runs, and descendants
+            # that keep its output open cannot hold up the run.
+            stdout = stack.enter_context(tempfile.TemporaryFile())
+            stderr = stack.enter_context(tempfile.TemporaryFile())
+            stdin: IO[bytes]
+            if isinstance(input, Spool):
+                # Each handler reads the spooled payload through its own
+                # read-only descriptor rather than a copy in a pipe.
+                stdin = stack.enter_context(input.open())
+                env[PAYLOAD_FILE_ENV] = input.path
+            elif input is not None:
+                stdin = stack.enter_context(tempfile.TemporaryFile())
+                stdin.write(input)
+                stdin.seek(0)
+            else:
+                # Without a payload the handler must not inherit the server's
+                # stdin.
+                stdin = stack.enter_context(open(os.devnull, "rb"))
+
+            start_time = time.time()
+            process = handler_spawner().spawn(
+                _limited_command(handler_path, limits),
+                env,
+                [stdin.fileno(), stdout.fileno(), stderr.fileno()],
+                timeout,
+            )
+            run.attach(process)
+            try:
+                returncode, rusage = process.wait()
+            finally:
+                run.detach(process)
+            duration = time.time() - start_time
+            stdout.seek(0)
+            stderr.seek(0)
+            output = stdout.read(), stderr.read()
+
+        if process.timed_out:
+            status = _make_topic_handler_status(None, timeout)
+        else:
+            # A handler that exited on its own before the run was cancelled
+            # keeps its real status.
+            cancelled = run.cancelled and returncode < 0
+            status = _make_topic_handler_status(returncode, duration, cancelled)
+        return status, *output, rusage
+
+
+def handler_outcome(status: TopicHandlerStatus) -> str:
+    if status.success:
+        return "success"
+    elif status.cancelled:
+        return "cancelled"
+    elif status.skipped:
+        return "skipped"
+    elif status.timed_out:
+        return "timed_out"
+    return "failure"
+
+
+def _record_metrics(
+    topic_name: str,
+    handler: str,
+    status: TopicHandlerStatus,
+    usage: TopicHandlerUsage | None,
+) -> None:
+    labels = {"topic": topic_name, "handler": handler}
+    METRICS.inc(
+        "nightlife_handler_runs_total", outcome=handler_outcome(status), **labels
+    )
+    METRICS.observe(
+        "nightlife_handler_runtime_seconds", status.runtime_ms / 1000, **labels
+    )
+    if usage:
+        METRICS.observe(
+            "nightlife_handler_cpu_seconds",
+            (usage.user_cpu_ms + usage.system_cpu_ms) / 1000,
+            **labels,
+        )
+        METRICS.set(
+            "nightlife_handler_max_rss_bytes", usage.max_rss_kb * 1024, **labels
+        )
+        METRICS.inc(
+            "nightlife_handler_context_switches_total",
+            usage.voluntary_context_switches + usage.involuntary_context_switches,
+            **labels,
+        )
+        METRICS.inc(
+            "nightlife_handler_block_io_ops_total",
+            usage.block_input_ops + usage.block_output_ops,
+            **labels,
         )
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Literal, TypeVar
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from .metrics import METRICS
+from .respond import TopicRun
+
+T = TypeVar("T")
+
+# queue: wait for a free slot.
+# reject: fail immediately if the topic has no free slot.
+# latest: cancel in-flight and waiting runs of the topic in favour of this one.
+Policy = Literal["queue", "reject", "latest"]
+# high: may use the reserved slots, and is started ahead of queued low runs.
+Priority = Literal["high", "low"]
+
+
+class SchedulerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="NIGHTLIFE_SCHEDULER_")
+
+    policy: Policy = "queue"
+    topic_policies: dict[str, Policy] = {}
+    max_concurrency: int = 8
+    topic_concurrency: int = 1
+    topic_concurrency_limits: dict[str, int] = {}
+    # Topics are high priority unless marked low, so that the reserved slots
+    # only limit topics that were explicitly marked as batch work.
+    priority: Priority = "high"
+    topic_priorities: dict[str, Priority] = {}
+    # Slots out of max_concurrency that only high priority topics may use.
+    reserved_slots: int = 2
+
+
+class TopicBusy(Exception):
+    pass
+
+
+class TopicSuperseded(Exception):
+    pass
+
+
+class _PrioritySlots:
+    """
+    A counting semaphore whose last few slots are kept for high priority
+    waiters, and which always wakes high priority waiters first.
+    """
+
+    def __init__(self, total: int, reserved: int):
+        self.total = total
+        # Low priority work must still be able to run.
+        self.reserved = max(0, min(reserved, total - 1))
+        self.in_use = 0
+        self._waiters: dict[Priority, deque[asyncio.Future]] = {
+            "high": deque(),
+            "low": deque(),
+        }
+
+    def _limit(self, priority: Priority) -> int:
+        return self.total if priority == "high" else self.total - self.reserved
+
+    def locked(self, priority: Priority) -> bool:
+        queued = self._waiters["high"] or (priority == "low" and self._waiters["low"])
+        return bool(queued) or self.in_use >= self._limit(priority)
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: Priority) -> None:
+        if not self.locked(priority):
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the waiter was cancelled.
+                self._release()
+            else:
+                self._waiters[priority].remove(future)
+            raise
+
+    def _release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        for priority in ("high", "low"):
+            waiters = self._waiters[priority]
+            while waiters and self.in_use < self._limit(priority):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self.in_use += 1
+                future.set_result(None)
+
+
+class _TopicState:
+    def __init__(self, concurrency: int):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.active: set[TopicRun] = set()
+        self.generation = 0
+        # Runs waiting for or holding a slot. The state is dropped once there
+        # are none, so topic names from callers do not accumulate.
+        self.runs = 0
+
+
+class TopicScheduler:
+    def __init__(self, settings: SchedulerSettings | None = None):
+        self.settings = settings or SchedulerSettings()
+        self._slots = _PrioritySlots(
+            self.settings.max_concurrency, self.settings.reserved_slots
+        )
+        self._topics: dict[str, _TopicState] = {}
+
+    def policy(self, topic_name: str) -> Policy:
+        return self.settings.topic_policies.get(topic_name, self.settings.policy)
+
+    def priority(self, topic_name: str) -> Priority:
+        return self.settings.topic_priorities.get(topic_name, self.settings.priority)
+
+    def _state(self, topic_name: str) -> _TopicState:
+        try:
+            return self._topics[topic_name]
+        except KeyError:
+            concurrency = self.settings.topic_concurrency_limits.get(
+                topic_name, self.settings.topic_concurrency
+            )
+            state = self._topics[topic_name] = _TopicState(concurrency)
+            return state
+
+    async def run(self, topic_name: str, target: Callable[[TopicRun], T]) -> T:
+        """
+        Run target on a worker thread once the topic's policy and the global
+        concurrency cap allow it. target receives the TopicRun that
+        cancellation is delivered through.
+        """
+        state = self._state(topic_name)
+        state.runs += 1
+        try:
+            return await self._run(topic_name, state, target)
+        finally:
+            state.runs -= 1
+            if not state.runs:
+                del self._topics[topic_name]
+
+    async def _run(
+        self, topic_name: str, state: _TopicState, target: Callable[[TopicRun], T]
+    ) -> T:
+        policy = self.policy(topic_name)
+        priority = self.priority(topic_name)
+
+        if policy == "reject" and (
+            state.slots.locked() or self._slots.locked(priority)
+        ):
+            raise TopicBusy(topic_name)
+
+        state.generation += 1
+        generation = state.generation
+        if policy == "latest":
+            for active in state.active:
+                logging.info("Cancelling superseded run of topic %s", topic_name)
+                active.cancel()
+
+        queued = time.monotonic()
+        async with state.slots:
+            async with self._slots.slot(priority):
+                METRICS.observe(
+                    "nightlife_scheduler_queue_wait_seconds",
+                    time.monotonic() - queued,
+                    topic=topic_name,
+                    priority=priority,
+                )
+                # A newer payload for a latest-wins topic arrived while this one
+                # was waiting; it would only be cancelled as soon as it started.
+                if policy == "latest" and generation != state.generation:
+                    raise TopicSuperseded(topic_name)
+
+                run = TopicRun()
+                state.active.add(run)
+                try:
+                    return await asyncio.to_thread(target, run)
+                finally:
+                    state.active.discard(run)
@@ -0,0 +1,18 @@
+import argparse
+
+from nightlife.config import AGENT_LOCKFILE, AGENT_SOCKET
+from nightlife.server import add_server_arguments, serve
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Run the nightlife agent server")
+    # Agents are usually reached remotely, so the Unix socket is opt-in.
+    add_server_arguments(
+        parser, port=8001, uds=AGENT_SOCKET, listen_uds=False, supervised=True
+    )
+    args = parser.parse_args(argv)
+    serve("nightlife.agent:app", AGENT_LOCKFILE, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import sys
+
+from nightlife.installer import install_launchd, install_systemd
+
+
+def main(argv: list[str] | None = None) -> None:
+    if sys.platform == "darwin":
+        install_launchd(argv)
+    else:
+        install_systemd(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+import json
+import sys
+
+from nightlife.client import PrincipalClient, PrincipalError
+from nightlife.config import PRINCIPAL_LOCKFILE
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Notify the principal of an event")
+    parser.add_argument("event_name")
+    parser.add_argument("--lockfile", default=PRINCIPAL_LOCKFILE)
+    parser.add_argument(
+        "--payload-stdin",
+        action="store_true",
+        default=False,
+        help="send stdin as the event payload instead of triggering the event",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="seconds to wait for agents before reporting them as pending",
+    )
+    parser.add_argument(
+        "--results",
+        action="store_true",
+        default=False,
+        help="print the per-agent results as JSON",
+    )
+    args = parser.parse_args(argv)
+
+    payload = sys.stdin.buffer.read() if args.payload_stdin else None
+    try:
+        results = PrincipalClient.from_lockfile(args.lockfile).notify(
+            args.event_name, payload, args.deadline
+        )
+    except (OSError, PrincipalError) as e:
+        sys.exit(f"nightlife-notify: {e}")
+    if args.results:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import argparse
+
+from nightlife.config import PRINCIPAL_LOCKFILE, PRINCIPAL_SOCKET
+from nightlife.server import add_server_arguments, serve
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Run the nightlife principal server")
+    add_server_arguments(
+        parser, port=8000, uds=PRINCIPAL_SOCKET, listen_uds=True, supervised=True
+    )
+    args = parser.parse_args(argv)
+    serve("nightlife.principal:app", PRINCIPAL_LOCKFILE, args)
+
+
+if __name__ == "__main__":
+    main()
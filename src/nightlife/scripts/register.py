@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+
+from nightlife.client import PrincipalClient, PrincipalError
+from nightlife.config import PRINCIPAL_LOCKFILE
+
+
+def _read_key_password() -> bytes | None:
+    # The key password is read from stdin; close stdin (0<&-) for keys
+    # without one.
+    if sys.stdin is None or sys.stdin.isatty():
+        return None
+    try:
+        password = sys.stdin.buffer.read().rstrip(b"\n")
+    except OSError:
+        return None
+    return password or None
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Register an agent with the principal")
+    parser.add_argument("agent_name")
+    parser.add_argument("host")
+    parser.add_argument("key_path")
+    parser.add_argument("events", nargs="+")
+    parser.add_argument("--lockfile", default=PRINCIPAL_LOCKFILE)
+    parser.add_argument(
+        "--channel-secret",
+        help="file holding the secret the agent opens its channel with",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        PrincipalClient.from_lockfile(args.lockfile).register(
+            args.agent_name,
+            args.host,
+            os.path.abspath(args.key_path),
+            args.events,
+            _read_key_password(),
+            args.channel_secret and os.path.abspath(args.channel_secret),
+        )
+    except (OSError, PrincipalError) as e:
+        sys.exit(f"nightlife-register: {e}")
+
+
+if __name__ == "__main__":
+    main()
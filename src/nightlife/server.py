@@ -0,0 +1,256 @@
+import argparse
+import http.client
+import importlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import uvicorn
+
+from .config import write_lockfile
+from .supervisor import Supervisor
+from .system import unlink
+
+# First descriptor passed by a socket-activating service manager (sd_listen_fds).
+LISTEN_FDS_START = 3
+
+
+def bind_tcp(host: str, port: int) -> socket.socket:
+    sock = socket.create_server((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def bind_unix(path: str) -> socket.socket:
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    # A socket left behind by a server that did not shut down cleanly would
+    # make bind fail.
+    unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    # Only the owning user may talk to the server over its socket.
+    os.chmod(path, 0o600)
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    return sock
+
+
+def inherited_sockets() -> list[socket.socket]:
+    """
+    Sockets passed in by systemd socket activation, in the order the socket
+    unit lists them.
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return []
+    count = int(os.environ.get("LISTEN_FDS", "0"))
+    # Children such as topic handlers must not think the sockets are theirs.
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(name, None)
+    return [
+        socket.socket(fileno=fd)
+        for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + count)
+    ]
+
+
+class IdleExitServer(uvicorn.Server):
+    """
+    Exits once no connection has been open for idle_timeout seconds, so that a
+    socket-activated server only runs while it is in use.
+    """
+
+    def __init__(self, config: uvicorn.Config, idle_timeout: float):
+        super().__init__(config)
+        self.idle_timeout = idle_timeout
+        self.last_active = time.monotonic()
+
+    async def on_tick(self, counter: int) -> bool:
+        if await super().on_tick(counter):
+            return True
+        if self.server_state.connections or self.server_state.tasks:
+            self.last_active = time.monotonic()
+            return False
+        return time.monotonic() - self.last_active > self.idle_timeout
+
+
+class StartupReportServer(uvicorn.Server):
+    """
+    Sends itself one request once it has started, prints how long that took
+    since the process started and the resident memory once idle, then exits.
+    """
+
+    def __init__(
+        self, config: uvicorn.Config, host: str, port: int, args: argparse.Namespace
+    ):
+        super().__init__(config)
+        self.host = host
+        self.port = port
+        self.args = args
+        # Stays 1 unless the report was made and within budget.
+        self.exit_code = 1
+
+    def run_report(self, sockets: list[socket.socket] | None = None) -> int:
+        reporter = threading.Thread(target=self._report, daemon=True)
+        reporter.start()
+        self.run(sockets=sockets)
+        return self.exit_code
+
+    def _report(self) -> None:
+        try:
+            self._measure()
+        except Exception:
+            logging.exception("Could not report startup")
+        finally:
+            self.should_exit = True
+
+    def _measure(self) -> None:
+        import psutil
+
+        process = psutil.Process()
+
+        def since_start() -> int:
+            return int((time.time() - process.create_time()) * 1000)
+
+        while not self.started:
+            if self.should_exit:
+                return
+            time.sleep(0.005)
+        ready_ms = since_start()
+
+        # Any answer will do, including a refusal to authenticate.
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            connection.request("GET", "/health")
+            connection.getresponse().read()
+        finally:
+            connection.close()
+        first_request_ms = since_start()
+        rss_kb = process.memory_info().rss // 1024
+
+        over_budget = []
+        startup_budget = self.args.startup_budget
+        if startup_budget is not None and first_request_ms > startup_budget:
+            over_budget.append("startup")
+        if self.args.rss_budget is not None and rss_kb > self.args.rss_budget * 1024:
+            over_budget.append("rss")
+        report = {
+            "ready_ms": ready_ms,
+            "first_request_ms": first_request_ms,
+            "rss_kb": rss_kb,
+            "over_budget": over_budget,
+        }
+        print(json.dumps(report), flush=True)
+        self.exit_code = 1 if over_budget else 0
+
+
+def add_server_arguments(
+    parser: argparse.ArgumentParser,
+    port: int,
+    uds: str,
+    listen_uds: bool,
+    supervised: bool = False,
+) -> None:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=port)
+    parser.add_argument(
+        "--uds",
+        nargs="?",
+        const=uds,
+        default=uds if listen_uds else None,
+        help="also listen on this Unix domain socket",
+    )
+    parser.add_argument("--no-uds", dest="uds", action="store_const", const=None)
+    parser.add_argument("--reload", action="store_true", default=False)
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="exit after this many seconds without connections",
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        default=False,
+        help="print startup time and idle memory as JSON after one request, then exit",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=int,
+        help="with --startup-report, fail if the first request took longer (ms)",
+    )
+    parser.add_argument(
+        "--rss-budget",
+        type=int,
+        help="with --startup-report, fail if idle memory is larger (MiB)",
+    )
+    if supervised:
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help=(
+                "pre-fork this many worker processes; in-memory state such as"
+                " scheduling, rate limits and history is per worker, so per-topic"
+                " ordering (queue, reject, latest), concurrency, rate and"
+                " in-flight limits hold within each worker only, and history"
+                " lists the runs of the worker that answers"
+            ),
+        )
+
+
+def serve(app: str, lockfile: str, args: argparse.Namespace) -> None:
+    workers = getattr(args, "workers", 1)
+    if args.idle_timeout and workers > 1:
+        # Workers cannot tell whether their siblings are idle.
+        raise SystemExit("--idle-timeout cannot be combined with --workers")
+
+    if args.reload:
+        # The reloader re-imports the app in a child process and can only bind
+        # one address, so only TCP is available in this mode.
+        write_lockfile(lockfile, args.host, args.port)
+        uvicorn.run(app, host=args.host, port=args.port, reload=True)
+        return
+
+    sockets = inherited_sockets()
+    # The service manager owns inherited sockets, including their files.
+    owned_uds = None
+    host: str | None
+    port: int | None
+    if sockets:
+        # Only advertise the addresses the service manager passed in.
+        host, port, uds = None, None, None
+        for sock in sockets:
+            if sock.family == socket.AF_UNIX:
+                uds = sock.getsockname()
+            else:
+                host, port = sock.getsockname()[:2]
+    else:
+        host, port, uds = args.host, args.port, args.uds
+        sockets.append(bind_tcp(host, port))
+        if uds:
+            sockets.append(bind_unix(uds))
+            owned_uds = uds
+    write_lockfile(lockfile, host, port, uds)
+
+    config = uvicorn.Config(app)
+    try:
+        if args.startup_report:
+            if host is None or port is None:
+                raise SystemExit("--startup-report needs a TCP socket")
+            server = StartupReportServer(config, host, port, args)
+            sys.exit(server.run_report(sockets))
+        elif workers > 1:
+            # The app module is imported once, here, so that every worker
+            # inherits it and the state its hooks load.
+            module = importlib.import_module(app.split(":")[0])
+            Supervisor(config, sockets, workers, module.worker_hooks()).run()
+        elif args.idle_timeout:
+            IdleExitServer(config, args.idle_timeout).run(sockets=sockets)
+        else:
+            uvicorn.Server(config).run(sockets=sockets)
+    finally:
+        if owned_uds:
+            unlink(owned_uds)
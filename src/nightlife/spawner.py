@@ -0,0 +1,255 @@
+"""
+Starts topic handlers from a small helper process.
+
+On Linux a child's peak resident memory starts out at its parent's, and exec
+does not reset it. A handler forked from the server would report the server's
+memory as its own, so handlers are forked from this helper instead, which runs
+with nothing but the standard library loaded.
+
+This module runs as a script in the helper, so it must only import the
+standard library.
+"""
+
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+
+class HandlerProcess:
+    """
+    A handler's process, reaped with os.wait4 to capture its resource usage.
+    It is only ever signalled before it is reaped, so a signal cannot reach an
+    unrelated process that has reused its pid.
+    """
+
+    def __init__(self, popen: subprocess.Popen):
+        self.popen = popen
+        self.timed_out = False
+        self._lock = threading.Lock()
+        self._exited = False
+
+    def kill(self) -> None:
+        with self._lock:
+            if not self._exited:
+                os.kill(self.popen.pid, signal.SIGKILL)
+
+    def _time_out(self) -> None:
+        with self._lock:
+            if not self._exited:
+                self.timed_out = True
+                os.kill(self.popen.pid, signal.SIGKILL)
+
+    def wait(self, timeout: float) -> tuple[int, resource.struct_rusage | None]:
+        """
+        Wait for the process to exit, killing it after timeout seconds, and
+        return its exit code and resource usage.
+        """
+        pid = self.popen.pid
+        timer = threading.Timer(timeout, self._time_out)
+        timer.daemon = True
+        timer.start()
+        try:
+            # Wait without reaping, so that the pid stays ours until no more
+            # signals can be sent to it.
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            with self._lock:
+                self._exited = True
+            _, status, rusage = os.wait4(pid, 0)
+        except ChildProcessError:
+            # Same fallback as Popen: the child was reaped elsewhere (e.g.
+            # SIGCHLD is ignored), so its status is unknown.
+            with self._lock:
+                self._exited = True
+            self.popen.returncode = 0
+            return 0, None
+        finally:
+            timer.cancel()
+        self.popen.returncode = os.waitstatus_to_exitcode(status)
+        return self.popen.returncode, rusage
+
+
+def _send(conn: socket.socket, message: dict) -> None:
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def _serve_handler(conn: socket.socket, stdio: list[int]) -> None:
+    with conn, conn.makefile("rb") as reader:
+        request = json.loads(reader.readline())
+        try:
+            popen = subprocess.Popen(
+                request["args"],
+                stdin=stdio[0],
+                stdout=stdio[1],
+                stderr=stdio[2],
+                env=request["env"],
+            )
+        except OSError as e:
+            _send(conn, {"error": [e.errno, e.strerror, e.filename]})
+            return
+        finally:
+            for fd in stdio:
+                os.close(fd)
+        process = HandlerProcess(popen)
+        _send(conn, {"pid": popen.pid})
+
+        def read_kills() -> None:
+            # Every line is a request to kill the handler. The server closing
+            # its end means nobody waits for the handler any more.
+            for _ in reader:
+                process.kill()
+            process.kill()
+
+        killer = threading.Thread(target=read_kills, daemon=True)
+        killer.start()
+        returncode, rusage = process.wait(request["timeout"])
+        try:
+            _send(
+                conn,
+                {
+                    "returncode": returncode,
+                    "timed_out": process.timed_out,
+                    "rusage": None if rusage is None else list(rusage),
+                },
+            )
+        except OSError:
+            # The server stopped waiting for the result.
+            pass
+        killer.join()
+
+
+def serve(control: socket.socket) -> None:
+    """
+    Start a handler for every connection passed in over control, until the
+    server closes it.
+    """
+    while True:
+        message, fds, _, _ = socket.recv_fds(control, 1, 4)
+        if not message:
+            return
+        conn = socket.socket(fileno=fds[0])
+        threading.Thread(
+            target=_serve_handler, args=(conn, fds[1:]), daemon=True
+        ).start()
+
+
+class SpawnedHandler:
+    """
+    The server's view of a handler started by the spawner.
+    """
+
+    def __init__(self, conn: socket.socket):
+        self._conn = conn
+        self._reader = conn.makefile("rb")
+        self._lock = threading.Lock()
+        self._done = False
+        self.timed_out = False
+
+    def kill(self) -> None:
+        with self._lock:
+            if not self._done:
+                try:
+                    self._conn.sendall(b"kill\n")
+                except OSError:
+                    pass
+
+    def _receive(self) -> dict:
+        line = self._reader.readline()
+        if not line:
+            raise ChildProcessError("handler spawner exited")
+        return json.loads(line)
+
+    def started(self) -> dict:
+        return self._receive()
+
+    def close(self) -> None:
+        with self._lock:
+            self._done = True
+        self._reader.close()
+        self._conn.close()
+
+    def wait(self) -> tuple[int, resource.struct_rusage | None]:
+        """
+        Wait for the handler to exit and return its exit code and resource
+        usage.
+        """
+        try:
+            result = self._receive()
+        finally:
+            self.close()
+        self.timed_out = result["timed_out"]
+        rusage = result["rusage"]
+        return result["returncode"], (
+            None if rusage is None else resource.struct_rusage(rusage)
+        )
+
+
+class Spawner:
+    """
+    A spawner process, owned by the process that started it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._control, remote = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, "-I", "-S", __file__, str(remote.fileno())],
+                stdin=subprocess.DEVNULL,
+                pass_fds=[remote.fileno()],
+            )
+        finally:
+            remote.close()
+        self.pid = os.getpid()
+
+    def alive(self) -> bool:
+        return self.pid == os.getpid() and self.process.poll() is None
+
+    def spawn(
+        self,
+        args: list[str],
+        env: dict[str, str],
+        stdio: list[int],
+        timeout: float,
+    ) -> SpawnedHandler:
+        """
+        Start args with stdio as its standard input, output and error, and
+        kill it after timeout seconds.
+        """
+        conn, remote = socket.socketpair()
+        try:
+            with self._lock:
+                socket.send_fds(self._control, [b"\0"], [remote.fileno(), *stdio])
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            remote.close()
+        handler = SpawnedHandler(conn)
+        try:
+            _send(conn, {"args": args, "env": env, "timeout": timeout})
+            reply = handler.started()
+        except BaseException:
+            handler.close()
+            raise
+        if "error" in reply:
+            handler.close()
+            raise OSError(*reply["error"])
+        return handler
+
+    def close(self) -> None:
+        self._control.close()
+        self.process.wait()
+
+
+if __name__ == "__main__":
+    # The server decides when to stop, by closing the control socket. Signals
+    # meant for its process group are caught rather than ignored, so that the
+    # handlers started here do not inherit an ignored disposition.
+    for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: None)
+    serve(socket.socket(fileno=int(sys.argv[1])))
@@ -0,0 +1,56 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO
+
+PAYLOAD_FILE_ENV = "NIGHTLIFE_PAYLOAD_FILE"
+
+
+class SpoolLimitExceeded(Exception):
+    pass
+
+
+@dataclass
+class Spool:
+    """
+    A payload written once to a file that each topic handler opens read-only,
+    instead of receiving its own copy through a pipe.
+    """
+
+    path: str
+    size: int = 0
+    _fd: int | None = None
+
+    @classmethod
+    def create(cls, spool_dir: str) -> "Spool":
+        os.makedirs(spool_dir, mode=0o700, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="payload-", dir=spool_dir)
+        # Writes go through the already-open descriptor, so the file can be
+        # made read-only before any handler gets to see it.
+        os.fchmod(fd, 0o400)
+        return cls(path=path, _fd=fd)
+
+    def write(self, chunk: bytes, limit: int | None = None) -> None:
+        assert self._fd is not None
+        if limit is not None and self.size + len(chunk) > limit:
+            raise SpoolLimitExceeded(f"payload exceeds {limit} bytes")
+        view = memoryview(chunk)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+        self.size += len(chunk)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def open(self) -> BinaryIO:
+        return open(self.path, "rb")
@@ -0,0 +1,146 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import uvicorn
+
+# How often the supervisor checks for exited workers and changed files.
+POLL_INTERVAL = 1.0
+RESPAWN_DELAY = 1.0
+
+
+@dataclass
+class WorkerHooks:
+    # Loads state that workers share. The supervisor calls it once before
+    # forking, so workers start with the state already in memory, and again
+    # whenever fingerprint changes.
+    load: Callable[[], None]
+    # Runs in each worker right after it is forked, with the worker's index.
+    start_worker: Callable[[int], None]
+    # Cheap summary of the files behind the shared state; a change makes the
+    # supervisor reload and send SIGHUP to every worker.
+    fingerprint: Callable[[], object] = lambda: None
+
+
+def path_fingerprint(paths: list[str]) -> tuple:
+    """
+    Sizes and mtimes of the given files and of everything below the given
+    directories.
+    """
+    stats = []
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            dirnames.sort()
+            for name in [""] + sorted(filenames):
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                stats.append((dirpath, name, st.st_size, st.st_mtime_ns))
+        if os.path.isfile(path):
+            st = os.stat(path)
+            stats.append((path, "", st.st_size, st.st_mtime_ns))
+    return tuple(stats)
+
+
+@dataclass
+class Supervisor:
+    """
+    Pre-forks uvicorn workers that share the listening sockets, keeps them
+    running, and fans reloads out to them. Connections go to whichever worker
+    accepts them, so state a worker keeps in memory only covers its share of
+    the requests.
+    """
+
+    config: uvicorn.Config
+    sockets: list[socket.socket]
+    workers: int
+    hooks: WorkerHooks
+    _pids: dict[int, int] = field(default_factory=dict)
+    _stopping: bool = False
+    _reload: bool = False
+
+    def run(self) -> None:
+        self.hooks.load()
+        fingerprint = self.hooks.fingerprint()
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        # Keep the objects created so far out of the collector, so that it does
+        # not touch (and un-share) their pages in every worker.
+        gc.freeze()
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        while self._pids:
+            self._reap()
+            if self._stopping:
+                time.sleep(POLL_INTERVAL / 10)
+                continue
+
+            current = self.hooks.fingerprint()
+            if current != fingerprint or self._reload:
+                fingerprint = current
+                self._reload = False
+                logging.info("Reloading shared state of %d workers", len(self._pids))
+                self.hooks.load()
+                self._signal(signal.SIGHUP)
+            time.sleep(POLL_INTERVAL)
+
+    def _spawn(self, worker_id: int) -> None:
+        pid = os.fork()
+        if pid:
+            logging.info("Started worker %d as process %d", worker_id, pid)
+            self._pids[pid] = worker_id
+            return
+
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            # A reload can come before the app has installed its SIGHUP
+            # handler, which must not kill the worker.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.hooks.start_worker(worker_id)
+            uvicorn.Server(self.config).run(sockets=self.sockets)
+        except BaseException:
+            logging.exception("Worker %d failed", worker_id)
+            os._exit(1)
+        os._exit(0)
+
+    def _reap(self) -> None:
+        while self._pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            worker_id = self._pids.pop(pid)
+            if self._stopping:
+                continue
+            logging.warning(
+                "Worker %d (process %d) exited with status %d; restarting it",
+                worker_id,
+                pid,
+                os.waitstatus_to_exitcode(status),
+            )
+            time.sleep(RESPAWN_DELAY)
+            self._spawn(worker_id)
+
+    def _signal(self, signum: int) -> None:
+        for pid in self._pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, frame) -> None:
+        self._stopping = True
+        self._signal(signal.SIGTERM)
+
+    def _on_reload(self, signum, frame) -> None:
+        self._reload = True
@@ -1,24 +1,172 @@
+import fnmatch
+import json
 import logging
 import os
 import shutil
 import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Iterable
 
 import psutil
 
+# Handlers of one topic run share a process index through this file, so only
+# the first of them has to scan every process.
+PROCESS_INDEX_ENV = "NIGHTLIFE_PROCESS_INDEX"
+PROCESS_INDEX_TTL = 2.0
 
-def pkill(name: str, signum: int) -> None:
-    for p in psutil.process_iter(attrs=["name", "exe", "cmdline"]):
+
+# A process as recorded in the index: its pid and creation time, which tells
+# it apart from a later process that reuses the pid.
+ProcessKey = tuple[int, float]
+
+
+@dataclass
+class IndexedProcess:
+    pid: int
+    create_time: float
+    name: str
+    # Basenames of the executable and argv[0]. Reading them costs two more
+    # /proc lookups, so they are only read once a process's name has failed
+    # to match, and are None until then.
+    aliases: list[str] | None = None
+
+    @property
+    def key(self) -> ProcessKey:
+        return self.pid, self.create_time
+
+
+@dataclass
+class ProcessIndex:
+    scanned: float
+    processes: list[IndexedProcess]
+
+
+def scan_processes() -> ProcessIndex:
+    processes = []
+    for p in psutil.process_iter(attrs=["name", "create_time"]):
         # Process.info property is conditionally set based on attrs argument to
         # psutil.process_iter. Since this property normally doesn't exist, we
         # need to assert its presence to satisfy mypy that it actually does.
         assert hasattr(p, "info")
-        if (
-            p.info["name"] == name
-            or (p.info["exe"] and os.path.basename(p.info["exe"]) == name)
-            or (p.info["cmdline"] and os.path.basename(p.info["cmdline"][0]) == name)
-        ):
-            logging.debug("Sending signal %d to %s process %d", signum, p.name(), p.pid)
+        processes.append(
+            IndexedProcess(p.pid, p.info["create_time"], p.info["name"] or "")
+        )
+    return ProcessIndex(time.time(), processes)
+
+
+def _read_aliases(process: IndexedProcess) -> list[str]:
+    aliases = set()
+    try:
+        p = psutil.Process(process.pid)
+        if p.create_time() != process.create_time:
+            return []
+        try:
+            aliases.add(os.path.basename(p.exe()))
+        except (psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+        try:
+            cmdline = p.cmdline()
+        except (psutil.AccessDenied, psutil.ZombieProcess):
+            cmdline = []
+        if cmdline:
+            aliases.add(os.path.basename(cmdline[0]))
+    except psutil.NoSuchProcess:
+        return []
+    aliases.discard("")
+    aliases.discard(process.name)
+    return sorted(aliases)
+
+
+def _read_process_index(path: str) -> ProcessIndex | None:
+    try:
+        with open(path) as f:
+            index = json.load(f)
+        if time.time() - index["scanned"] > PROCESS_INDEX_TTL:
+            return None
+        return ProcessIndex(
+            index["scanned"],
+            [IndexedProcess(*process) for process in index["processes"]],
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_process_index(path: str, index: ProcessIndex) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(
+            {
+                "scanned": index.scanned,
+                "processes": [
+                    [p.pid, p.create_time, p.name, p.aliases] for p in index.processes
+                ],
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+
+
+def _matches(name: str, patterns: list[str]) -> bool:
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def find_processes(patterns: Iterable[str]) -> set[ProcessKey]:
+    """
+    Match processes by name, executable basename or argv[0] basename. Patterns
+    may use fnmatch wildcards; all of them are resolved against a single
+    process scan. The executable and argv[0] are only read for processes whose
+    name matches no pattern.
+    """
+    patterns = list(patterns)
+    if not patterns:
+        return set()
+
+    path = os.getenv(PROCESS_INDEX_ENV)
+    index = _read_process_index(path) if path else None
+    changed = index is None
+    if index is None:
+        index = scan_processes()
+
+    keys: set[ProcessKey] = set()
+    for process in index.processes:
+        if _matches(process.name, patterns):
+            keys.add(process.key)
+            continue
+        if process.aliases is None:
+            process.aliases = _read_aliases(process)
+            changed = True
+        if any(_matches(alias, patterns) for alias in process.aliases):
+            keys.add(process.key)
+
+    # Later handlers of the run reuse the scan, along with the aliases read for
+    # it so far.
+    if path and changed:
+        _write_process_index(path, index)
+    return keys
+
+
+def signal_processes(patterns: Iterable[str], signum: int) -> set[int]:
+    signalled = set()
+    for pid, create_time in find_processes(patterns):
+        # The index can be up to PROCESS_INDEX_TTL seconds old, so make sure
+        # the pid still belongs to the process that was indexed.
+        try:
+            p = psutil.Process(pid)
+            if p.create_time() != create_time:
+                continue
+            logging.debug("Sending signal %d to process %d", signum, pid)
             p.send_signal(signum)
+        except psutil.NoSuchProcess:
+            continue
+        signalled.add(pid)
+    return signalled
+
+
+def pkill(name: str, signum: int) -> None:
+    signal_processes([name], signum)
 
 
 def unlink(path: str) -> None:
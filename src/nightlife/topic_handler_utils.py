@@ -1,10 +1,11 @@
 import os
 
 from .config import STATE_HOME, state_file
-from .system import pkill, symlink, unlink
+from .system import pkill, signal_processes, symlink, unlink
 
 __all__ = [
     "pkill",
+    "signal_processes",
     "symlink",
     "system_state_file",
     "topic_state_file",
@@ -0,0 +1,65 @@
+import importlib.util
+
+from .respond import TopicHandlerResults
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = [MSGPACK_MEDIA_TYPE, "application/x-msgpack"]
+
+
+def msgpack_available() -> bool:
+    return importlib.util.find_spec("msgpack") is not None
+
+
+def _quality(params: str) -> float:
+    for param in params.split(";"):
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+def negotiate(accept: str | None) -> str:
+    """
+    Pick the response media type for an Accept header, preferring the ranges
+    with the highest q-value. JSON is the default; MessagePack is only chosen
+    when the client asks for it and it is installed.
+    """
+    if not accept:
+        return JSON_MEDIA_TYPE
+
+    candidates = []
+    for media_range in accept.split(","):
+        media_type, _, params = media_range.strip().partition(";")
+        quality = _quality(params)
+        if quality > 0:
+            candidates.append((quality, media_type.strip().lower()))
+    # sorted is stable, so equally preferred ranges keep the client's order.
+    for _, media_type in sorted(candidates, key=lambda c: -c[0]):
+        if media_type in MSGPACK_MEDIA_TYPES and msgpack_available():
+            return MSGPACK_MEDIA_TYPE
+        if media_type in (JSON_MEDIA_TYPE, "application/*", "*/*"):
+            return JSON_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def encode_results(results: TopicHandlerResults, media_type: str) -> bytes:
+    if media_type in MSGPACK_MEDIA_TYPES:
+        import msgpack
+
+        # model_dump keeps handler output as raw bytes, which msgpack encodes
+        # as bin without any text transcoding.
+        return msgpack.packb(results.model_dump(), use_bin_type=True)
+    return results.model_dump_json().encode()
+
+
+def decode_results(data: bytes, media_type: str | None) -> TopicHandlerResults:
+    media_type = (media_type or JSON_MEDIA_TYPE).partition(";")[0].strip().lower()
+    if media_type in MSGPACK_MEDIA_TYPES:
+        import msgpack
+
+        return TopicHandlerResults.model_validate(msgpack.unpackb(data, raw=False))
+    return TopicHandlerResults.model_validate_json(data)
@@ -0,0 +1,63 @@
+import asyncio
+import base64
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from nightlife.channel import AgentChannel, ChannelError
+from nightlife.respond import TopicHandlerResults
+from nightlife.wire import JSON_MEDIA_TYPE, encode_results
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent: list[dict] = []
+        self.incoming: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def send_json(self, frame: dict) -> None:
+        self.sent.append(frame)
+
+    async def receive(self) -> dict:
+        return await self.incoming.get()
+
+    def push(self, frame: object) -> None:
+        text = frame if isinstance(frame, str) else json.dumps(frame)
+        self.incoming.put_nowait({"type": "websocket.receive", "text": text})
+
+
+def _results_frame(frame_id: int, name: str) -> dict:
+    body = encode_results(TopicHandlerResults(name=name), JSON_MEDIA_TYPE)
+    return {
+        "type": "results",
+        "id": frame_id,
+        "media_type": JSON_MEDIA_TYPE,
+        "body": base64.b64encode(body).decode(),
+    }
+
+
+def test_receive_skips_bad_frames_and_keeps_delivering():
+    async def main():
+        websocket = FakeWebSocket()
+        channel = AgentChannel(websocket)
+        receiver = asyncio.create_task(channel.receive())
+        first = asyncio.create_task(channel.deliver("theme", b"dark"))
+        second = asyncio.create_task(channel.deliver("theme", b"light"))
+        await asyncio.sleep(0)
+        assert [frame["id"] for frame in websocket.sent] == [1, 2]
+
+        for junk in ["not json", [1], {"type": "results"}, {"type": "surprise"}]:
+            websocket.push(junk)
+        websocket.push({"type": "results", "id": [1]})
+        websocket.push({"type": "results", "id": 1, "body": "%%%"})
+        websocket.push(_results_frame(2, "theme"))
+        with pytest.raises(ChannelError) as e:
+            await first
+        assert e.value.status == 502
+        assert (await second).name == "theme"
+
+        websocket.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        with pytest.raises(WebSocketDisconnect):
+            await receiver
+
+    asyncio.run(main())
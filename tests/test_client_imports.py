@@ -0,0 +1,40 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+# Modules the client entry points must not pull in at import time.
+HEAVY_MODULES = ["fastapi", "pydantic", "jwt", "cryptography", "watchdog", "psutil"]
+
+# Cumulative import time of the entry point module, in microseconds. Generous,
+# so that only an accidental heavy import trips it on a loaded machine.
+IMPORT_BUDGET_US = 150_000
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def _importtime(module: str) -> dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative
+
+
+@pytest.mark.parametrize(
+    "module", ["nightlife.scripts.notify", "nightlife.scripts.register"]
+)
+def test_client_imports_stay_light(module):
+    imported = _importtime(module)
+    assert module in imported
+    heavy = sorted(name for name in imported if name.split(".")[0] in HEAVY_MODULES)
+    assert heavy == []
+    assert imported[module] < IMPORT_BUDGET_US
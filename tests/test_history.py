@@ -0,0 +1,31 @@
+import json
+
+from nightlife.history import History, HistorySettings
+
+
+def test_load_skips_lines_that_are_not_records(tmp_path):
+    log_file = tmp_path / "history.log"
+    record = [1700000000.0, "theme", "1-handler", "success", 0, 12]
+    log_file.write_text(
+        "\n".join(
+            [
+                "null",
+                "3",
+                '"text"',
+                "[1, 2]",
+                json.dumps([1700000000.0, ["theme"], "1-handler", "success", 0, 12]),
+                json.dumps([1700000000.0, "theme", "1-handler", "success", 0, "x"]),
+                json.dumps(record),
+                '[1700000001.0, "theme", "1-hand',
+            ]
+        )
+    )
+    history = History(HistorySettings(persist=True, log_file=str(log_file)))
+    history.load()
+
+    topic = history.topic_history("theme")
+    assert [handler.name for handler in topic.handlers] == ["1-handler"]
+    runs = topic.handlers[0].runs
+    assert [(run.outcome, run.exit_status, run.runtime_ms) for run in runs] == [
+        ("success", 0, 12)
+    ]
@@ -0,0 +1,41 @@
+import pytest
+
+from nightlife.config import local_urls, read_lockfile, unix_url, write_lockfile
+
+
+@pytest.mark.parametrize(
+    "host, url",
+    [
+        ("127.0.0.1", "http://127.0.0.1:8000"),
+        ("localhost", "http://localhost:8000"),
+        ("::1", "http://[::1]:8000"),
+        ("[::1]", "http://[::1]:8000"),
+    ],
+)
+def test_tcp_address(tmp_path, host, url):
+    lockfile = str(tmp_path / "principal.lock")
+    write_lockfile(lockfile, host, 8000)
+    assert read_lockfile(lockfile) == [url]
+
+
+def test_unix_socket_only(tmp_path):
+    lockfile = str(tmp_path / "principal.lock")
+    socket_path = tmp_path / "principal.sock"
+    socket_path.touch()
+    write_lockfile(lockfile, None, None, str(socket_path))
+    assert local_urls(read_lockfile(lockfile)) == [unix_url(str(socket_path))]
+
+
+def test_unix_socket_before_tcp(tmp_path):
+    lockfile = str(tmp_path / "principal.lock")
+    socket_path = tmp_path / "principal.sock"
+    socket_path.touch()
+    write_lockfile(lockfile, "127.0.0.1", 8000, str(socket_path))
+    assert read_lockfile(lockfile) == [
+        "http://127.0.0.1:8000",
+        unix_url(str(socket_path)),
+    ]
+    assert local_urls(read_lockfile(lockfile)) == [
+        unix_url(str(socket_path)),
+        "http://127.0.0.1:8000",
+    ]
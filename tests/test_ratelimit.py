@@ -0,0 +1,97 @@
+import types
+
+import pytest
+
+from nightlife import ratelimit
+from nightlife.ratelimit import LoadShed, RateLimiter, RateLimitSettings
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        ratelimit, "time", types.SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    return clock
+
+
+def test_issuer_bucket_allows_a_burst_then_sheds(clock):
+    limiter = RateLimiter(RateLimitSettings(issuer_rate=2, issuer_burst=3))
+    for _ in range(3):
+        with limiter.admitted("principal"):
+            pass
+
+    with pytest.raises(LoadShed) as shed:
+        limiter.admit("principal")
+    assert shed.value.reason == "issuer"
+    assert shed.value.retry_after == pytest.approx(0.5)
+    assert shed.value.headers() == {"Retry-After": "1"}
+    # Other issuers have buckets of their own.
+    limiter.admit("other")
+    limiter.release()
+
+    clock.now += 0.5
+    limiter.admit("principal")
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_topic_rates_override_the_default(clock):
+    limiter = RateLimiter(
+        RateLimitSettings(topic_rate=10, topic_burst=1, topic_rates={"backup": 0.1})
+    )
+    limiter.admit("principal", "backup")
+    limiter.release()
+    with pytest.raises(LoadShed) as shed:
+        limiter.admit("principal", "backup")
+    assert shed.value.reason == "topic"
+    assert shed.value.retry_after == pytest.approx(10)
+
+    limiter.admit("principal", "theme")
+    limiter.release()
+    clock.now += 0.1
+    limiter.admit("principal", "theme")
+    limiter.release()
+
+
+def test_a_shed_delivery_takes_no_tokens(clock):
+    limiter = RateLimiter(
+        RateLimitSettings(issuer_rate=1, issuer_burst=5, topic_rate=1, topic_burst=1)
+    )
+    limiter.admit("principal", "theme")
+    limiter.release()
+    for _ in range(3):
+        with pytest.raises(LoadShed):
+            limiter.admit("principal", "theme")
+    assert limiter._issuers["principal"].tokens == 4
+
+
+def test_in_flight_limit(clock):
+    limiter = RateLimiter(RateLimitSettings(max_in_flight=2))
+    limiter.admit("principal")
+    limiter.admit("principal")
+    with pytest.raises(LoadShed) as shed:
+        limiter.admit("principal")
+    assert shed.value.reason == "in_flight"
+
+    limiter.release()
+    limiter.admit("principal")
+    assert limiter.in_flight == 2
+
+
+def test_idle_buckets_are_forgotten(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_BUCKETS", 2)
+    limiter = RateLimiter(RateLimitSettings(issuer_rate=1, issuer_burst=2))
+    for issuer in ("a", "b"):
+        limiter.admit(issuer)
+        limiter.release()
+
+    clock.now += 0.5
+    limiter.admit("c")
+    limiter.release()
+    assert set(limiter._issuers) == {"a", "b", "c"}
+
+    clock.now += 0.5
+    limiter.admit("d")
+    limiter.release()
+    assert set(limiter._issuers) == {"c", "d"}
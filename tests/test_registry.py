@@ -0,0 +1,83 @@
+import pytest
+
+from nightlife.registry import Agent, AgentHealth, SqliteAgentRegistry
+
+
+def _agent(name: str, events: set[str]) -> Agent:
+    return Agent(
+        name=name,
+        host=f"https://{name}:8080",
+        key_path=f"/keys/{name}",
+        key_password=b"secret",
+        events=events,
+    )
+
+
+@pytest.fixture
+def registries(tmp_path):
+    # Two handles on one database, like two principal workers.
+    path = str(tmp_path / "registry" / "agents.db")
+    first, second = SqliteAgentRegistry(path), SqliteAgentRegistry(path)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_changes_are_reloaded_by_other_connections(registries):
+    first, second = registries
+    assert second.names() == []
+
+    first.put(_agent("desk", {"theme"}))
+    assert second.get("desk") == _agent("desk", {"theme"})
+    assert [agent.name for agent in second.subscribers("theme")] == ["desk"]
+
+    first.put(_agent("desk", {"volume"}))
+    assert second.subscribers("theme") == []
+
+    assert second.delete("desk").name == "desk"
+    assert first.names() == []
+    with pytest.raises(KeyError):
+        first.get("desk")
+    with pytest.raises(KeyError):
+        first.delete("desk")
+
+
+def test_reads_reload_only_after_a_change(registries):
+    first, second = registries
+    first.put(_agent("desk", {"theme"}))
+    version = second.version()
+    assert second.version() == version
+    second.get("desk")
+    assert second.version() == version
+
+    # Last values live in their own database and do not force a reload.
+    first.put_last_value("theme", b"dark")
+    assert second.version() == version
+    assert second.last_values(["theme", "volume"]) == {"theme": b"dark"}
+
+    first.put(_agent("laptop", {"theme"}))
+    assert second.version() == version + 1
+
+
+def test_health_is_shared_and_removed_with_the_agent(registries):
+    first, second = registries
+    first.put(_agent("desk", {"theme"}))
+    assert second.health("desk") is None
+
+    def fail(health: AgentHealth | None) -> AgentHealth:
+        health = health or AgentHealth()
+        return health.model_copy(
+            update={"consecutive_failures": health.consecutive_failures + 1}
+        )
+
+    first.update_health("desk", fail)
+    second.update_health("desk", fail)
+    assert first.health("desk").consecutive_failures == 2
+
+    version = first.version()
+    second.update_health("desk", lambda health: health)
+    assert first.version() == version
+
+    second.delete("desk")
+    first.put(_agent("desk", {"theme"}))
+    assert second.health("desk") is None
@@ -0,0 +1,122 @@
+import json
+import time
+
+import pytest
+
+from nightlife import respond
+from nightlife.respond import RespondSettings, RespondTool
+
+
+@pytest.fixture
+def topic(tmp_path, monkeypatch):
+    monkeypatch.setattr(respond, "RUNTIME_ESTIMATES", {})
+    topic_dir = tmp_path / "theme"
+    topic_dir.mkdir()
+
+    def add(name: str, script: str) -> None:
+        handler = topic_dir / name
+        handler.write_text(f"#!/bin/sh\n{script}\n")
+        handler.chmod(0o755)
+
+    def manifest(handlers: dict) -> None:
+        (topic_dir / respond.TOPIC_MANIFEST_FILE).write_text(
+            json.dumps({"handlers": handlers})
+        )
+
+    yield topic_dir, add, manifest
+    respond.close_handler_spawner()
+
+
+def _tool(topic_dir) -> RespondTool:
+    return RespondTool(
+        RespondSettings(topics_dir=str(topic_dir.parent), share_process_index=False)
+    )
+
+
+def _stdout(results) -> dict[str, bytes]:
+    return {handler.name: handler.stdout.output for handler in results.handlers}
+
+
+def test_manifest_orders_stages_and_runs_groups_in_parallel(topic):
+    topic_dir, add, manifest = topic
+    marker = topic_dir.parent / "marker"
+    add("a-late", f"cat {marker}")
+    add("b-left", "sleep 0.4; echo left")
+    add("c-right", "sleep 0.4; echo right")
+    add("d-first", f"echo first > {marker}")
+    add("e-quiet", "cat")
+    manifest(
+        {
+            "a-late": {"stage": 2},
+            "b-left": {"stage": 1, "group": "left"},
+            "c-right": {"stage": 1, "group": "right"},
+            "e-quiet": {"stdin": False, "output_limit": 2},
+        }
+    )
+
+    start = time.monotonic()
+    results = _tool(topic_dir).handle_topic("theme", b"payload")
+    assert time.monotonic() - start < 0.75
+
+    # Results keep the handlers' name order, whatever order they ran in.
+    assert [handler.name for handler in results.handlers] == [
+        "a-late",
+        "b-left",
+        "c-right",
+        "d-first",
+        "e-quiet",
+    ]
+    assert _stdout(results) == {
+        "a-late": b"first\n",
+        "b-left": b"left\n",
+        "c-right": b"right\n",
+        "d-first": b"",
+        "e-quiet": b"",
+    }
+
+
+def test_output_limit_truncates(topic):
+    topic_dir, add, manifest = topic
+    add("echo", "cat")
+    manifest({"echo": {"output_limit": 3}})
+    (result,) = _tool(topic_dir).handle_topic("theme", b"payload").handlers
+    assert (result.stdout.output, result.stdout.length, result.stdout.truncated) == (
+        b"pay",
+        7,
+        True,
+    )
+
+
+def test_deadline_skips_stages_that_cannot_finish(topic):
+    topic_dir, add, manifest = topic
+    add("fast", "echo fast")
+    add("slow", "echo slow")
+    add("slower", "echo slower")
+    manifest({"slow": {"stage": 1}, "slower": {"stage": 2}})
+    respond.RUNTIME_ESTIMATES["theme/slow"] = 0.01
+    respond.RUNTIME_ESTIMATES["theme/slower"] = 60
+
+    results = _tool(topic_dir).handle_topic("theme", b"", deadline=time.monotonic() + 5)
+    status = {handler.name: handler.status for handler in results.handlers}
+    assert not status["fast"].skipped and status["fast"].success
+    assert not status["slow"].skipped and status["slow"].success
+    assert status["slower"].skipped
+    assert not status["slower"].timed_out
+    assert respond.handler_outcome(status["slower"]) == "skipped"
+
+    # Only handlers that ran update the estimates.
+    assert "theme/fast" in respond.RUNTIME_ESTIMATES
+    assert respond.RUNTIME_ESTIMATES["theme/slower"] == 60
+
+
+def test_handlers_after_the_deadline_are_skipped(topic):
+    topic_dir, add, manifest = topic
+    add("first", "sleep 0.5")
+    add("second", "echo second")
+
+    results = _tool(topic_dir).handle_topic(
+        "theme", b"", deadline=time.monotonic() + 0.2
+    )
+    first, second = results.handlers
+    assert first.status.cancelled
+    assert second.status.skipped
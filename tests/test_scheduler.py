@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from nightlife.scheduler import (
+    SchedulerSettings,
+    TopicBusy,
+    TopicScheduler,
+    TopicSuperseded,
+    _PrioritySlots,
+)
+
+
+def _blocking(release: threading.Event, started: list):
+    def target(run):
+        started.append(run)
+        while not release.is_set() and not run.cancelled:
+            time.sleep(0.01)
+        return "cancelled" if run.cancelled else "done"
+
+    return target
+
+
+async def _until(condition) -> None:
+    for _ in range(300):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+def test_queue_runs_a_topic_one_at_a_time():
+    scheduler = TopicScheduler(SchedulerSettings(policy="queue"))
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def target(run):
+        with lock:
+            running.append(run)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(run)
+        return len(peak)
+
+    async def main():
+        return await asyncio.gather(*(scheduler.run("theme", target) for _ in range(3)))
+
+    assert sorted(asyncio.run(main())) == [1, 2, 3]
+    assert max(peak) == 1
+    assert scheduler._topics == {}
+
+
+def test_reject_fails_while_the_topic_is_busy():
+    scheduler = TopicScheduler(SchedulerSettings(policy="reject"))
+    release = threading.Event()
+    started = []
+
+    async def main():
+        first = asyncio.create_task(scheduler.run("theme", _blocking(release, started)))
+        try:
+            await _until(lambda: started)
+            with pytest.raises(TopicBusy):
+                await scheduler.run("theme", lambda run: "second")
+            assert await scheduler.run("volume", lambda run: "other") == "other"
+        finally:
+            release.set()
+        assert await first == "done"
+
+    asyncio.run(main())
+    assert scheduler._topics == {}
+
+
+def test_latest_cancels_the_running_and_supersedes_the_waiting():
+    scheduler = TopicScheduler(SchedulerSettings(policy="latest"))
+    release = threading.Event()
+    started = []
+
+    async def main():
+        first = asyncio.create_task(scheduler.run("theme", _blocking(release, started)))
+        await _until(lambda: started)
+        second = asyncio.create_task(scheduler.run("theme", lambda run: "second"))
+        await asyncio.sleep(0)
+        third = asyncio.create_task(scheduler.run("theme", lambda run: "third"))
+        try:
+            assert await first == "cancelled"
+            with pytest.raises(TopicSuperseded):
+                await second
+            assert await third == "third"
+        finally:
+            release.set()
+
+    asyncio.run(main())
+
+
+def test_topics_are_high_priority_by_default():
+    scheduler = TopicScheduler(SchedulerSettings(max_concurrency=4, reserved_slots=2))
+    release = threading.Event()
+    started = []
+
+    async def main():
+        runs = [
+            asyncio.create_task(
+                scheduler.run(f"topic-{i}", _blocking(release, started))
+            )
+            for i in range(4)
+        ]
+        try:
+            await _until(lambda: len(started) == 4)
+        finally:
+            release.set()
+        await asyncio.gather(*runs)
+
+    asyncio.run(main())
+
+
+def test_low_priority_topics_leave_the_reserved_slots_free():
+    scheduler = TopicScheduler(
+        SchedulerSettings(
+            max_concurrency=2,
+            reserved_slots=1,
+            topic_concurrency=2,
+            topic_priorities={"backup": "low"},
+        )
+    )
+    release = threading.Event()
+    started = []
+
+    async def main():
+        backups = [
+            asyncio.create_task(scheduler.run("backup", _blocking(release, started)))
+            for _ in range(2)
+        ]
+        try:
+            await _until(lambda: started)
+            await asyncio.sleep(0.1)
+            assert len(started) == 1
+            assert await scheduler.run("alert", lambda run: "alert") == "alert"
+        finally:
+            release.set()
+        assert await asyncio.gather(*backups) == ["done", "done"]
+
+    asyncio.run(main())
+
+
+def test_priority_slots_wake_high_priority_waiters_first():
+    slots = _PrioritySlots(total=2, reserved=1)
+    order = []
+
+    async def hold(priority, name, release: asyncio.Event):
+        async with slots.slot(priority):
+            order.append(name)
+            await release.wait()
+
+    async def main():
+        releases = {name: asyncio.Event() for name in ("a", "b", "low", "high")}
+        tasks = [
+            asyncio.create_task(hold("high", "a", releases["a"])),
+            asyncio.create_task(hold("high", "b", releases["b"])),
+        ]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(hold("low", "low", releases["low"])))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(hold("high", "high", releases["high"])))
+        await asyncio.sleep(0)
+        assert order == ["a", "b"]
+
+        releases["a"].set()
+        await _until(lambda: len(order) == 3)
+        assert order[2] == "high"
+
+        # The one slot left to low priority work is taken by "b".
+        releases["high"].set()
+        await asyncio.sleep(0.05)
+        assert order == ["a", "b", "high"]
+
+        releases["b"].set()
+        await _until(lambda: len(order) == 4)
+        releases["low"].set()
+        await asyncio.gather(*tasks)
+        assert slots.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_priority_slots_keep_one_slot_for_low_priority():
+    assert _PrioritySlots(total=1, reserved=5).reserved == 0
+    assert _PrioritySlots(total=4, reserved=5).reserved == 3
@@ -0,0 +1,49 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+# Generous, so that only a real regression trips them on a loaded machine.
+STARTUP_BUDGET_MS = 10_000
+RSS_BUDGET_MIB = 200
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_agent_starts_within_budget(tmp_path):
+    env = dict(
+        os.environ,
+        NIGHTLIFE_CONFIG=str(tmp_path / "config"),
+        NIGHTLIFE_STATE=str(tmp_path / "state"),
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "nightlife.scripts.agent",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(_free_port()),
+            "--no-uds",
+            "--startup-report",
+            "--startup-budget",
+            str(STARTUP_BUDGET_MS),
+            "--rss-budget",
+            str(RSS_BUDGET_MIB),
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report["over_budget"] == []
+    assert 0 < report["ready_ms"] <= report["first_request_ms"]
+    assert 0 < report["rss_kb"]
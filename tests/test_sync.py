@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from nightlife import config
+from nightlife.installer import sync
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "CONFIG_DIR", str(tmp_path / "config"))
+    source_dir = tmp_path / "source"
+    (source_dir / "events").mkdir(parents=True)
+    (source_dir / "handlers" / "theme").mkdir(parents=True)
+
+    def write(path: str, content: str, mode: int = 0o755) -> None:
+        file = source_dir / path
+        file.write_text(content)
+        file.chmod(mode)
+
+    write("events/theme", "#!/bin/sh\necho dark\n")
+    write("handlers/theme/1-gtk", "#!/bin/sh\ncat\n")
+    return source_dir, write
+
+
+def test_plan_copies_changes_and_chmods_mode_changes(source):
+    source_dir, write = source
+    plan, _ = sync.plan_sync(str(source_dir), prune=False, jobs=2)
+    assert sorted(plan.copy) == ["events/theme", "handlers/theme/1-gtk"]
+    sync.sync(str(source_dir), enable=False, prune=False, jobs=2)
+
+    plan, _ = sync.plan_sync(str(source_dir), prune=False, jobs=2)
+    assert (plan.copy, plan.chmod, plan.remove) == ({}, {}, [])
+    assert sorted(plan.unchanged) == ["events/theme", "handlers/theme/1-gtk"]
+
+    write("events/theme", "#!/bin/sh\necho light\n")
+    (source_dir / "handlers" / "theme" / "1-gtk").chmod(0o700)
+    plan, _ = sync.plan_sync(str(source_dir), prune=False, jobs=2)
+    assert plan.copy == {"events/theme": str(source_dir / "events" / "theme")}
+    assert plan.chmod == {"handlers/theme/1-gtk": 0o700}
+
+    sync.apply_sync(plan, jobs=2)
+    installed = config.config_file("events", "theme")
+    with open(installed) as f:
+        assert f.read() == "#!/bin/sh\necho light\n"
+    assert os.stat(
+        config.config_file("handlers", "theme", "1-gtk")
+    ).st_mode & 0o777 == (0o700)
+
+
+def test_unchanged_files_are_not_hashed_again(source, monkeypatch):
+    source_dir, _ = source
+    sync.sync(str(source_dir), enable=False, prune=False, jobs=1)
+
+    hashed = []
+    file_digest = sync.hashlib.file_digest
+
+    def counting_digest(f, digest):
+        hashed.append(f.name)
+        return file_digest(f, digest)
+
+    monkeypatch.setattr(sync.hashlib, "file_digest", counting_digest)
+    plan, _ = sync.plan_sync(str(source_dir), prune=False, jobs=1)
+    assert len(plan.unchanged) == 2
+    assert hashed == []
+
+
+def test_prune_removes_files_missing_from_the_source(source):
+    source_dir, write = source
+    write("handlers/theme/2-qt", "#!/bin/sh\ncat\n")
+    sync.sync(str(source_dir), enable=False, prune=False, jobs=2)
+    (source_dir / "handlers" / "theme" / "2-qt").unlink()
+
+    plan, _ = sync.plan_sync(str(source_dir), prune=False, jobs=2)
+    assert plan.remove == []
+    plan, _ = sync.plan_sync(str(source_dir), prune=True, jobs=2)
+    assert plan.remove == ["handlers/theme/2-qt"]
+
+    sync.sync(str(source_dir), enable=False, prune=True, jobs=2)
+    assert not os.path.exists(config.config_file("handlers", "theme", "2-qt"))
+    assert sorted(sync.read_manifest().files) == [
+        "events/theme",
+        "handlers/theme/1-gtk",
+    ]
+
+
+def test_enable_swaps_in_a_new_enabled_set(source):
+    source_dir, write = source
+    sync.sync(str(source_dir), enable=True, prune=False, jobs=2)
+    enabled = config.config_file("enabled")
+    assert os.path.islink(enabled)
+    first = os.path.realpath(enabled)
+    assert os.path.isfile(os.path.join(enabled, "handlers", "theme", "1-gtk"))
+
+    write("events/volume", "#!/bin/sh\necho 50\n")
+    sync.sync(str(source_dir), enable=True, prune=False, jobs=2)
+    assert os.path.realpath(enabled) != first
+    assert not os.path.exists(first)
+    assert os.path.isfile(os.path.join(enabled, "events", "volume"))
+    assert os.path.isfile(os.path.join(enabled, "events", "theme"))
@@ -0,0 +1,47 @@
+import json
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from nightlife import system
+
+
+@pytest.fixture
+def sleeper(tmp_path):
+    # Started through a link, so that its name and argv[0] basename differ
+    # from its executable's basename, "sleep".
+    link = tmp_path / "nl-sleeper"
+    link.symlink_to(shutil.which("sleep"))
+    process = subprocess.Popen([str(link), "30"])
+    time.sleep(0.1)
+    yield process
+    process.kill()
+    process.wait()
+
+
+def test_matches_name_and_executable(sleeper, monkeypatch):
+    monkeypatch.delenv(system.PROCESS_INDEX_ENV, raising=False)
+    assert sleeper.pid in {pid for pid, _ in system.find_processes(["sleep"])}
+    matched = system.find_processes(["nl-sl*"])
+    assert {pid for pid, _ in matched} == {sleeper.pid}
+
+
+def test_shared_index_reads_aliases_only_for_unmatched_names(
+    sleeper, tmp_path, monkeypatch
+):
+    index_path = tmp_path / "index" / "run.json"
+    monkeypatch.setenv(system.PROCESS_INDEX_ENV, str(index_path))
+
+    system.find_processes(["nl-sleeper"])
+    processes = json.loads(index_path.read_text())["processes"]
+    (entry,) = [p for p in processes if p[0] == sleeper.pid]
+    assert entry[3] is None
+
+    # A later handler of the run reuses the scan and records the aliases it
+    # had to read.
+    assert sleeper.pid in {pid for pid, _ in system.find_processes(["sleep"])}
+    processes = json.loads(index_path.read_text())["processes"]
+    (entry,) = [p for p in processes if p[0] == sleeper.pid]
+    assert entry[3] == ["sleep"]
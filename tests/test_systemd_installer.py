@@ -0,0 +1,111 @@
+from nightlife.config import app_file
+from nightlife.installer.systemd_installer import (
+    DEFAULT_IDLE_TIMEOUT,
+    event_units,
+    render_units,
+    server_units,
+)
+
+TEMPLATE_DIR = app_file("templates")
+
+
+def _render(units):
+    return render_units(units, TEMPLATE_DIR)
+
+
+def _directive(unit: str, name: str) -> list[str]:
+    prefix = f"{name}="
+    return [
+        line[len(prefix) :] for line in unit.splitlines() if line.startswith(prefix)
+    ]
+
+
+def test_socket_activated_agent_exits_when_idle():
+    rendered = _render(
+        server_units(
+            "agent",
+            "/bin",
+            "/state",
+            socket_activation=True,
+            listen=["127.0.0.1:8001", "/state/agent.sock"],
+            idle_timeout=DEFAULT_IDLE_TIMEOUT["agent"],
+        )
+    )
+    assert sorted(rendered) == [
+        "nightlife-server-agent.service",
+        "nightlife-server-agent.socket",
+    ]
+    service = rendered["nightlife-server-agent.service"]
+    assert _directive(service, "ExecStart") == [
+        "/bin/nightlife-agent --idle-timeout 600"
+    ]
+    assert _directive(service, "StandardOutput") == [
+        "append:/state/nightlife-server-agent/stdout.log"
+    ]
+    socket = rendered["nightlife-server-agent.socket"]
+    assert _directive(socket, "ListenStream") == [
+        "127.0.0.1:8001",
+        "/state/agent.sock",
+    ]
+    assert _directive(socket, "Service") == ["nightlife-server-agent.service"]
+
+
+def test_principal_does_not_exit_when_idle_by_default():
+    assert "principal" not in DEFAULT_IDLE_TIMEOUT
+    rendered = _render(
+        server_units(
+            "principal",
+            "/bin",
+            "/state",
+            socket_activation=True,
+            listen=["127.0.0.1:8000"],
+            idle_timeout=None,
+        )
+    )
+    service = rendered["nightlife-server-principal.service"]
+    assert _directive(service, "ExecStart") == ["/bin/nightlife-principal"]
+
+
+def test_exec_start_uses_systemd_quoting():
+    rendered = _render(
+        event_units(
+            "theme",
+            "/home/me/my bin",
+            "/state",
+            run_under=["watch", "--format", '%s "$HOME" \\'],
+            on_path=[],
+            on_calendar=[],
+        )
+    )
+    service = rendered["nightlife-event-theme.service"]
+    assert _directive(service, "ExecStart") == [
+        'watch --format "%%s \\"$$HOME\\" \\\\"'
+        ' "/home/me/my bin/nightlife-notify" theme'
+    ]
+    assert _directive(service, "Type") == ["simple"]
+
+
+def test_event_path_and_timer_units():
+    rendered = _render(
+        event_units(
+            "theme",
+            "/bin",
+            "/state",
+            run_under=None,
+            on_path=["/etc/theme%1"],
+            on_calendar=["hourly", "Mon *-*-* 09:00"],
+        )
+    )
+    assert sorted(rendered) == [
+        "nightlife-event-theme.path",
+        "nightlife-event-theme.service",
+        "nightlife-event-theme.timer",
+    ]
+    service = rendered["nightlife-event-theme.service"]
+    assert _directive(service, "Type") == ["oneshot"]
+    assert _directive(service, "ExecStart") == ["/bin/nightlife-notify theme"]
+    path = rendered["nightlife-event-theme.path"]
+    assert _directive(path, "PathChanged") == ["/etc/theme%%1"]
+    assert _directive(path, "Unit") == ["nightlife-event-theme.service"]
+    timer = rendered["nightlife-event-theme.timer"]
+    assert _directive(timer, "OnCalendar") == ["hourly", "Mon *-*-* 09:00"]
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from nightlife import dispatch
+from nightlife.dispatch import DispatchSettings, TriggerTool
+
+
+def test_concurrent_misses_share_one_trigger_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(dispatch, "TRIGGER_CACHE", {})
+    monkeypatch.setattr(dispatch, "TRIGGER_IN_FLIGHT", {})
+    runs = tmp_path / "runs"
+    event = tmp_path / "slow-event"
+    event.write_text(f"#!/bin/sh\necho run >> {runs}\nsleep 0.5\necho payload\n")
+    event.chmod(0o755)
+    tool = TriggerTool(DispatchSettings(events_dir=str(tmp_path), trigger_cache_ttl=60))
+
+    outputs = []
+    threads = [
+        threading.Thread(target=lambda: outputs.append(tool.trigger("slow-event")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+
+    assert outputs == [b"payload\n"] * 4
+    assert runs.read_text() == "run\n"
+    assert dispatch.TRIGGER_IN_FLIGHT == {}
+
+
+def test_waiters_see_the_trigger_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(dispatch, "TRIGGER_CACHE", {})
+    monkeypatch.setattr(dispatch, "TRIGGER_IN_FLIGHT", {})
+    event = tmp_path / "failing-event"
+    event.write_text("#!/bin/sh\nsleep 0.3\nexit 3\n")
+    event.chmod(0o755)
+    tool = TriggerTool(DispatchSettings(events_dir=str(tmp_path), trigger_cache_ttl=60))
+
+    errors = []
+
+    def trigger():
+        try:
+            tool.trigger("failing-event")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=trigger) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+    assert dispatch.TRIGGER_CACHE == {}
+    assert dispatch.TRIGGER_IN_FLIGHT == {}
@@ -0,0 +1,79 @@
+import pytest
+
+from nightlife import wire
+
+from nightlife.respond import (
+    TopicHandlerOutput,
+    TopicHandlerResult,
+    TopicHandlerResults,
+    TopicHandlerStatus,
+)
+from nightlife.wire import (
+    JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+    decode_results,
+    encode_results,
+    msgpack_available,
+    negotiate,
+)
+
+BINARY_OUTPUT = b"\xff\xfe\x00binary\n"
+
+
+def _results(output: bytes) -> TopicHandlerResults:
+    return TopicHandlerResults(
+        name="theme",
+        handlers=[
+            TopicHandlerResult(
+                name="1-handler",
+                status=TopicHandlerStatus(
+                    success=True, timed_out=False, exit_status=0, runtime_ms=3
+                ),
+                stdout=TopicHandlerOutput(
+                    truncated=False, length=len(output), output=output
+                ),
+                stderr=TopicHandlerOutput(truncated=False, length=0, output=b""),
+            )
+        ],
+    )
+
+
+def test_json_carries_binary_output_as_base64():
+    encoded = encode_results(_results(BINARY_OUTPUT), JSON_MEDIA_TYPE)
+    assert b'"output":"//4AYmluYXJ5Cg=="' in encoded
+    decoded = decode_results(encoded, JSON_MEDIA_TYPE)
+    assert decoded.handlers[0].stdout.output == BINARY_OUTPUT
+
+
+@pytest.mark.skipif(not msgpack_available(), reason="msgpack is not installed")
+def test_msgpack_carries_binary_output_as_is():
+    encoded = encode_results(_results(BINARY_OUTPUT), MSGPACK_MEDIA_TYPE)
+    assert BINARY_OUTPUT in encoded
+    decoded = decode_results(encoded, MSGPACK_MEDIA_TYPE)
+    assert decoded == _results(BINARY_OUTPUT)
+
+
+@pytest.mark.parametrize(
+    "accept, media_type",
+    [
+        (None, JSON_MEDIA_TYPE),
+        ("", JSON_MEDIA_TYPE),
+        ("application/msgpack", MSGPACK_MEDIA_TYPE),
+        ("application/x-msgpack", MSGPACK_MEDIA_TYPE),
+        ("Application/MsgPack", MSGPACK_MEDIA_TYPE),
+        ("application/json, application/msgpack", JSON_MEDIA_TYPE),
+        ("application/json;q=0.5, application/msgpack", MSGPACK_MEDIA_TYPE),
+        ("application/msgpack;q=0.2, */*;q=0.8", JSON_MEDIA_TYPE),
+        ("application/msgpack;q=0, application/json", JSON_MEDIA_TYPE),
+        ("application/msgpack;q=oops, application/json", JSON_MEDIA_TYPE),
+        ("text/html", JSON_MEDIA_TYPE),
+    ],
+)
+def test_negotiate(monkeypatch, accept, media_type):
+    monkeypatch.setattr(wire, "msgpack_available", lambda: True)
+    assert negotiate(accept) == media_type
+
+
+def test_negotiate_falls_back_to_json_without_msgpack(monkeypatch):
+    monkeypatch.setattr(wire, "msgpack_available", lambda: False)
+    assert negotiate("application/msgpack, application/json;q=0.1") == (JSON_MEDIA_TYPE)